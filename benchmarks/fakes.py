@@ -0,0 +1,489 @@
+'''
+Copyright 2023 The Board of Trustees of The Leland Stanford Junior University
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+'''
+
+"""
+Synthetic measurement data and stand-ins for the external services, for
+running the pipeline offline in benchmarks.
+
+- `trace_record` builds scamper-style JSON trace records and `warts_trace`
+  encodes them as warts; the fake `scamper` executable in
+  `benchmarks/fake_scamper` serves them in either format.
+- `FakeCensysHosts` pages through synthetic Censys hosts like `CensysHosts`.
+- `FakeBigQueryClient` returns synthetic Censys result sets for queries and
+  accepts load jobs, counting the rows loaded into each table.
+
+Only the standard library is imported at module level so the fake scamper
+starts quickly.
+"""
+
+import io
+import json
+import os
+import random
+import socket
+import struct
+import time
+import zlib
+
+FAKE_SCAMPER_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "fake_scamper")
+
+
+def synthetic_ip(i: int) -> str:
+    """
+    :return: the i-th address of a synthetic /8 (i < 2**24)
+    """
+    return "98.{}.{}.{}".format(i >> 16 & 255, i >> 8 & 255, i & 255)
+
+
+def path_depth(dst: str, max_hops: int = 12) -> int:
+    """
+    :return: number of hops to `dst`, fixed per destination
+    """
+    return 4 + zlib.crc32(dst.encode()) % max(max_hops - 3, 1)
+
+
+def hop_addr(dst: str, ttl: int, depth: int) -> str:
+    # destinations in the same /24 share their path
+    if ttl >= depth:
+        return dst
+    return "100.64.{}.{}".format(ttl, zlib.crc32(dst.rsplit(".", 1)[0].encode() + bytes([ttl])) % 254 + 1)
+
+
+def trace_record(dst: str, ttl: int = None, userid: int = 0, now: float = None, loss: float = 0.0,
+                 max_hops: int = 12, rng: random.Random = random) -> dict:
+    """
+    Build a scamper `trace -P icmp-paris -q 1` JSON record.
+
+    :param dst: destination IP
+    :param ttl: (optional) probe only this TTL (`-f ttl -m ttl`), as `ttl_ping` does;
+    a full paris-traceroute otherwise
+    :param userid: (optional) userid of the command (`-U`)
+    :param now: (optional) start time, defaults to the current time
+    :param loss: (optional) probability of a probe getting no reply
+    :param max_hops: (optional) longest path to a destination
+    :param rng: (optional) random source for RTTs and losses
+    :return: the record as a dict
+    """
+    if now is None:
+        now = time.time()
+    depth = path_depth(dst, max_hops)
+    ttls = range(1, depth + 1) if ttl is None else [ttl]
+    hops = []
+    for t in ttls:
+        if rng.random() < loss:
+            continue
+        hops.append({
+            "addr": hop_addr(dst, t, depth),
+            "probe_ttl": t,
+            "probe_id": 1,
+            "probe_size": 44,
+            "tx": {"sec": int(now), "usec": int(now % 1 * 1000000)},
+            "rtt": round(rng.uniform(20, 60) + 2 * t, 3),
+            "reply_ttl": 64 - t,
+            "reply_tos": 0,
+            "reply_size": 56,
+            "reply_ipid": rng.randrange(65536),
+            "icmp_type": 0 if t >= depth else 11,
+            "icmp_code": 0,
+        })
+    completed = any(h["addr"] == dst for h in hops)
+    record = {
+        "type": "trace",
+        "version": "0.1",
+        "userid": userid,
+        "method": "icmp-echo-paris",
+        "src": "10.0.0.1",
+        "dst": dst,
+        "icmp_sum": 0,
+        "stop_reason": "COMPLETED" if completed else "GAPLIMIT",
+        "stop_data": 0,
+        "start": {
+            "sec": int(now),
+            "usec": int(now % 1 * 1000000),
+            "ftime": time.strftime("%Y-%m-%d %H:%M:%S", time.gmtime(now)),
+        },
+        "hop_count": max([h["probe_ttl"] for h in hops], default=ttls[-1]),
+        "attempts": 1,
+        "hoplimit": 0,
+        "firsthop": ttls[0],
+        "wait": 5,
+        "wait_probe": 0,
+        "tos": 0,
+        "probe_size": 44,
+        "probe_count": len(ttls),
+    }
+    if hops:
+        record["hops"] = hops
+    return record
+
+
+# scamper trace types; `trace -P icmp-paris` is ICMP_ECHO_PARIS
+WARTS_TRACE_TYPES = {"icmp-echo": 1, "udp": 2, "tcp": 3, "icmp-echo-paris": 4, "udp-paris": 5, "tcp-ack": 6}
+
+WARTS_STOP_REASONS = ("NONE", "COMPLETED", "UNREACH", "ICMP", "LOOP", "GAPLIMIT",
+                      "ERROR", "HOPLIMIT", "GSS", "HALTED")
+
+
+def _warts_object(obj_type: int, body: bytes) -> bytes:
+    return struct.pack(">HHI", 0x1205, obj_type, len(body)) + body
+
+
+def _warts_params(params: list) -> bytes:
+    """
+    :param params: (flag, encoded value) pairs in increasing flag order
+    :return: the flag bitmap, parameter length and parameters
+    """
+    if not params:
+        return b"\x00"
+    flags = bytearray((params[-1][0] - 1) // 7 + 1)
+    for flag, _ in params:
+        flags[(flag - 1) // 7] |= 1 << ((flag - 1) % 7)
+    for i in range(len(flags) - 1):
+        flags[i] |= 0x80
+    data = b"".join(value for _, value in params)
+    return bytes(flags) + struct.pack(">H", len(data)) + data
+
+
+def _warts_addr(addr: str, table: dict) -> bytes:
+    # addresses already defined in the object are referenced by ID
+    if addr in table:
+        return struct.pack(">BI", 0, table[addr])
+    table[addr] = len(table)
+    if ":" in addr:
+        return struct.pack(">BB", 16, 2) + socket.inet_pton(socket.AF_INET6, addr)
+    return struct.pack(">BB", 4, 1) + socket.inet_pton(socket.AF_INET, addr)
+
+
+def warts_preamble(list_name: str = "default", start_time: int = None) -> bytes:
+    """
+    :return: the list and cycle start objects scamper writes before the first trace
+    """
+    if start_time is None:
+        start_time = int(time.time())
+    name = list_name.encode() + b"\x00"
+    list_obj = _warts_object(1, struct.pack(">II", 1, 1) + name + b"\x00")
+    cycle_obj = _warts_object(2, struct.pack(">IIII", 1, 1, 1, start_time) + b"\x00")
+    return list_obj + cycle_obj
+
+
+def warts_cycle_stop(stop_time: int = None) -> bytes:
+    """
+    :return: the cycle stop object scamper writes after the last trace
+    """
+    if stop_time is None:
+        stop_time = int(time.time())
+    return _warts_object(4, struct.pack(">II", 1, stop_time) + b"\x00")
+
+
+def warts_trace(record: dict, icmpext: bool = False) -> bytes:
+    """
+    Encode a scamper JSON trace record (see `trace_record`) as a warts trace
+    object, as scamper writes it with `-O warts`.
+
+    :param record: the trace record
+    :param icmpext: (optional) attach an ICMP extension block to every hop
+    :return: the warts object
+    """
+    table = {}
+    start = record.get("start", {})
+    params = [
+        (1, struct.pack(">I", 1)),
+        (2, struct.pack(">I", 1)),
+        (5, struct.pack(">II", start.get("sec", 0), start.get("usec", 0))),
+        (6, struct.pack(">B", WARTS_STOP_REASONS.index(record["stop_reason"]))),
+        (7, struct.pack(">B", record.get("stop_data", 0))),
+        (9, struct.pack(">B", record.get("attempts", 1))),
+        (10, struct.pack(">B", record.get("hoplimit", 0))),
+        (11, struct.pack(">B", WARTS_TRACE_TYPES.get(record.get("method"), 4))),
+        (12, struct.pack(">H", record.get("probe_size", 44))),
+        (15, struct.pack(">B", record.get("firsthop", 1))),
+        (16, struct.pack(">B", record.get("tos", 0))),
+        (17, struct.pack(">B", record.get("wait", 5))),
+        (19, struct.pack(">H", record["hop_count"])),
+        (23, struct.pack(">H", record.get("probe_count", 0))),
+        (24, struct.pack(">B", record.get("wait_probe", 0))),
+        (26, _warts_addr(record.get("src", "10.0.0.1"), table)),
+        (27, _warts_addr(record["dst"], table)),
+        (28, struct.pack(">I", record.get("userid", 0))),
+        # a parameter past the ones the decoder reads
+        (29, struct.pack(">H", 0)),
+    ]
+    body = bytearray(_warts_params(params))
+
+    hops = record.get("hops", [])
+    body += struct.pack(">H", len(hops))
+    for hop in hops:
+        tx = hop.get("tx", {"sec": start.get("sec", 0), "usec": start.get("usec", 0)})
+        hop_params = [
+            (2, struct.pack(">B", hop["probe_ttl"])),
+            (3, struct.pack(">B", hop.get("reply_ttl", 0))),
+            (5, struct.pack(">B", hop.get("probe_id", 1))),
+            (6, struct.pack(">I", round(hop["rtt"] * 1000))),
+            (7, struct.pack(">BB", hop.get("icmp_type", 11), hop.get("icmp_code", 0))),
+            (8, struct.pack(">H", hop.get("probe_size", 44))),
+            (9, struct.pack(">H", hop.get("reply_size", 56))),
+            (10, struct.pack(">H", hop.get("reply_ipid", 0))),
+            (11, struct.pack(">B", hop.get("reply_tos", 0))),
+        ]
+        if icmpext:
+            # one MPLS label stack extension
+            ext = struct.pack(">HBB", 4, 1, 1) + struct.pack(">I", 0x00010140)
+            hop_params.append((17, struct.pack(">H", len(ext)) + ext))
+        hop_params += [
+            (18, _warts_addr(hop["addr"], table)),
+            (19, struct.pack(">II", tx["sec"], tx["usec"])),
+        ]
+        body += _warts_params(hop_params)
+    # end of the trace's optional attributes
+    body += struct.pack(">H", 0)
+    return _warts_object(6, bytes(body))
+
+
+def write_synthetic_traces(path: str, num_traces: int, seed: int = 0, scamper_format: str = "json") -> None:
+    """
+    Write `num_traces` scamper-style trace records with irregular hops
+    (gaps, unsorted TTLs, traces without hops) to `path`.
+
+    :param scamper_format: (optional) "json" or "warts"
+    """
+    rng = random.Random(seed)
+    with open(path, "w" if scamper_format == "json" else "wb") as f:
+        if scamper_format == "json":
+            f.write(json.dumps({"type": "cycle-start", "list_name": "synthetic", "id": 1}) + "\n")
+        else:
+            f.write(warts_preamble("synthetic", 1700000000))
+        for i in range(num_traces):
+            num_hops = rng.randint(0, 12)
+            ttls = rng.sample(range(1, 16), num_hops)
+            sec = 1700000000 + i
+            # every field scamper writes for a hop and a trace, so both
+            # formats carry what a real run does
+            hops = [{
+                "addr": "100.64.%d.%d" % (ttl, rng.randint(0, 255)),
+                "probe_ttl": ttl,
+                "probe_id": 1,
+                "probe_size": 44,
+                "tx": {"sec": sec, "usec": 0},
+                "rtt": round(rng.uniform(1, 120), 3),
+                "reply_ttl": 64 - ttl,
+                "reply_tos": 0,
+                "reply_size": 56,
+                "reply_ipid": rng.randrange(65536),
+                "icmp_type": 11,
+                "icmp_code": 0,
+            } for ttl in ttls]
+            record = {
+                "type": "trace",
+                "version": "0.1",
+                "userid": 0,
+                "method": "icmp-echo-paris",
+                "src": "10.0.0.1",
+                "dst": "98.97.%d.%d" % (i // 256 % 256, i % 256),
+                "icmp_sum": 0,
+                "stop_reason": rng.choice(["COMPLETED", "GAPLIMIT", "UNREACH"]),
+                "stop_data": 0,
+                "start": {"sec": sec, "usec": 0, "ftime": "2023-11-14 22:13:20"},
+                "hop_count": max(ttls, default=0),
+                "attempts": 1,
+                "hoplimit": 0,
+                "firsthop": 1,
+                "wait": 5,
+                "wait_probe": 0,
+                "tos": 0,
+                "probe_size": 44,
+                "probe_count": 15,
+            }
+            if hops:
+                record["hops"] = hops
+            if scamper_format == "json":
+                f.write(json.dumps(record) + "\n")
+            else:
+                f.write(warts_trace(record))
+
+
+def synthetic_ping_rounds(num_destinations: int, rounds: int = 2, loss: float = 0.02, seed: int = 0,
+                          work_dir: str = None) -> dict:
+    """
+    Build the scamper output of `rounds` TTL ping rounds to the last hop of
+    `num_destinations` destinations, in the shape `aggregate_data` reads.
+
+    :param work_dir: (optional) write each round to a file in this directory
+    instead of keeping it in memory
+    :return: JSON-lines buffer (or open file) for each round
+    """
+    rng = random.Random(seed)
+    files = {}
+    for seq in range(1, rounds + 1):
+        if work_dir is None:
+            buf = io.StringIO()
+        else:
+            buf = open(os.path.join(work_dir, "round-{}.json".format(seq)), "w+")
+        now = 1700000000 + seq
+        for i in range(num_destinations):
+            dst = synthetic_ip(i)
+            buf.write(json.dumps(trace_record(dst, path_depth(dst), seq, now, loss, rng=rng)) + "\n")
+        files[seq] = buf
+    return files
+
+
+def synthetic_hosts(num_hosts: int, start: int = 0) -> list:
+    """
+    :return: Censys host search results for `num_hosts` synthetic hosts
+    """
+    return [{
+        "ip": synthetic_ip(i),
+        "services": [{"port": 80, "service_name": "HTTP"}, {"port": 443, "service_name": "HTTP"}],
+        "dns": {"reverse_dns": {"names": ["host-{}.example.net".format(i)]}},
+        "autonomous_system": {"asn": 64500},
+    } for i in range(start, start + num_hosts)]
+
+
+def synthetic_traceroutes(num_destinations: int, asn: int = 64500):
+    """
+    :return: dataframe shaped like the output of
+    `DataCollection.paris_traceroute_exposed_services`
+    """
+    import pandas as pd
+    ips = [synthetic_ip(i) for i in range(num_destinations)]
+    depths = [path_depth(ip) for ip in ips]
+    return pd.DataFrame({
+        "ip": ips,
+        "date": time.strftime("%Y-%m-%d"),
+        "asn": asn,
+        "stop_reason": "COMPLETED",
+        "hop_count": [float(d) for d in depths],
+        "sec_last_ip": [hop_addr(ip, d - 1, d) for ip, d in zip(ips, depths)],
+        "sec_last_hop": [float(d - 1) for d in depths],
+    })
+
+
+class FakeCensysHosts:
+    """
+    Stand-in for `censys.search.CensysHosts` that pages through synthetic hosts.
+    """
+
+    def __init__(self, num_hosts: int, per_page: int = 100, latency: float = 0.0) -> None:
+        """
+        :param num_hosts: hosts returned by each search
+        :param per_page: (optional) hosts per page (Censys returns at most 100)
+        :param latency: (optional) seconds each page takes to arrive
+        """
+        self.num_hosts = num_hosts
+        self.per_page = per_page
+        self.latency = latency
+
+    def search(self, query: str, pages: int = -1):
+        for start in range(0, self.num_hosts, self.per_page):
+            time.sleep(self.latency)
+            yield synthetic_hosts(min(self.per_page, self.num_hosts - start), start)
+
+
+class _FakeRowIterator:
+
+    def __init__(self, num_rows: int, page_size: int, asn: int, latency: float) -> None:
+        self.num_rows = num_rows
+        self.page_size = page_size or num_rows
+        self.asn = asn
+        self.latency = latency
+
+    def to_dataframe_iterable(self):
+        import pandas as pd
+        for start in range(0, self.num_rows, self.page_size):
+            time.sleep(self.latency)
+            n = min(self.page_size, self.num_rows - start)
+            yield pd.DataFrame({
+                "ip": [synthetic_ip(i) for i in range(start, start + n)],
+                "date": time.strftime("%Y-%m-%d"),
+                "asn": self.asn,
+                "dns_name": [["host-{}.example.net".format(i)] for i in range(start, start + n)],
+                "port": [[80, 443]] * n,
+                "pep_link": [[False, False]] * n,
+            })
+
+    def to_dataframe(self):
+        import pandas as pd
+        return pd.concat(list(self.to_dataframe_iterable()), ignore_index=True)
+
+
+class _FakeQueryJob:
+
+    def __init__(self, client: "FakeBigQueryClient") -> None:
+        self.client = client
+
+    def result(self, page_size: int = None):
+        return _FakeRowIterator(self.client.censys_rows, page_size, self.client.asn, self.client.latency)
+
+
+class _FakeLoadJob:
+
+    def __init__(self, client: "FakeBigQueryClient", data: bytes, table_id: str) -> None:
+        self.client = client
+        self.data = data
+        self.table_id = table_id
+        self.errors = []
+        self.output_rows = None
+
+    def result(self):
+        import pyarrow.parquet as pq
+        time.sleep(self.client.latency)
+        self.output_rows = pq.ParquetFile(io.BytesIO(self.data)).metadata.num_rows
+        self.client.loaded[self.table_id] = self.client.loaded.get(self.table_id, 0) + self.output_rows
+        self.client.loaded_bytes += len(self.data)
+        return self
+
+
+class FakeBigQueryClient:
+    """
+    Stand-in for `google.cloud.bigquery.Client`. Queries return a synthetic
+    Censys universal dataset result set; Parquet load jobs are read back and
+    their row counts added to `loaded`.
+    """
+
+    def __init__(self, censys_rows: int = 0, asn: int = 64500, latency: float = 0.0) -> None:
+        """
+        :param censys_rows: (optional) rows returned by every query
+        :param asn: (optional) ASN of the returned hosts
+        :param latency: (optional) seconds each result page or load job takes
+        """
+        self.censys_rows = censys_rows
+        self.asn = asn
+        self.latency = latency
+        self.loaded = {}
+        self.loaded_bytes = 0
+
+    def query(self, sql: str) -> _FakeQueryJob:
+        return _FakeQueryJob(self)
+
+    def load_table_from_file(self, file_obj, table_id: str, job_config=None) -> _FakeLoadJob:
+        return _FakeLoadJob(self, file_obj.read(), table_id)
+
+
+def install_fake_bigquery(client: FakeBigQueryClient) -> None:
+    """
+    Make `bq_upload.get_client` return `client`, in this process and in the
+    worker processes it forks.
+    """
+    import bq_upload
+    from google.cloud import bigquery
+    bigquery.Client = lambda *args, **kwargs: client
+    bq_upload._client = None
+
+
+def use_fake_scamper() -> None:
+    """
+    Put the fake `scamper` executable first on the PATH.
+    """
+    os.environ["PATH"] = FAKE_SCAMPER_DIR + os.pathsep + os.environ.get("PATH", "")
@@ -0,0 +1,261 @@
+'''
+Copyright 2023 The Board of Trustees of The Leland Stanford Junior University
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+'''
+
+"""
+Offline benchmark suite for the pipeline stages.
+
+Every stage runs against synthetic data and the stand-ins in `fakes` (the
+fake scamper executable, synthetic Censys pages and a fake BigQuery
+client), so no network access or credentials are needed. Each benchmark
+runs in its own process at every size (number of destinations) and reports
+its wall time, throughput and peak RSS.
+
+Results are compared with the stored baselines in `baselines.json`; a
+benchmark that got slower than its baseline by more than the tolerance is
+reported as a regression and the suite exits with status 1.
+
+    python benchmarks/suite.py                          # 1k, 100k and 1M destinations
+    python benchmarks/suite.py --sizes 1000 --only ttl_ping upload
+    python benchmarks/suite.py --sizes 1000 100000 --save-baseline
+
+Baselines depend on the machine; save new ones when moving the suite to
+another host.
+"""
+
+import argparse
+import json
+import multiprocessing
+import os
+import platform
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+import fakes
+import metrics
+from bq_upload import BigQueryUploader
+from data_collection import DataCollection
+from data_parse import aggregate_data, get_last_hops_from_paris_tr
+from scamper import plan_ttl_probes, ttl_ping
+from search_censys import iter_censys_bq, iter_censys_hosts
+
+BASELINES = os.path.join(os.path.dirname(os.path.abspath(__file__)), "baselines.json")
+
+SIZES = (1000, 100000, 1000000)
+
+ASN = 64500
+
+
+def bench_last_hops(size: int, work_dir: str, args) -> dict:
+    path = os.path.join(work_dir, "traces.json")
+    fakes.write_synthetic_traces(path, size)
+    start = time.perf_counter()
+    df = get_last_hops_from_paris_tr(path)
+    return {"seconds": time.perf_counter() - start, "rows": len(df)}
+
+
+def bench_last_hops_warts(size: int, work_dir: str, args) -> dict:
+    path = os.path.join(work_dir, "traces.warts")
+    fakes.write_synthetic_traces(path, size, scamper_format="warts")
+    start = time.perf_counter()
+    df = get_last_hops_from_paris_tr(path)
+    return {"seconds": time.perf_counter() - start, "rows": len(df)}
+
+
+def bench_aggregate_data(size: int, work_dir: str, args) -> dict:
+    files = fakes.synthetic_ping_rounds(size, args.rounds, work_dir=work_dir)
+    start = time.perf_counter()
+    df = aggregate_data(files, compact=True)
+    return {"seconds": time.perf_counter() - start, "rows": len(df)}
+
+
+def bench_ttl_ping(size: int, work_dir: str, args) -> dict:
+    probe_file = os.path.join(work_dir, "probes.csv")
+    plan_ttl_probes(fakes.synthetic_traceroutes(size, ASN)).to_csv(probe_file, index=False)
+    outputs = {name: os.path.join(work_dir, name + ".csv") for name in ("sec_last", "last", "rtt_summary")}
+    start = time.perf_counter()
+    results = ttl_ping(probe_file, outputs, args.rounds, 0, asn=ASN)
+    return {"seconds": time.perf_counter() - start, "rows": sum(len(df) for df in results.values())}
+
+
+def bench_ping_exposed_services(size: int, work_dir: str, args) -> dict:
+    dc = DataCollection(data_dir=work_dir)
+    tr_df = fakes.synthetic_traceroutes(size, ASN)
+    start = time.perf_counter()
+    dc.ping_exposed_services(tr_df, args.rounds, 0, max_concurrency=args.workers)
+    seconds = time.perf_counter() - start
+    outputs, _ = dc._ping_outputs()
+    rows = 0
+    for hop_type in ("sec_last", "last"):
+        with open(outputs[hop_type]) as f:
+            rows += sum(1 for _ in f)
+    return {"seconds": seconds, "rows": rows}
+
+
+def bench_upload(size: int, work_dir: str, args) -> dict:
+    df = aggregate_data(fakes.synthetic_ping_rounds(size, args.rounds, work_dir=work_dir), compact=True)
+    client = fakes.FakeBigQueryClient()
+    # the uploader imports the BigQuery SDK on first use; keep that one-time
+    # cost (reported by `main.py --timings`) out of the load throughput
+    import google.cloud.bigquery
+    start = time.perf_counter()
+    with BigQueryUploader(client=client) as uploader:
+        uploader.submit("benchmark.pings", "pings", df)
+    seconds = time.perf_counter() - start
+    if client.loaded.get("benchmark.pings") != len(df):
+        raise Exception("Fake BigQuery loaded {} of {} rows".format(client.loaded.get("benchmark.pings"), len(df)))
+    return {"seconds": seconds, "rows": len(df), "bytes": client.loaded_bytes}
+
+
+def bench_censys_api(size: int, work_dir: str, args) -> dict:
+    client = fakes.FakeCensysHosts(size)
+    start = time.perf_counter()
+    rows = sum(1 for _ in iter_censys_hosts(ASN, 4, client=client))
+    return {"seconds": time.perf_counter() - start, "rows": rows}
+
+
+def bench_censys_bq(size: int, work_dir: str, args) -> dict:
+    client = fakes.FakeBigQueryClient(censys_rows=size, asn=ASN)
+    start = time.perf_counter()
+    rows = sum(len(df) for df in iter_censys_bq(ASN, 4, "benchmark.censys", client=client))
+    return {"seconds": time.perf_counter() - start, "rows": rows}
+
+
+BENCHMARKS = {
+    "last_hops": bench_last_hops,
+    "last_hops_warts": bench_last_hops_warts,
+    "aggregate_data": bench_aggregate_data,
+    "ttl_ping": bench_ttl_ping,
+    "ping_exposed_services": bench_ping_exposed_services,
+    "upload": bench_upload,
+    "censys_api": bench_censys_api,
+    "censys_bq": bench_censys_bq,
+}
+
+
+def _run_one(name: str, size: int, args, results) -> None:
+    with tempfile.TemporaryDirectory(prefix="bench-") as work_dir:
+        result = BENCHMARKS[name](size, work_dir, args)
+    result["rows_per_second"] = result["rows"] / result["seconds"] if result["seconds"] > 0 else None
+    result["peak_rss_mb"] = metrics.peak_rss_mb()
+    results.put(result)
+
+
+def run(name: str, size: int, args) -> dict:
+    """
+    Run a benchmark in a fresh process, so its peak RSS is its own.
+    """
+    results = multiprocessing.Queue()
+    p = multiprocessing.Process(target=_run_one, args=(name, size, args, results))
+    p.start()
+    result = None
+    while p.is_alive() or not results.empty():
+        try:
+            result = results.get(timeout=1)
+            break
+        except Exception:
+            continue
+    p.join()
+    if result is None:
+        raise Exception("Benchmark {} at {} destinations failed with exit code {}".format(name, size, p.exitcode))
+    return result
+
+
+def load_baselines(path: str) -> dict:
+    if not os.path.exists(path):
+        return {}
+    with open(path) as f:
+        return json.load(f).get("results", {})
+
+
+def save_baselines(path: str, results: dict) -> None:
+    baselines = load_baselines(path)
+    for name, sizes in results.items():
+        baselines.setdefault(name, {}).update(sizes)
+    with open(path, "w") as f:
+        json.dump({
+            "environment": {
+                "python": platform.python_version(),
+                "machine": platform.machine(),
+                "processor": platform.processor(),
+                "cpus": os.cpu_count(),
+                "saved": time.strftime("%Y-%m-%d"),
+            },
+            "results": baselines,
+        }, f, indent=2, sort_keys=True)
+        f.write("\n")
+
+
+def compare(result: dict, baseline: dict, tolerance: float, min_delta: float) -> tuple:
+    """
+    :return: (ratio to the baseline time or None, whether it is a regression)
+    """
+    if baseline is None:
+        return None, False
+    ratio = result["seconds"] / baseline["seconds"] if baseline["seconds"] > 0 else None
+    regression = (result["seconds"] > baseline["seconds"] * (1 + tolerance)
+                  and result["seconds"] - baseline["seconds"] > min_delta)
+    return ratio, regression
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Offline benchmark suite for the pipeline stages; exits with status 1 on a regression.",
+        epilog="examples:\n"
+               "  python benchmarks/suite.py --sizes 1000 --only ttl_ping upload\n"
+               "  python benchmarks/suite.py --sizes 1000 100000 --save-baseline",
+        formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sizes", type=int, nargs="+", default=SIZES, help="numbers of destinations")
+    parser.add_argument("--only", nargs="+", choices=sorted(BENCHMARKS), help="benchmarks to run (default all)")
+    parser.add_argument("--rounds", type=int, default=2, help="ping rounds per destination")
+    parser.add_argument("--workers", type=int, default=4, help="ping workers for ping_exposed_services")
+    parser.add_argument("--baselines", default=BASELINES, help="baselines file")
+    parser.add_argument("--save-baseline", action="store_true", help="store the results as the new baselines")
+    parser.add_argument("--tolerance", type=float, default=0.25, help="allowed slowdown relative to the baseline")
+    parser.add_argument("--min-delta", type=float, default=0.05, help="slowdowns of fewer seconds are ignored")
+    parser.add_argument("--output", help="also write the results to this JSON file")
+    args = parser.parse_args()
+
+    fakes.use_fake_scamper()
+    baselines = load_baselines(args.baselines)
+    results = {}
+    regressions = []
+    print("{:<24}{:>10}{:>10}{:>14}{:>10}{:>10}".format("benchmark", "size", "seconds", "rows/s", "rss MB", "vs base"))
+    for name in args.only or BENCHMARKS:
+        for size in args.sizes:
+            result = run(name, size, args)
+            results.setdefault(name, {})[str(size)] = result
+            ratio, regression = compare(result, baselines.get(name, {}).get(str(size)), args.tolerance, args.min_delta)
+            if regression:
+                regressions.append((name, size))
+            print("{:<24}{:>10}{:>10.3f}{:>14.0f}{:>10.0f}{:>10}".format(
+                name, size, result["seconds"], result["rows_per_second"] or 0, result["peak_rss_mb"],
+                "-" if ratio is None else "{:.2f}x{}".format(ratio, " !" if regression else "")))
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+    if args.save_baseline:
+        save_baselines(args.baselines, results)
+        print("saved baselines to " + args.baselines)
+    if regressions:
+        print("regressions: " + ", ".join("{} at {}".format(n, s) for n, s in regressions))
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -14,14 +14,42 @@ See the License for the specific language governing permissions and
 limitations under the License.
 '''
 
-from google.cloud import bigquery
-import google.cloud.exceptions
+import io
+import os
+import threading
+import time
+import metrics
+import pandas as pd
+import pyarrow.parquet as pq
+from concurrent.futures import ThreadPoolExecutor
+from storage import SCHEMAS, to_arrow_table
+
+# the BigQuery client library is imported by the functions that use it, so
+# runs that never upload do not pay for loading it
+
+_client = None
+_client_pid = None
+
+def get_client() -> "bigquery.Client":
+    """
+    Returns the BigQuery client shared by everything in this process. A new
+    client is created after a fork so children never reuse the parent's
+    connections.
+    """
+    global _client, _client_pid
+    if _client is None or _client_pid != os.getpid():
+        from google.cloud import bigquery
+        _client = bigquery.Client()
+        _client_pid = os.getpid()
+    return _client
 
 def get_improved_bad_request_exception(
-    job: google.cloud.bigquery.job.LoadJob
-) -> google.cloud.exceptions.BadRequest:
+    job: "bigquery.job.LoadJob"
+) -> "BadRequest":
+    from google.cloud.exceptions import BadRequest
+
     errors = job.errors
-    result = google.cloud.exceptions.BadRequest(
+    result = BadRequest(
         '; '.join([error['message'] for error in errors]),
         errors=errors
     )
@@ -31,8 +59,11 @@ def get_improved_bad_request_exception(
 
 def upload_exposed_services_file(table_id, file_path):
     # https://cloud.google.com/bigquery/docs/samples/bigquery-create-table
+    from google.cloud import bigquery
+    from google.cloud.exceptions import BadRequest
+
 
-    client = bigquery.Client()
+    client = get_client()
 
     job_config = bigquery.LoadJobConfig(
         source_format=bigquery.SourceFormat.NEWLINE_DELIMITED_JSON, 
@@ -59,24 +90,20 @@ def upload_exposed_services_file(table_id, file_path):
 
     try:
         job.result()
-    except google.cloud.exceptions.BadRequest as exc:
+    except BadRequest as exc:
         raise get_improved_bad_request_exception(job) from exc
 
-    table = client.get_table(table_id)  # Make an API request.
     print(
-        "Uploading exposed service data from {} to {} table".format(
-            file_path, table_id
-        )
-    )
-    print(
-        "Loaded {} rows and {} columns to {}".format(
-            table.num_rows, len(table.schema), table_id
+        "Loaded {} rows of exposed service data from {} to {}".format(
+            job.output_rows, file_path, table_id
         )
     )
 
 def upload_ping_file(table_id, file_path):
     # Construct a BigQuery client object.
-    client = bigquery.Client()
+    from google.cloud import bigquery
+
+    client = get_client()
 
     job_config = bigquery.LoadJobConfig(
         source_format=bigquery.SourceFormat.CSV, 
@@ -101,14 +128,173 @@ def upload_ping_file(table_id, file_path):
 
     job.result()  # Waits for the job to complete.
 
-    table = client.get_table(table_id)  # Make an API request.
     print(
-        "Uploading ping data from {} to {} table".format(
-            file_path, table_id
+        "Loaded {} rows of ping data from {} to {}".format(
+            job.output_rows, file_path, table_id
         )
     )
+
+def upload_parquet_file(table_id, file_path):
+    """
+    Load a Parquet file written by `storage.write_parquet` into a BigQuery
+    table. The file carries its own schema, so no explicit schema is needed.
+    """
+    from google.cloud import bigquery
+    from google.cloud.exceptions import BadRequest
+
+    client = get_client()
+
+    parquet_options = bigquery.ParquetOptions()
+    parquet_options.enable_list_inference = True
+    job_config = bigquery.LoadJobConfig(
+        source_format=bigquery.SourceFormat.PARQUET,
+        parquet_options=parquet_options,
+    )
+
+    with open(file_path, "rb") as source_file:
+        job = client.load_table_from_file(source_file, table_id, job_config=job_config)
+
+    try:
+        job.result()
+    except BadRequest as exc:
+        raise get_improved_bad_request_exception(job) from exc
+
     print(
-        "Loaded {} rows and {} columns to {}".format(
-            table.num_rows, len(table.schema), table_id
+        "Loaded {} rows from {} to {}".format(
+            job.output_rows, file_path, table_id
         )
     )
+
+
+class BigQueryUploader:
+    """
+    Queues result dataframes and loads them into BigQuery as a few large
+    Parquet load jobs.
+
+    Frames submitted for the same table are batched until `batch_rows` rows
+    are queued, then serialized to Parquet in memory and loaded on a small
+    thread pool, so uploads overlap with probing. Failed loads are retried
+    with exponential backoff; bad requests (schema errors) are not retried.
+    A callback can be attached to each frame to learn when its rows are
+    committed to BigQuery.
+    """
+
+    def __init__(self, client=None, max_workers: int = 2, batch_rows: int = 500000,
+                 max_retries: int = 5, backoff: float = 1.0) -> None:
+        """
+        :param client: (optional) BigQuery client, defaults to the shared client
+        :param max_workers: (optional) number of load jobs running at once
+        :param batch_rows: (optional) rows queued per table before a load job is started
+        :param max_retries: (optional) attempts per load job before giving up
+        :param backoff: (optional) seconds to wait before the first retry, doubled after each failure
+        """
+        self.client = client if client is not None else get_client()
+        self.batch_rows = batch_rows
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.stats = []
+
+        self._executor = ThreadPoolExecutor(max_workers=max_workers)
+        self._lock = threading.Lock()
+        self._queued = {}
+        self._futures = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+    def submit(self, table_id: str, table: str, df: pd.DataFrame, on_loaded=None) -> None:
+        """
+        Queue a dataframe for upload.
+
+        :param table_id: BigQuery table ID
+        :param table: local table name used to pick the schema, one of `storage.SCHEMAS`
+        :param df: rows to upload
+        :param on_loaded: (optional) function called without arguments once the
+        load job containing `df` has succeeded
+        """
+        if df is None or len(df) == 0:
+            if on_loaded is not None:
+                on_loaded()
+            return
+        with self._lock:
+            queued = self._queued.setdefault((table_id, table), [])
+            queued.append((df, on_loaded))
+            if sum(len(d) for d, _ in queued) >= self.batch_rows:
+                self._dispatch(table_id, table)
+
+    def flush(self) -> None:
+        """
+        Start load jobs for everything that is queued.
+        """
+        with self._lock:
+            for table_id, table in list(self._queued):
+                self._dispatch(table_id, table)
+
+    def close(self) -> None:
+        """
+        Flush the queue and wait for every load job. Raises the first upload
+        error, if any.
+        """
+        self.flush()
+        self._executor.shutdown(wait=True)
+        for future in self._futures:
+            future.result()
+
+    def _dispatch(self, table_id: str, table: str) -> None:
+        queued = self._queued.pop((table_id, table), [])
+        if len(queued) > 0:
+            self._futures.append(self._executor.submit(self._load, table_id, table, queued))
+
+    def _load(self, table_id: str, table: str, queued: list) -> None:
+        from google.cloud import bigquery
+        from google.cloud.exceptions import BadRequest
+
+        df = pd.concat([d for d, _ in queued], ignore_index=True)
+        buf = io.BytesIO()
+        pq.write_table(to_arrow_table(df, SCHEMAS[table]), buf, compression="zstd")
+        num_bytes = buf.tell()
+
+        parquet_options = bigquery.ParquetOptions()
+        parquet_options.enable_list_inference = True
+        job_config = bigquery.LoadJobConfig(
+            source_format=bigquery.SourceFormat.PARQUET,
+            parquet_options=parquet_options,
+        )
+
+        start = time.time()
+        for attempt in range(1, self.max_retries + 1):
+            buf.seek(0)
+            job = self.client.load_table_from_file(buf, table_id, job_config=job_config)
+            try:
+                job.result()
+                break
+            except BadRequest as exc:
+                raise get_improved_bad_request_exception(job) from exc
+            except Exception as e:
+                if attempt == self.max_retries:
+                    raise
+                delay = self.backoff * 2 ** (attempt - 1)
+                print("Load to {} failed ({}), retrying in {:.1f}s".format(table_id, e, delay))
+                time.sleep(delay)
+
+        elapsed = time.time() - start
+        self.stats.append({
+            "table_id": table_id,
+            "rows": len(df),
+            "bytes": num_bytes,
+            "seconds": elapsed,
+            "attempts": attempt,
+        })
+        metrics.record("bq_load", {"table_id": table_id}, rows=len(df), bytes=num_bytes,
+                       seconds=elapsed, attempts=attempt)
+        print(
+            "Loaded {} rows ({} bytes) to {} in {:.1f}s".format(
+                len(df), num_bytes, table_id, elapsed
+            )
+        )
+        for _, on_loaded in queued:
+            if on_loaded is not None:
+                on_loaded()
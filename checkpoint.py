@@ -0,0 +1,195 @@
+'''
+Copyright 2023 The Board of Trustees of The Leland Stanford Junior University
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+'''
+
+"""
+Checkpoints for resumable runs.
+
+A run directory holds a `manifest.json` listing the completed stages, the
+Parquet output of the exposed services and traceroute stages, and one
+directory of ping chunks per ping worker:
+
+    <run_dir>/manifest.json
+    <run_dir>/exposed_services.parquet
+    <run_dir>/traceroute.parquet
+    <run_dir>/pings/worker-<i>-of-<n>/rounds-<first>-<last>.parquet
+
+Every file is written to a temporary name and renamed into place, so a
+crash never leaves a partial checkpoint behind. Once the pings of a hop
+type in a chunk are loaded into BigQuery, a `.<hop_type>.committed` marker
+is written next to the chunk.
+"""
+
+import glob
+import json
+import os
+import time
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+from data_parse import COMPACT_PING_DTYPES
+from storage import EXPOSED_SERVICES_SCHEMA, to_arrow_table
+
+STAGES = ("exposed_services", "traceroute", "pings")
+
+# schema of the frame each stage outputs; the exposed services have not been
+# traced yet, so their frame has no traceroute columns for the traceroute
+# stage's merge to collide with. Incremental runs add the date each host was
+# last reported by Censys, which their snapshot keeps (see `snapshot`).
+STAGE_SCHEMAS = {
+    "exposed_services": pa.schema([field for field in EXPOSED_SERVICES_SCHEMA
+                                   if field.name in ("ip", "date", "asn", "dns_name", "port", "pep_link")]
+                                  + [pa.field("last_seen", pa.date32())]),
+    "traceroute": EXPOSED_SERVICES_SCHEMA,
+}
+
+
+def _replace(path: str, write) -> None:
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    write(path + ".tmp")
+    os.replace(path + ".tmp", path)
+
+
+class RunManifest:
+
+    def __init__(self, run_dir: str) -> None:
+        """
+        :param run_dir: directory of the run, created if it does not exist
+        """
+        self.run_dir = run_dir
+        os.makedirs(run_dir, exist_ok=True)
+        self.manifest_path = os.path.join(run_dir, "manifest.json")
+        self.stages = {}
+        if os.path.exists(self.manifest_path):
+            with open(self.manifest_path) as f:
+                self.stages = json.load(f).get("stages", {})
+
+    def path(self, name: str) -> str:
+        return os.path.join(self.run_dir, name)
+
+    def done(self, stage: str) -> bool:
+        return stage in self.stages
+
+    def complete(self, stage: str, **info) -> None:
+        """
+        Record a stage as completed, with optional details (e.g. row counts).
+        """
+        if stage not in STAGES:
+            raise Exception("Unknown run stage: " + str(stage))
+        self.stages[stage] = dict(info, completed=time.time())
+
+        def write(tmp):
+            with open(tmp, "w") as f:
+                json.dump({"stages": self.stages}, f, indent=2)
+        _replace(self.manifest_path, write)
+
+    def save_frame(self, stage: str, df: pd.DataFrame) -> None:
+        """
+        Persist the output of the exposed services or traceroute stage.
+        """
+        table = to_arrow_table(df, STAGE_SCHEMAS[stage])
+        _replace(self.path(stage + ".parquet"), lambda tmp: pq.write_table(table, tmp, compression="zstd"))
+
+    def load_frame(self, stage: str) -> pd.DataFrame:
+        """
+        :return: the output of the exposed services or traceroute stage, with
+        the columns of its `STAGE_SCHEMAS` schema (`last_seen` only if the run
+        is incremental)
+        """
+        df = pq.read_table(self.path(stage + ".parquet"), schema=STAGE_SCHEMAS[stage]).to_pandas()
+        if 'last_seen' in df.columns:
+            if df['last_seen'].isna().all():
+                df = df.drop(columns=['last_seen'])
+            else:
+                df['last_seen'] = df['last_seen'].astype(str)
+        df['date'] = df['date'].astype(str)
+        for col in ['dns_name', 'port', 'pep_link']:
+            df[col] = df[col].apply(list)
+        return df
+
+
+class PingCheckpoint:
+    """
+    Ping chunks of one ping worker. A chunk holds the pings of a batch of
+    rounds for every hop type (in a `hop_type` column) in the compact ping
+    dtypes, so a batch is either fully checkpointed or not at all.
+    """
+
+    def __init__(self, checkpoint_dir: str) -> None:
+        self.checkpoint_dir = checkpoint_dir
+        os.makedirs(checkpoint_dir, exist_ok=True)
+
+    def save(self, seqs: list, dfs: dict) -> str:
+        """
+        Persist the pings of a batch of rounds.
+
+        :param seqs: rounds in the batch
+        :param dfs: ping dataframe of the batch for each hop type
+        :return: path of the chunk
+        """
+        name = "rounds-{}-{}".format(min(seqs), max(seqs))
+        path = os.path.join(self.checkpoint_dir, name + ".parquet")
+        # the late replies collected at the end of a run can cover rounds
+        # that already have a chunk, so never overwrite one
+        suffix = 1
+        while os.path.exists(path):
+            path = os.path.join(self.checkpoint_dir, "{}-{}.parquet".format(name, suffix))
+            suffix += 1
+        df = pd.concat([d.assign(hop_type=hop_type) for hop_type, d in dfs.items()], ignore_index=True)
+        _replace(path, lambda tmp: df.to_parquet(tmp, index=False, compression="zstd"))
+        return path
+
+    def chunks(self) -> list:
+        """
+        :return: paths of every chunk, oldest rounds first
+        """
+        paths = glob.glob(os.path.join(self.checkpoint_dir, "rounds-*.parquet"))
+        return sorted(paths, key=lambda p: (self.rounds(p), p))
+
+    def load(self, path: str) -> dict:
+        """
+        :return: ping dataframe of the chunk for each hop type
+        """
+        df = pd.read_parquet(path)
+        return {
+            hop_type: d.drop(columns=['hop_type']).reset_index(drop=True).astype(COMPACT_PING_DTYPES)
+            for hop_type, d in df.groupby('hop_type', observed=True)
+        }
+
+    @staticmethod
+    def rounds(path: str) -> tuple:
+        """
+        :return: (first, last) round stored in a chunk
+        """
+        first, last = os.path.basename(path)[:-len(".parquet")].split("-")[1:3]
+        return int(first), int(last)
+
+    def last_round(self) -> int:
+        """
+        :return: the last round that has been checkpointed (0 if none)
+        """
+        return max([self.rounds(p)[1] for p in self.chunks()], default=0)
+
+    def committed(self, path: str, hop_type: str) -> bool:
+        return os.path.exists(path + "." + hop_type + ".committed")
+
+    def mark_committed(self, path: str, hop_type: str) -> None:
+        open(path + "." + hop_type + ".committed", "w").close()
+
+    def done(self) -> bool:
+        return os.path.exists(os.path.join(self.checkpoint_dir, "done"))
+
+    def mark_done(self) -> None:
+        open(os.path.join(self.checkpoint_dir, "done"), "w").close()
@@ -15,22 +15,70 @@ limitations under the License.
 '''
 
 import ast
+import glob
+import metrics
 import os
 import pandas as pd
-import tempfile
+import queue
+import threading
 from datetime import date
+from typing import Iterator
 from data_parse import get_last_hops_from_paris_tr
-from multiprocessing import Process
-from scamper import *
-from search_censys import *
-from bq_upload import *
-from google.cloud import bigquery
-from google.auth import default
+from multiprocessing import Process, Queue
+from queue import Empty, Full
+from scamper import plan_ttl_probes, save_rtt_summary, trace_last_hops, ttl_ping
+from search_censys import iter_censys_bq, iter_censys_hosts, search_censys
+from bq_upload import BigQueryUploader
+from storage import write_parquet
+from path_cache import PathCache
+from checkpoint import RunManifest
+from snapshot import SnapshotStore, LAST_HOP_COLUMNS, due_for_retrace, merge_delta
+from targets import reduce_targets
+
+# stages of `DataCollection.run_checkpointed`, in the order they run
+RUN_STAGES = ("exposed_services", "traceroute", "pings")
+
+
+def ping_worker(batches, stats_queue, output_destinations: dict, ping_len: int, ping_interval: int, upload_to_bq: bool, bq_table_ids: dict, pps: int, output_format: str, asn: int, path_cache, scamper_format: str) -> None:
+    """
+    Long-lived ping worker of `DataCollection.run_pipelined`. Runs a single
+    ping schedule (see `ttl_ping`) from its first batch on and feeds every
+    probe list handed over on `batches` into it as it arrives, until it
+    receives None; then puts the RTT aggregator of the run (None if it got
+    no batch) on `stats_queue`.
+    """
+    aggregator = None
+    collected = queue.Queue()
+    exhausted = []
+
+    def feed():
+        if len(exhausted) > 0:
+            return None
+        arrived = []
+        while True:
+            try:
+                probes = batches.get_nowait()
+            except Empty:
+                return arrived
+            if probes is None:
+                exhausted.append(True)
+                return arrived
+            arrived.append(probes)
+
+    try:
+        probes = batches.get()
+        if probes is not None:
+            ttl_ping(probes, output_destinations, ping_len, ping_interval,
+                     upload_to_bq, bq_table_ids, pps, 0, output_format, asn, path_cache,
+                     collected, None, scamper_format, feed)
+            aggregator = collected.get()
+    finally:
+        stats_queue.put(aggregator)
 
 
 class DataCollection:
 
-    def __init__(self, data_dir: str = None, bq_dataset_id: str = None) -> None:
+    def __init__(self, data_dir: str = None, bq_dataset_id: str = None, output_format: str = "csv", path_cache_max_age: float = None, path_cache_granularity: str = "ip", metrics_file: str = None, scamper_format: str = "json") -> None:
         """
         Specifies the directory to store measurement data in. If one is not
         specified, the current directory is used.
@@ -39,7 +87,25 @@ class DataCollection:
 
         :param data_dir: directory path
         :param bq_dataset_id: Big Query dataset ID
+        :param output_format: (optional) "csv" for the CSV/JSON files or "parquet"
+        for the typed columnar store under `<data_dir>/parquet`
+        :param path_cache_max_age: (optional) enables the traceroute path cache
+        under `<data_dir>/path_cache.sqlite`; seconds a cached path stays fresh
+        :param path_cache_granularity: (optional) "ip" or "prefix" (/24 or /64) cache keys
+        :param metrics_file: (optional) append stage timings, throughput and
+        resource usage as JSON lines to this file (see `metrics`)
+        :param scamper_format: (optional) "json" or "warts", the format scamper
+        reports traceroutes and pings in; warts is smaller and faster to parse
         """ 
+        if output_format not in ("csv", "parquet"):
+            raise Exception("Unsupported output format: " + str(output_format))
+        if scamper_format not in ("json", "warts"):
+            raise Exception("Unsupported scamper output format: " + str(scamper_format))
+        self.output_format = output_format
+        self.scamper_format = scamper_format
+        if metrics_file is not None:
+            metrics.configure(metrics_file)
+
         if data_dir is None:
             data_dir = "."
         if os.path.exists(data_dir):
@@ -48,21 +114,31 @@ class DataCollection:
         else:
             raise Exception("Directory path provided does not exist.")
 
+        self.path_cache = None
+        if path_cache_max_age is not None:
+            self.path_cache = PathCache(
+                os.path.join(self.data_dir, "path_cache.sqlite"),
+                path_cache_max_age,
+                path_cache_granularity
+            )
+
         if bq_dataset_id is None:
             self.bq_exposed_services_table_id = None
             self.bq_sec_last_ping_table_id = None
             self.bq_last_ping_table_id = None
+            self.bq_rtt_summary_table_id = None
         else:
             self.bq_exposed_services_table_id = bq_dataset_id + ".exposed_services"
             self.bq_sec_last_ping_table_id = bq_dataset_id + ".sec_last_pings"
             self.bq_last_ping_table_id = bq_dataset_id + ".endpoint_pings"
+            self.bq_rtt_summary_table_id = bq_dataset_id + ".rtt_summary"
             
 
     def create_data_dirs(self) -> None:
         """
         Creates directories to store measurement data in the specified directory.
         `exposed_services` stores information about the exposed ips ports 
-        `pings` stores ping tests
+        `pings` stores ping tests and their RTT summaries
         """ 
         exposed_services_path = os.path.join(self.data_dir, "exposed_services")
         if not os.path.exists(exposed_services_path):
@@ -78,19 +154,42 @@ class DataCollection:
         pings_last_path = os.path.join(pings_path, "last")
         if not os.path.exists(pings_last_path):
             os.makedirs(pings_last_path)
+        pings_summary_path = os.path.join(pings_path, "rtt_summary")
+        if not os.path.exists(pings_summary_path):
+            os.makedirs(pings_summary_path)
         self.pings_dir = {
             "sec_last_hop": pings_sec_last_path,
-            "last_hop": pings_last_path
+            "last_hop": pings_last_path,
+            "rtt_summary": pings_summary_path
         }
 
+        self.parquet_dir = os.path.join(self.data_dir, "parquet")
+        self.snapshots = SnapshotStore(os.path.join(self.data_dir, "snapshots"))
+
         
-    def get_censys_exposed_services(self, asn: int, ipv: int = None, bq: str = None) -> pd.DataFrame:
+    def get_censys_exposed_services(self, asn: int, ipv: int = None, bq: str = None, prefixes: list = None, incremental: bool = False, max_age_days: int = 7, full_refresh_days: int = None) -> pd.DataFrame:
         """
         Queries Censys for exposed services and returns the result as a dataframe.
 
+        In incremental mode the Censys API is only asked for hosts updated
+        since the latest local snapshot of the ASN; the remaining hosts are
+        carried over from that snapshot. Hosts that do not change never show
+        up in that delta, so every `full_refresh_days` the ASN is queried in
+        full instead, which renews the `last_seen` of every host still
+        reported before it expires. (The BigQuery dataset is always read in
+        full since its query cost does not depend on the rows returned, and
+        merged with the snapshot like a full query.)
+
         :param asn: the autonomous system number to query
         :param ipv: (optional) specify 4 or 6 to filter for IP version
         :param bq: (optional) the BigQuery table to pull data from
+        :param prefixes: (optional) IP prefixes to split the Censys API search
+        into parallel queries
+        :param incremental: (optional) only fetch the delta since the latest snapshot
+        :param max_age_days: (optional) in incremental mode, drop carried-over hosts
+        Censys has not reported for this many days
+        :param full_refresh_days: (optional) in incremental mode, days between full
+        queries (default is half of `max_age_days`)
         :return: dataframe of exposed services information
         """
         def stringified_list_to_list(x):
@@ -116,36 +215,21 @@ class DataCollection:
 
         df = pd.DataFrame()
         exposed_services = {}
+        today = str(date.today())
         try:
             exposed_services = pd.DataFrame()
             if bq:
-                client = bigquery.Client()
-                ip_col = 'host_identifier.ipv6' if ipv == 6 else 'host_identifier.ipv4'
-                QUERY = (
-                    'SELECT DISTINCT '
-                    '    {ip_col} as ip, '
-                    '    CURRENT_DATE() as date, '
-                    '    {asn} as asn, '
-                    '    dns.reverse_dns.names as dns_name, '
-                    '    ports_list as port, '
-                    '    ARRAY( '
-                    '     SELECT '
-                    '      CASE '
-                    '        WHEN LOWER(service.tls.certificates.leaf_data.subject_dn) LIKE "%peplink%" '
-                    '        THEN TRUE '
-                    '        ELSE FALSE '
-                    '      END '
-                    '     FROM UNNEST(services) AS service '
-                    '   ) AS pep_link '
-                    'FROM `{table}` '
-                    'WHERE '
-                    '    autonomous_system.asn={asn} AND '
-                    '    TIMESTAMP_TRUNC(snapshot_date, DAY) = TIMESTAMP(DATE_SUB(CURRENT_DATE, INTERVAL 2 DAY)) '  # we can only guarantee that censys's data from yesterday is available , reverse dns names take another day to populate in dataset
-                    '    AND host_identifier.ipv4 IS NOT NULL '
-                ).format(ip_col=ip_col, asn=asn, table=bq)
-                query_job = client.query(QUERY)  # API request
-                query_job.result()  # Waits for query to finish
-                bq_df = query_job.to_dataframe()
+                # only the columns of each page are kept and each column is
+                # released as soon as it is joined
+                pieces = {}
+                for page in iter_censys_bq(asn, ipv, bq):
+                    for col in page.columns:
+                        pieces.setdefault(col, []).append(page[col])
+                bq_df = pd.DataFrame({col: pd.concat(pieces.pop(col), ignore_index=True) for col in list(pieces)}, copy=False)
+                if incremental and len(bq_df) > 0:
+                    _, previous = self.snapshots.latest(asn, before=today)
+                    bq_df = merge_delta(previous, bq_df, today, max_age_days)
+                    self.snapshots.mark_full(asn, today)
 
                 # cleaning
                 # bq_df['dns_name'] = bq_df['dns_name'].apply(stringified_list_to_list)
@@ -154,8 +238,18 @@ class DataCollection:
 
                 return bq_df
             else: 
-                exposed_services = search_censys(asn, ipv)
+                since, previous = None, None
+                if incremental:
+                    since, previous = self.snapshots.latest(asn, before=today)
+                    if full_refresh_days is None:
+                        full_refresh_days = max(max_age_days // 2, 1)
+                    last_full = self.snapshots.last_full(asn, before=today)
+                    if last_full is None or (date.fromisoformat(today) - date.fromisoformat(last_full)).days >= full_refresh_days:
+                        since = None
+                exposed_services = search_censys(asn, ipv, prefixes, since=since)
                 df = pd.DataFrame.from_dict(exposed_services)
+                if incremental and since is None:
+                    self.snapshots.mark_full(asn, today)
         except Exception as e:
             print(f"An error occurred: {e}")
             return df
@@ -163,127 +257,560 @@ class DataCollection:
         df = df.groupby(['ip', 'date', 'asn', 'dns_name']).agg(list).reset_index()
         df['dns_name'] = df['dns_name'].apply(stringified_list_to_list)
         df['pep_link'] = df['pep_link'].apply(list_of_nulls_to_empty_list)
+        if incremental:
+            df = merge_delta(previous, df, today, max_age_days)
         return df
 
-    def paris_traceroute_exposed_services(self, df: pd.DataFrame, ip_col: str, upload_to_bq: bool = True) -> pd.DataFrame:
+    def iter_censys_exposed_services(self, asn: int, ipv: int = None, bq: str = None, page_size: int = 50000, prefixes: list = None) -> Iterator[pd.DataFrame]:
+        """
+        Streams the exposed services from Censys in chunks of at most
+        `page_size` hosts, so memory use does not grow with the number of
+        hosts in the ASN. `run_pipelined` traces and pings the chunks as
+        they arrive.
+
+        :param asn: the autonomous system number to query
+        :param ipv: (optional) specify 4 or 6 to filter for IP version
+        :param bq: (optional) the BigQuery table to pull data from (default is the Censys API)
+        :param page_size: (optional) number of hosts per chunk
+        :param prefixes: (optional) IP prefixes to split the Censys API search
+        into parallel queries
+        :return: generator of exposed services dataframes
+        """
+        if bq:
+            yield from iter_censys_bq(asn, ipv, bq, page_size)
+            return
+
+        def to_frame(hosts):
+            return pd.DataFrame({
+                'ip': [host['ip'] for host in hosts],
+                'date': str(date.today()),
+                'asn': asn,
+                'dns_name': [host['dns_name'] for host in hosts],
+                'port': [host['ports'] for host in hosts],
+                'pep_link': [[] for _ in hosts],
+            })
+
+        hosts = []
+        for host in iter_censys_hosts(asn, ipv, prefixes):
+            hosts.append(host)
+            if len(hosts) >= page_size:
+                yield to_frame(hosts)
+                hosts = []
+        if len(hosts) > 0:
+            yield to_frame(hosts)
+
+    def paris_traceroute_exposed_services(self, df: pd.DataFrame, ip_col: str, upload_to_bq: bool = True, incremental: bool = False, rotation_days: int = 7, shards: int = 1, pps: int = None, append_output: bool = False) -> pd.DataFrame:
         """
         Queries Censys for exposed services then runs an icmp paris-traceroute
         to each exposed IP address and stores data in `exposed_services`.
 
+        In incremental mode only IPs missing from the latest snapshot of the
+        ASN are traced, plus the share of known IPs whose turn it is in the
+        `rotation_days` cycle; the other IPs reuse their snapshot results. The
+        combined result is saved as today's snapshot.
+
+        When the path cache is enabled, IPs with a fresh cached path are not
+        traced either, and completed traceroutes are added to the cache.
+
         :param df: a dataframe containing at least one column that contains IP addresses to traceroute
         :param ip_col: the name of the column that contains the IP addresses to traceroute
         :param upload_to_bq: (optional) upload data to big query (default saves the output to file)
+        :param incremental: (optional) reuse traceroute results from the latest snapshot
+        :param rotation_days: (optional) number of days over which every known IP is re-traced once
+        :param shards: (optional) number of parallel scamper workers to split the IPs across
+        :param pps: (optional) global packets-per-second limit shared by the workers
+        :param append_output: (optional) append to today's output file instead of overwriting it
         :return: dataframe of traceroute results
         """
 
-        output_file = os.path.join(self.exposed_services_dir, str(date.today()) + ".json")
+        started = metrics.start_stage()
+        today = str(date.today())
+        output_file = os.path.join(self.exposed_services_dir, today + ".json")
+        asn = int(df['asn'].iloc[0]) if len(df) > 0 else None
 
         # run paris-traceroutes for each unique IP and extract the 
         # second-to-last hop and last hop
 
         fallback_file = False
-        with tempfile.NamedTemporaryFile(mode='w+') as temp_ip:
-            # Uncomment the following block if using a fallback file incase Censys queries
-            # fail. 
-            # If the provided dataframe does not contain data, use a fallback file
-
-            # if df.empty:
-            #     print("(paris_traceroute_exposed_services) using fallback file")
-            #     df = pd.read_json(
-            #         'MYFALLBACKFILE.json' # TODO: edit to fallback file path
-            #         lines=True
-            #     )
-            #     df = df[['ip', 'date', 'asn', 'dns_name', 'port', 'pep_link']]
-            #     fallback_file = True
-                
-            unique_ips = df[ip_col].unique()
-            unique_ips_df = pd.DataFrame(unique_ips, columns=[ip_col])
-            unique_ips_df.to_csv(temp_ip.name, header=False, index=False) 
-
-            with tempfile.NamedTemporaryFile(mode='w+') as temp_tr:
-
-                run_paris_trs(temp_ip.name, temp_tr.name)
-                last_hops = get_last_hops_from_paris_tr(temp_tr.name)
-                df = df.merge(
-                    last_hops, 
-                    how="left", 
-                    left_on=ip_col, 
-                    right_on='dst'
-                )
-                df = df.drop(columns=['dst'])
-                # drop rows where either 'sec_last_ip' or 'sec_last_hop' is None
-                df = df.dropna(subset=['sec_last_ip', 'sec_last_hop'])
-        
-        # output to json file
+        # Uncomment the following block if using a fallback file incase Censys queries
+        # fail. 
+        # If the provided dataframe does not contain data, use a fallback file
+
+        # if df.empty:
+        #     print("(paris_traceroute_exposed_services) using fallback file")
+        #     df = pd.read_json(
+        #         'MYFALLBACKFILE.json' # TODO: edit to fallback file path
+        #         lines=True
+        #     )
+        #     df = df[['ip', 'date', 'asn', 'dns_name', 'port', 'pep_link']]
+        #     fallback_file = True
+            
+        unique_ips = pd.Series(df[ip_col].unique())
+        reused = None
+        if incremental and asn is not None:
+            _, previous = self.snapshots.latest(asn)
+            if previous is not None:
+                known = previous[previous['last_traced'].notna()].drop_duplicates('ip').set_index('ip')
+                to_trace = ~unique_ips.isin(known.index) | due_for_retrace(unique_ips, today, rotation_days)
+                reused = known.loc[unique_ips[~to_trace], LAST_HOP_COLUMNS + ['last_traced']]
+                reused = reused.rename_axis('dst').reset_index()
+                unique_ips = unique_ips[to_trace]
+                print("tracing {} IPs, reusing {} from snapshot".format(len(unique_ips), len(reused)))
+
+        cached = None
+        if self.path_cache is not None:
+            self.path_cache.evict_expired()
+            cached = self.path_cache.lookup(unique_ips)
+            unique_ips = unique_ips[~unique_ips.isin(cached['dst'])]
+            print("tracing {} IPs, {} paths cached".format(len(unique_ips), len(cached)))
+
+        targets = {
+            "traced": len(unique_ips),
+            "cached": len(cached) if cached is not None else 0,
+            "reused": len(reused) if reused is not None else 0,
+        }
+
+        # scamper reads the IPs from a pipe and its traces are parsed as they
+        # arrive, so nothing goes through a temporary file
+        if len(unique_ips) > 0:
+            last_hops = trace_last_hops(unique_ips, shards, pps, scamper_format=self.scamper_format)
+        else:
+            last_hops = get_last_hops_from_paris_tr([])
+        if self.path_cache is not None:
+            self.path_cache.update(last_hops)
+        if incremental:
+            last_hops['last_traced'] = today
+        frames = [d for d in (last_hops, reused, cached) if d is not None and len(d) > 0]
+        if len(frames) > 0:
+            last_hops = pd.concat(frames, ignore_index=True)
+        df = df.merge(
+            last_hops, 
+            how="left", 
+            left_on=ip_col, 
+            right_on='dst'
+        )
+        df = df.drop(columns=['dst'])
+        if incremental and asn is not None:
+            if 'last_seen' not in df.columns:
+                df['last_seen'] = today
+            self.snapshots.save(asn, today, df)
+            df = df.drop(columns=['last_seen', 'last_traced'])
+        # drop rows where either 'sec_last_ip' or 'sec_last_hop' is None
+        df = df.dropna(subset=['sec_last_ip', 'sec_last_hop'])
+
+        # output to bigquery, parquet or json file
         if upload_to_bq and not fallback_file:
-            with tempfile.NamedTemporaryFile(mode='w+', suffix=".json") as temp_json:
-                df['date'] = df['date'].astype(str)
-                df.to_json(temp_json.name, orient="records", lines=True)
-                temp_json.seek(0)
-                upload_exposed_services_file(self.bq_exposed_services_table_id, temp_json.name)
+            with BigQueryUploader() as uploader:
+                uploader.submit(self.bq_exposed_services_table_id, "exposed_services", df)
+        elif self.output_format == "parquet" and not fallback_file:
+            write_parquet(df, self.parquet_dir, "exposed_services", today, asn)
         elif not fallback_file:
-            df.to_json(output_file, orient="records", lines=True)
+            df.to_json(output_file, orient="records", lines=True, mode="a" if append_output else "w")
 
+        metrics.finish_stage("traceroute", started, {"asn": asn}, rows=len(df), **targets)
         return df
 
 
-    def ping_exposed_services(self, df: pd.DataFrame, ping_len: int = 5, ping_interval: int = 1, upload_to_bq: bool = False) -> None:
+    def ping_exposed_services(self, df: pd.DataFrame, ping_len: int = 5, ping_interval: int = 1, upload_to_bq: bool = False, max_concurrency: int = None, max_pps: int = None, checkpoint_dir: str = None, per_group: int = None, rotate: str = "day") -> None:
         """
         Pings the exposed services and collects measurements for the RTTs of 
         the last hop and the second-to-last hop found in the paris-traceroute. 
         Only collects measurements for exposed services with a completed 
         traceroute.
 
+        Every destination is probed at its own TTLs from a single probe list,
+        with the second-to-last and last hop of a destination probed together
+        so paired RTT samples line up in time. The probe list can be split
+        evenly across several workers; their rounds are staggered across the
+        ping interval so the probes are spread out rather than sent in bursts.
+
+        Per-destination and per-second-to-last-hop RTT statistics (loss, min,
+        mean, p50, p95, max) are aggregated while the pings are collected and
+        written to the `rtt_summary` table next to the raw pings.
+
         :param df: dataframe constructed from `paris_traceroute_exposed_services`
         :param ping_len: (optional) specify the number of probes to send
         :param ping_interval: (optional) specify the number of seconds between probes
         :param upload_to_bq: (optional) upload data to bigquery (default saves output to file)
+        :param max_concurrency: (optional) number of ping workers to split the
+        probe list across (default is a single worker)
+        :param max_pps: (optional) global packets-per-second budget shared by the
+        workers; at most `max_pps` workers are started so none exceeds it
+        :param checkpoint_dir: (optional) directory to checkpoint the ping rounds in;
+        a rerun with the same directory resumes the workers where they stopped
+        :param per_group: (optional) only probe this many destinations per
+        group of destinations sharing a second-to-last hop, hop count and
+        prefix (see `targets.reduce_targets`; default probes every destination)
+        :param rotate: (optional) rotate the probed destinations of a group
+        every "day" or every "round"
         """
 
         # only ping the reachable endpoints
         df = df[df['stop_reason'] == 'COMPLETED']
-        df = df.groupby(['hop_count', 'sec_last_hop'])['ip'].agg(list).reset_index()
-
-        sec_last_hop_output = os.path.join(self.pings_dir['sec_last_hop'], str(date.today()) + ".csv" )
-        last_hop_output = os.path.join(self.pings_dir['last_hop'], str(date.today()) + ".csv")
-        
-        # create temporary file structure
-        temp_ip_files = {}
-
-        for i in df.index:
-            temp_ip_files[i] = tempfile.NamedTemporaryFile(mode='w+', suffix='.txt')
-
-        for i in df.index:
-            ips = df.iloc[i]['ip']
-            sec_last_ttl = int(df.iloc[i]['sec_last_hop'])
-            last_ttl = int(df.iloc[i]['hop_count'])
-
-            ip_df = pd.DataFrame({'ip': ips})
-
-            temp_ip_files[i].flush()
-            ip_df.to_csv(temp_ip_files[i].name, header=False, index=False) 
-            temp_ip_files[i].seek(0)
-
-
-            p1 = Process(target = ttl_ping,
-                        args = (True, temp_ip_files[i].name, 
-                                sec_last_hop_output, sec_last_ttl, 
-                                ping_len, ping_interval, 
-                                upload_to_bq, self.bq_sec_last_ping_table_id))
-            p1.start()
-
-            temp_ip_files[i].seek(0)
+        asn = int(df['asn'].iloc[0]) if 'asn' in df.columns and len(df) > 0 else None
+        probes = plan_ttl_probes(df)
+        if per_group is not None:
+            probes = reduce_targets(probes, per_group, rotate)
+        if len(probes) == 0:
+            return
+
+        output_destinations, bq_table_ids = self._ping_outputs()
+
+        # split the probe list round-robin so every worker gets the same
+        # number of destinations; each worker gets an equal share of the
+        # probe budget and a fixed phase within the ping interval
+        num_workers = 1 if max_concurrency is None else max(1, min(max_concurrency, len(probes)))
+        if max_pps is not None:
+            # every worker needs at least 1 pps of the budget
+            num_workers = max(1, min(num_workers, max_pps))
+        if checkpoint_dir is not None:
+            # resumed workers must get the same share of the probe list
+            previous = glob.glob(os.path.join(checkpoint_dir, "worker-*-of-*"))
+            if len(previous) > 0:
+                num_workers = int(previous[0].rsplit("-", 1)[1])
+        worker_pps = None
+        if max_pps is not None:
+            if max_pps < num_workers:
+                raise Exception("Cannot split a budget of {} pps between {} ping workers".format(max_pps, num_workers))
+            worker_pps = max_pps // num_workers
+
+        # the workers hand their RTT aggregators back so the per-PoP
+        # statistics of destinations split across workers are merged
+        stats_queue = Queue()
+        processes = []
+        for i in range(num_workers):
+            offset = i * ping_interval / num_workers
+            worker_checkpoint_dir = None
+            if checkpoint_dir is not None:
+                worker_checkpoint_dir = os.path.join(checkpoint_dir, "worker-{}-of-{}".format(i, num_workers))
+            p = Process(target = ttl_ping,
+                        args = (probes.iloc[i::num_workers], output_destinations,
+                                ping_len, ping_interval,
+                                upload_to_bq, bq_table_ids,
+                                worker_pps, offset, self.output_format, asn, self.path_cache,
+                                stats_queue, worker_checkpoint_dir, self.scamper_format))
+            p.start()
+            processes.append(p)
+
+        aggregators = []
+        while len(aggregators) < num_workers:
+            try:
+                aggregators.append(stats_queue.get(timeout=5))
+            except Empty:
+                if not any(p.is_alive() for p in processes):
+                    break
+
+        for p in processes:
+            p.join()
+        # a failed worker leaves its share of the rounds unpinged; the stage
+        # must not look finished, so a rerun resumes it from its checkpoint
+        failed = [(i, p.exitcode) for i, p in enumerate(processes) if p.exitcode != 0]
+        if len(failed) > 0:
+            raise Exception("Ping workers of AS{} failed (worker, exit code): {}".format(asn, failed))
+
+        self._save_rtt_summary(aggregators, asn, upload_to_bq)
+
+    def _ping_outputs(self) -> tuple:
+        """
+        :return: the ping output destinations and BigQuery table IDs for
+        `ttl_ping`, keyed by hop type and "rtt_summary"
+        """
+        if self.output_format == "parquet":
+            output_destinations = {"sec_last": self.parquet_dir, "last": self.parquet_dir, "rtt_summary": self.parquet_dir}
+        else:
+            output_destinations = {
+                "sec_last": os.path.join(self.pings_dir['sec_last_hop'], str(date.today()) + ".csv" ),
+                "last": os.path.join(self.pings_dir['last_hop'], str(date.today()) + ".csv"),
+                "rtt_summary": os.path.join(self.pings_dir['rtt_summary'], str(date.today()) + ".csv")
+            }
+        bq_table_ids = {
+            "sec_last": self.bq_sec_last_ping_table_id,
+            "last": self.bq_last_ping_table_id,
+            "rtt_summary": self.bq_rtt_summary_table_id
+        }
+        return output_destinations, bq_table_ids
 
-            p2 = Process(target = ttl_ping,
-                        args = (False, temp_ip_files[i].name, 
-                                last_hop_output, last_ttl, 
-                                ping_len, ping_interval, 
-                                upload_to_bq, self.bq_last_ping_table_id))
-            p2.start()
+    def _save_rtt_summary(self, aggregators: list, asn: int, upload_to_bq: bool) -> None:
+        """
+        Merge the RTT aggregators of the ping workers and write the summary.
+        """
+        if len(aggregators) == 0:
+            return
+        output_destinations, bq_table_ids = self._ping_outputs()
+        for other in aggregators[1:]:
+            aggregators[0].merge(other)
+        save_rtt_summary(aggregators[0].summary(str(date.today()), asn),
+                         output_destinations["rtt_summary"], upload_to_bq,
+                         bq_table_ids["rtt_summary"], self.output_format, asn)
+
+    def run_checkpointed(self, asn: int, ipv: int = None, bq: str = None, ping_len: int = 5, ping_interval: int = 1, upload_to_bq: bool = False, run_id: str = None, shards: int = 1, max_concurrency: int = None, max_pps: int = None, per_group: int = None, rotate: str = "day", stages: tuple = None, incremental: bool = False, max_age_days: int = 7, full_refresh_days: int = None, rotation_days: int = 7) -> None:
+        """
+        Runs the Censys query, the paris-traceroutes and the pings of an ASN
+        with stage-level checkpoints under `<data_dir>/runs/<asn>/<run_id>`.
 
-            p1.join()
-            p2.join()
+        The output of each finished stage is persisted and recorded in the
+        run's manifest, and the ping rounds are checkpointed as they are
+        collected. Calling this again with the same run ID (by default, the
+        same day) skips the finished stages, resumes the pings after the last
+        checkpointed round and only re-uploads ping rounds BigQuery has not
+        committed.
 
-        # clean up temporary file structure
-        for i in df.index:
-            temp_ip_files[i].close()
+        :param asn: the autonomous system number to measure
+        :param ipv: (optional) specify 4 or 6 to filter for IP version
+        :param bq: (optional) the BigQuery table to pull Censys data from
+        :param ping_len: (optional) specify the number of probes to send
+        :param ping_interval: (optional) specify the number of seconds between probes
+        :param upload_to_bq: (optional) upload data to bigquery (default saves output to file)
+        :param run_id: (optional) ID of the run to start or resume (default is today's date)
+        :param shards: (optional) number of parallel scamper workers for the traceroutes
+        :param max_concurrency: (optional) number of ping workers
+        :param max_pps: (optional) global packets-per-second budget
+        :param per_group: (optional) destinations pinged per group (see `ping_exposed_services`)
+        :param rotate: (optional) rotate the pinged destinations every "day" or "round"
+        :param stages: (optional) run only these of `RUN_STAGES`; the stages before
+        them must have been checkpointed by an earlier call
+        :param incremental: (optional) discover and trace against the ASN's latest
+        snapshot (see `get_censys_exposed_services` and
+        `paris_traceroute_exposed_services`) and save the run as today's snapshot
+        :param max_age_days: (optional) days a host is kept without Censys reporting it
+        :param full_refresh_days: (optional) days between full Censys queries
+        :param rotation_days: (optional) days over which every known IP is re-traced once
+        """
+        if run_id is None:
+            run_id = str(date.today())
+        if stages is None:
+            stages = RUN_STAGES
+        for stage in stages:
+            if stage not in RUN_STAGES:
+                raise Exception("Unknown run stage: " + str(stage))
+        last_stage = max(RUN_STAGES.index(stage) for stage in stages)
+        manifest = RunManifest(os.path.join(self.data_dir, "runs", str(asn), run_id))
+        for stage in RUN_STAGES[:last_stage]:
+            if stage not in stages and not manifest.done(stage):
+                raise Exception("Stage {} of run {} of AS{} has not run yet".format(stage, run_id, asn))
+
+        with metrics.stage("run_stage", asn=asn, stage="exposed_services") as m:
+            m["resumed"] = manifest.done("exposed_services")
+            if manifest.done("exposed_services"):
+                df = manifest.load_frame("exposed_services")
+            else:
+                df = self.get_censys_exposed_services(asn, ipv, bq, incremental=incremental, max_age_days=max_age_days,
+                                                      full_refresh_days=full_refresh_days)
+                if len(df) == 0:
+                    print("no exposed services found for AS{}, not checkpointing".format(asn))
+                    return
+                manifest.save_frame("exposed_services", df)
+                manifest.complete("exposed_services", rows=len(df))
+            m["rows"] = len(df)
+        if last_stage == 0:
+            return
+
+        with metrics.stage("run_stage", asn=asn, stage="traceroute") as m:
+            m["resumed"] = manifest.done("traceroute")
+            if manifest.done("traceroute"):
+                tr_df = manifest.load_frame("traceroute")
+            else:
+                tr_df = self.paris_traceroute_exposed_services(df, 'ip', upload_to_bq, incremental=incremental,
+                                                               rotation_days=rotation_days, shards=shards, pps=max_pps)
+                manifest.save_frame("traceroute", tr_df)
+                manifest.complete("traceroute", rows=len(tr_df))
+            m["rows"] = len(tr_df)
+        if last_stage == 1:
+            return
+
+        with metrics.stage("run_stage", asn=asn, stage="pings") as m:
+            m["resumed"] = manifest.done("pings")
+            if not manifest.done("pings"):
+                self.ping_exposed_services(tr_df, ping_len, ping_interval, upload_to_bq,
+                                           max_concurrency, max_pps, checkpoint_dir=manifest.path("pings"),
+                                           per_group=per_group, rotate=rotate)
+                manifest.complete("pings")
+
+    def run_pipelined(self, asn: int, ipv: int = None, bq: str = None, prefixes: list = None, ping_len: int = 5, ping_interval: int = 1, upload_to_bq: bool = False, batch_size: int = 1000, queue_size: int = 4, shards: int = 1, max_concurrency: int = 2, max_pps: int = None, per_group: int = None, rotate: str = "day") -> None:
+        """
+        Runs the Censys query, the paris-traceroutes and the pings of an ASN
+        as a pipeline instead of one stage after the other.
+
+        Exposed services are handed to the traceroute stage in batches of
+        `batch_size` hosts as the Censys pages arrive, and every traced batch
+        is handed to the next free one of `max_concurrency` ping worker
+        processes, which are started once for the whole run. The stages are
+        connected by queues of at most `queue_size` batches, so a slow stage
+        holds back the ones feeding it instead of letting batches pile up in
+        memory. A run takes about as long as its slowest stage rather than the
+        sum of all stages.
+
+        Each destination is pinged `ping_len` times from the moment its
+        batch reaches the ping stage: a worker feeds the batches it takes into
+        its running ping schedule, so batches arriving one after the other
+        are pinged side by side rather than `ping_len` rounds each in turn. The traceroute stage and each of the at
+        most `max_concurrency` ping workers get an equal share of `max_pps`;
+        fewer ping workers run when the budget cannot give each 1 pps.
+
+        :param asn: the autonomous system number to measure
+        :param ipv: (optional) specify 4 or 6 to filter for IP version
+        :param bq: (optional) the BigQuery table to pull Censys data from
+        :param prefixes: (optional) IP prefixes to split the Censys API search by
+        :param ping_len: (optional) specify the number of probes to send
+        :param ping_interval: (optional) specify the number of seconds between probes
+        :param upload_to_bq: (optional) upload data to bigquery (default saves output to file)
+        :param batch_size: (optional) number of hosts per batch
+        :param queue_size: (optional) number of batches buffered between stages
+        :param shards: (optional) number of parallel scamper workers for the traceroutes
+        :param max_concurrency: (optional) number of ping workers running at once
+        :param max_pps: (optional) global packets-per-second budget
+        :param per_group: (optional) destinations pinged per group (see
+        `ping_exposed_services`); groups are formed within a batch
+        :param rotate: (optional) rotate the pinged destinations every "day" or "round"
+        """
+        stage_pps = None
+        if max_pps is not None:
+            # the traceroutes and every ping worker need at least 1 pps each
+            if max_pps < 2:
+                raise Exception("Cannot split a budget of {} pps between the traceroutes and the ping workers".format(max_pps))
+            max_concurrency = min(max_concurrency, max_pps - 1)
+            stage_pps = max_pps // (max_concurrency + 1)
+
+        started = metrics.start_stage()
+        hosts = queue.Queue(maxsize=queue_size)
+        traced = queue.Queue(maxsize=queue_size)
+        errors = []
+        # set when the run ends or fails, so no stage keeps waiting on a
+        # queue whose other end is gone
+        stop = threading.Event()
+
+        def put(q, item) -> bool:
+            while not stop.is_set():
+                try:
+                    q.put(item, timeout=1)
+                    return True
+                except queue.Full:
+                    pass
+            return False
+
+        def get(q):
+            while not stop.is_set():
+                try:
+                    return q.get(timeout=1)
+                except Empty:
+                    pass
+            return None
+
+        def discover():
+            with metrics.stage("pipeline_stage", asn=asn, stage="discover") as m:
+                m["batches"], m["rows"] = 0, 0
+                try:
+                    for chunk in self.iter_censys_exposed_services(asn, ipv, bq, batch_size, prefixes):
+                        m["batches"] += 1
+                        m["rows"] += len(chunk)
+                        if not put(hosts, chunk):
+                            break
+                except Exception as e:
+                    errors.append(e)
+                finally:
+                    put(hosts, None)
+
+        def trace():
+            with metrics.stage("pipeline_stage", asn=asn, stage="trace") as m:
+                m["batches"], m["rows"] = 0, 0
+                try:
+                    first = True
+                    while True:
+                        chunk = get(hosts)
+                        if chunk is None:
+                            break
+                        tr_df = self.paris_traceroute_exposed_services(
+                            chunk, 'ip', upload_to_bq, shards=shards, pps=stage_pps, append_output=not first)
+                        first = False
+                        m["batches"] += 1
+                        m["rows"] += len(tr_df)
+                        if not put(traced, tr_df[tr_df['stop_reason'] == 'COMPLETED']):
+                            break
+                except Exception as e:
+                    errors.append(e)
+                    # unblock discovery so it can finish
+                    while get(hosts) is not None:
+                        pass
+                finally:
+                    put(traced, None)
+
+        output_destinations, bq_table_ids = self._ping_outputs()
+        # every worker takes the waiting batches before each of its rounds;
+        # the queue holds one waiting batch per worker
+        batches = Queue(maxsize=max_concurrency)
+        stats_queue = Queue()
+        workers = [
+            Process(target=ping_worker,
+                    args=(batches, stats_queue, output_destinations, ping_len, ping_interval,
+                          upload_to_bq, bq_table_ids, stage_pps, self.output_format, asn,
+                          self.path_cache, self.scamper_format))
+            for _ in range(max_concurrency)
+        ]
+        # the workers are forked before the stage threads start, so no worker
+        # inherits a lock held by one of them
+        for p in workers:
+            p.start()
+        stages = [threading.Thread(target=discover, name="pipeline-discover"),
+                  threading.Thread(target=trace, name="pipeline-trace")]
+        for t in stages:
+            t.start()
+
+        def hand_over(item) -> None:
+            while True:
+                try:
+                    batches.put(item, timeout=1)
+                    return
+                except Full:
+                    if not any(p.is_alive() for p in workers):
+                        raise Exception("Every ping worker of the pipeline of AS{} has exited".format(asn))
+
+        aggregators = []
+        ping_batches = 0
+        try:
+            while True:
+                tr_df = get(traced)
+                if tr_df is None:
+                    break
+                probes = plan_ttl_probes(tr_df)
+                if per_group is not None:
+                    probes = reduce_targets(probes, per_group, rotate)
+                if len(probes) == 0:
+                    continue
+                hand_over(probes)
+                ping_batches += 1
+                print("pipeline: pinging batch of {} destinations".format(len(probes)))
+
+            for _ in workers:
+                hand_over(None)
+            results = 0
+            while results < len(workers):
+                try:
+                    aggregator = stats_queue.get(timeout=5)
+                except Empty:
+                    if not any(p.is_alive() for p in workers):
+                        break
+                    continue
+                results += 1
+                if aggregator is not None:
+                    aggregators.append(aggregator)
+            for p in workers:
+                p.join()
+                if p.exitcode != 0:
+                    errors.append(Exception("Ping worker of AS{} exited with code {}".format(asn, p.exitcode)))
+        finally:
+            stop.set()
+            for t in stages:
+                t.join()
+            for p in workers:
+                if p.is_alive():
+                    p.terminate()
+                p.join()
+            # batches no worker took must not hold up the exit of this process
+            batches.cancel_join_thread()
+
+        self._save_rtt_summary(aggregators, asn, upload_to_bq)
+
+        metrics.finish_stage("pipeline", started, {"asn": asn},
+                             ping_batches=ping_batches, errors=len(errors))
+        if len(errors) > 0:
+            raise errors[0]
@@ -15,146 +15,406 @@ limitations under the License.
 '''
 
 import glob
+import json
 import os
+import time
+import metrics
+import warts
+import numpy as np
 import pandas as pd
-from multiprocessing import Process
+from array import array
+from functools import partial
+from typing import Callable, Iterator
 
-def get_last_hops_from_paris_tr(file_path: str) -> pd.DataFrame:
+# number of rows held in the typed column buffers before they are handed to
+# pandas as a dataframe
+CHUNK_SIZE = 100000
+
+TRACE_COLUMNS = {
+    'dst': 'str',
+    'stop_reason': 'str',
+    'hop_count': 'float',
+}
+
+LAST_HOPS_COLUMNS = {
+    'dst': 'str',
+    'stop_reason': 'str',
+    'hop_count': 'float',
+    'sec_last_ip': 'str',
+    'sec_last_hop': 'float',
+}
+
+PING_COLUMNS = {
+    'date': 'str',
+    'seq': 'int',
+    'dst': 'str',
+    'stop_reason': 'str',
+    'start_time': 'str',
+    'start_sec': 'int',
+    'hop_count': 'float',
+    'ip_at_ttl': 'str',
+    'probe_ttl': 'float',
+    'rtt': 'float',
+}
+
+# in-memory dtypes of compact ping records; string columns become categoricals
+# so each row only holds a small integer code per IP / stop reason / date
+COMPACT_PING_DTYPES = {
+    'date': 'category',
+    'seq': np.int32,
+    'dst': 'category',
+    'stop_reason': 'category',
+    'start_time': 'Int64',
+    'start_sec': 'Int64',
+    'hop_count': np.float32,
+    'ip_at_ttl': 'category',
+    'probe_ttl': np.float32,
+    'rtt': np.float32,
+}
+
+
+class ColumnBuffer:
+    """
+    Fixed-size typed column arrays that scamper records are parsed into.
+    Strings are kept in object arrays, numbers in int64/float64 arrays so no
+    per-row Python objects are kept around for numeric fields.
+    """
+
+    def __init__(self, columns: dict, size: int = CHUNK_SIZE) -> None:
+        """
+        :param columns: mapping of column name to 'str', 'int' or 'float'
+        :param size: number of rows in each chunk
+        """
+        self.columns = columns
+        self.size = size
+        self.reset()
+
+    def reset(self) -> None:
+        self.n = 0
+        self.arrays = {}
+        self.missing = {}
+        for name, kind in self.columns.items():
+            if kind == 'str':
+                self.arrays[name] = np.full(self.size, None, dtype=object)
+            elif kind == 'int':
+                self.arrays[name] = np.zeros(self.size, dtype=np.int64)
+                self.missing[name] = np.zeros(self.size, dtype=bool)
+            else:
+                self.arrays[name] = np.full(self.size, np.nan, dtype=np.float64)
+
+    def full(self) -> bool:
+        return self.n >= self.size
+
+    def append(self, row: tuple) -> None:
+        i = self.n
+        for (name, kind), value in zip(self.columns.items(), row):
+            if value is None:
+                if kind == 'int':
+                    self.missing[name][i] = True
+                continue
+            self.arrays[name][i] = value
+        self.n += 1
+
+    def to_frame(self) -> pd.DataFrame:
+        data = {}
+        for name, kind in self.columns.items():
+            values = self.arrays[name][:self.n]
+            if kind == 'int' and self.missing[name][:self.n].any():
+                values = pd.arrays.IntegerArray(values.copy(), self.missing[name][:self.n].copy())
+            else:
+                values = values.copy()
+            data[name] = values
+        # the columns are fresh copies; keeping them as separate blocks lets
+        # `_concat_chunks` release each column once it is joined
+        return pd.DataFrame(data, copy=False)
+
+
+def iter_trace_records(source) -> Iterator[dict]:
+    """
+    Read scamper JSON output line by line and yield the decoded trace records.
+    Warts output (`scamper -O warts`) is recognised by its magic number and
+    decoded into the same records (see `warts`).
+
+    :param source: file path, open file or pipe (e.g. scamper's stdout), or an
+    iterable of lines
+    :return: generator of trace records
+    """
+    if isinstance(source, (str, os.PathLike)):
+        with open(source, 'rb') as f:
+            yield from iter_trace_records(f)
+        return
+
+    peek = getattr(source, 'peek', None)
+    if peek is not None and peek(len(warts.MAGIC))[:len(warts.MAGIC)] == warts.MAGIC:
+        yield from warts.iter_traces(source)
+        return
+
+    for line in source:
+        if not line.strip():
+            continue
+        try:
+            record = json.loads(line)
+        except ValueError:
+            continue
+        if record.get('type') == 'trace':
+            yield record
+
+
+def parse_trace_chunks(source, extract: Callable[[dict], tuple], columns: dict, chunk_size: int = CHUNK_SIZE) -> Iterator[pd.DataFrame]:
+    """
+    Stream scamper trace records into fixed-size dataframes.
+
+    :param source: see `iter_trace_records`
+    :param extract: function mapping a trace record to a row tuple ordered as `columns`
+    :param columns: mapping of column name to 'str', 'int' or 'float'
+    :param chunk_size: (optional) number of rows per dataframe
+    :return: generator of dataframes with at most `chunk_size` rows
+    """
+    buf = ColumnBuffer(columns, chunk_size)
+    for record in iter_trace_records(source):
+        buf.append(extract(record))
+        if buf.full():
+            yield buf.to_frame()
+            buf.reset()
+    if buf.n > 0:
+        yield buf.to_frame()
+
+
+def _concat_chunks(chunks: Iterator[pd.DataFrame], columns: dict) -> pd.DataFrame:
+    """
+    Join parsed chunks into one dataframe column by column. Only the columns
+    of each chunk are kept while parsing and the pieces of a column are
+    released as soon as it is joined, so the rows are not held twice as with
+    a `pd.concat` of the whole chunks. Callers that write the rows out should
+    iterate the chunks instead (see `iter_last_hops` and `iter_pings`).
+    """
+    pieces = {name: [] for name in columns}
+    for chunk in chunks:
+        for name in columns:
+            pieces[name].append(chunk[name])
+    if len(pieces[next(iter(columns))]) == 0:
+        return pd.DataFrame(columns=list(columns))
+    data = {}
+    for name in columns:
+        data[name] = pd.concat(pieces.pop(name), ignore_index=True)
+    return pd.DataFrame(data, copy=False)
+
+
+def parse_hop_chunks(source, chunk_size: int = CHUNK_SIZE) -> Iterator[tuple]:
+    """
+    Stream scamper trace records into a trace table and a flattened hop table.
+
+    Every hop of every trace becomes one row of the hop table, with `trace_id`
+    pointing at the row of its trace in the trace table of the same chunk.
+
+    :param source: see `iter_trace_records`
+    :param chunk_size: (optional) number of traces per chunk
+    :return: generator of (traces, hops) dataframe pairs
+    """
+    traces = ColumnBuffer(TRACE_COLUMNS, chunk_size)
+    trace_ids, probe_ttls, addrs, rtts = array('q'), array('d'), [], array('d')
+
+    def flush():
+        hops = pd.DataFrame({
+            'trace_id': np.frombuffer(trace_ids, dtype=np.int64).copy(),
+            'probe_ttl': np.frombuffer(probe_ttls, dtype=np.float64).copy(),
+            'addr': np.array(addrs, dtype=object),
+            'rtt': np.frombuffer(rtts, dtype=np.float64).copy(),
+        })
+        return traces.to_frame(), hops
+
+    for record in iter_trace_records(source):
+        trace_id = traces.n
+        traces.append((record.get('dst'), record.get('stop_reason'), record.get('hop_count')))
+        hops = record.get('hops')
+        if isinstance(hops, list):
+            for hop in hops:
+                trace_ids.append(trace_id)
+                probe_ttls.append(hop['probe_ttl'])
+                addrs.append(hop.get('addr'))
+                rtts.append(hop.get('rtt', np.nan))
+
+        if traces.full():
+            yield flush()
+            traces.reset()
+            trace_ids, probe_ttls, addrs, rtts = array('q'), array('d'), [], array('d')
+
+    if traces.n > 0:
+        yield flush()
+
+
+def nth_hop_from_end(hops: pd.DataFrame, num_traces: int, n: int) -> tuple:
+    """
+    Find the n-th hop from the end (by probe_ttl) of every trace in a hop table.
+    Ties in probe_ttl keep the order the hops were reported in.
+
+    :param hops: hop table from `parse_hop_chunks`
+    :param num_traces: number of traces the hop table refers to
+    :param n: 1 for the last hop, 2 for the second-to-last hop, ...
+    :return: (addr, probe_ttl) arrays indexed by trace_id; None/NaN for traces
+    with fewer than n hops
+    """
+    trace_id = hops['trace_id'].to_numpy()
+    probe_ttl = hops['probe_ttl'].to_numpy()
+
+    # stable sort by (trace_id, probe_ttl), then index back from the end of
+    # each trace's run of hops
+    order = np.lexsort((probe_ttl, trace_id))
+    counts = np.bincount(trace_id, minlength=num_traces)
+    ends = np.cumsum(counts)
+    has_hop = counts >= n
+    idx = order[ends[has_hop] - n]
+
+    addr = np.full(num_traces, None, dtype=object)
+    addr[has_hop] = hops['addr'].to_numpy()[idx]
+    ttl = np.full(num_traces, np.nan)
+    ttl[has_hop] = probe_ttl[idx]
+    return addr, ttl
+
+
+def iter_last_hops(source, chunk_size: int = CHUNK_SIZE) -> Iterator[pd.DataFrame]:
+    """
+    Stream the second-to-last and last hops of scamper traces. The hop table
+    of each chunk is reduced to one row per trace and dropped before the next
+    chunk is parsed.
+
+    :param source: see `iter_trace_records`
+    :param chunk_size: (optional) number of traces per chunk
+    :return: generator of dataframes with the columns of `LAST_HOPS_COLUMNS`
+    """
+    for traces, hops in parse_hop_chunks(source, chunk_size):
+        traces['sec_last_ip'], traces['sec_last_hop'] = nth_hop_from_end(hops, len(traces), 2)
+        yield traces
+
+
+def get_last_hops_from_paris_tr(file_path: str, chunk_size: int = CHUNK_SIZE) -> pd.DataFrame:
     """
     Extract the hop number and IPs for the second-to-last and last hop in
     ICMP paris-traceroutes.
 
     :param file_path: file path to the .json formatted scamper trace output
+    (an open file or pipe is also accepted)
+    :param chunk_size: (optional) number of traces parsed per chunk
     :return: dataframe with the IPs and hop numbers of the second-to-last and
     last hops in the traceroutes as well as the stop reason.
     """
-
-    def sort_hops(e):
-        return e['probe_ttl']
-
-    def get_sec_last_ip(hops):
-        # If the list has fewer than two elements, return None
-        if not isinstance(hops, list) or len(hops) < 2:
-            print('not an instance of list or len is not >= 2: ', hops)
-            return None
-        hops.sort(key=sort_hops)
-        return hops[-2]['addr']
-
-    def get_sec_last_probe_ttl(hops):
-        # If the list has fewer than two elements, return None
-        if not isinstance(hops, list) or len(hops) < 2:
-            print('not an instance of list or len is not >= 2: ', hops)
-            return None
-        hops.sort(key=sort_hops)
-        return hops[-2]['probe_ttl']
-
-    df = pd.read_json(file_path, lines=True)
-
-    # filter for only 'trace' data
-    df = df[df["type"] == "trace"]
-    df['sec_last_ip'] = df['hops'].apply(lambda x: get_sec_last_ip(x))
-    df['sec_last_hop'] = df['hops'].apply(lambda x: get_sec_last_probe_ttl(x))
-    df = df[['dst', 'stop_reason', 'hop_count', 'sec_last_ip', 'sec_last_hop']]
+    start = time.monotonic()
+    df = _concat_chunks(iter_last_hops(file_path, chunk_size), LAST_HOPS_COLUMNS)
+    _record_parse("traces", len(df), time.monotonic() - start)
     return df
 
-def aggregate_data(files: dict) -> pd.DataFrame:
+def compact_pings(df: pd.DataFrame) -> pd.DataFrame:
     """
-    Aggregates data from list of files containing scamper outputs when running ttl_ping
-    into a single file.
+    Convert a ping dataframe to the compact in-memory representation of
+    `COMPACT_PING_DTYPES`, with `start_time` as epoch microseconds.
+    """
+    df = df.copy()
+    start_time = pd.to_datetime(df['start_time'], format='%Y-%m-%d %H:%M:%S', errors='coerce')
+    df['start_time'] = (start_time - pd.Timestamp(0)) // pd.Timedelta(1, 'us')
+    return df.astype(COMPACT_PING_DTYPES)
 
-    :param files: list of .json files from scamper output
-    :return: a single aggregated dataframe with column for seq numbers
+
+def concat_pings(dfs: list) -> pd.DataFrame:
+    """
+    Concatenate compact ping dataframes, merging the categories of the
+    categorical columns so they stay categorical (a plain `pd.concat` falls
+    back to object columns when the categories differ).
     """
+    dfs = [df for df in dfs if len(df) > 0]
+    if len(dfs) == 0:
+        return compact_pings(pd.DataFrame(columns=list(PING_COLUMNS)))
+    if len(dfs) == 1:
+        return dfs[0]
+    data = {}
+    for name, dtype in COMPACT_PING_DTYPES.items():
+        if dtype == 'category':
+            data[name] = pd.api.types.union_categoricals([df[name] for df in dfs])
+        else:
+            data[name] = pd.concat([df[name] for df in dfs], ignore_index=True)
+    return pd.DataFrame(data)
 
-    def get_date(start):
-        try:
-            return start['ftime'].split()[0]
-        except:
-            return None
 
-    def get_start_time(start):
-        try:
-            return start['ftime']
-        except:
-            return None
+def expand_pings(df: pd.DataFrame) -> pd.DataFrame:
+    """
+    Convert compact ping records back to the plain columns `aggregate_data`
+    returns without `compact`, with `start_time` formatted as scamper's ftime.
+    """
+    df = df.copy()
+    for name, dtype in COMPACT_PING_DTYPES.items():
+        if dtype == 'category':
+            df[name] = df[name].astype(object).where(df[name].notna(), None)
+        elif dtype == np.float32:
+            # scamper reports microsecond resolution; rounding drops the
+            # noise added by widening float32
+            df[name] = df[name].astype(np.float64).round(3)
+    start_time = pd.to_datetime(df['start_time'], unit='us', utc=True)
+    df['start_time'] = start_time.dt.strftime('%Y-%m-%d %H:%M:%S').where(start_time.notna(), None)
+    df['seq'] = df['seq'].astype(np.int64)
+    return df
 
-    def get_start_sec(start):
-        try:
-            return start['sec']
-        except:
-            return None
-
-    def get_rtt(hops):
-        try: 
-            return hops[0]['rtt']
-        except:
-            return None
-    def get_probe_ttl(hops):
-        try:
-            return hops[0]['probe_ttl']
-        except:
-            return None
-    def get_ip_at_ttl(hops):
-        try:
-            return hops[0]['addr']
-        except:
-            return None
 
-    dfs = []
+def ping_row(record: dict, seq: int) -> tuple:
+    """
+    :param record: trace record of a `ttl_ping` probe
+    :param seq: round the probe was sent in
+    :return: row ordered as `PING_COLUMNS`
+    """
+    start = record.get('start') or {}
+    ftime = start.get('ftime')
+    hop = {}
+    hops = record.get('hops')
+    if isinstance(hops, list) and len(hops) > 0:
+        hop = hops[0]
+    return (ftime.split()[0] if ftime else None, seq, record.get('dst'),
+            record.get('stop_reason'), ftime, start.get('sec'),
+            record.get('hop_count'), hop.get('addr'), hop.get('probe_ttl'),
+            hop.get('rtt'))
+
+
+def iter_pings(files: dict, chunk_size: int = CHUNK_SIZE, compact: bool = False) -> Iterator[pd.DataFrame]:
+    """
+    Stream the ping records of scamper outputs from `ttl_ping` in chunks, so
+    they can be written out without holding every round in memory.
+
+    :param files: open .json files (or in-memory buffers) of scamper output, by seq number
+    :param chunk_size: (optional) number of traces per chunk
+    :param compact: (optional) yield compact records (see `COMPACT_PING_DTYPES`)
+    :return: generator of dataframes with the columns of `PING_COLUMNS`
+    """
     for seq, f in files.items():
         f.flush()
-        df = pd.DataFrame()
+        f.seek(0)
         try:
-            df = pd.read_json(f.name, lines=True)
+            for chunk in parse_trace_chunks(f, partial(ping_row, seq=seq), PING_COLUMNS, chunk_size):
+                yield compact_pings(chunk) if compact else chunk
         except Exception as e:
             print("Could not load json file with seq: " + str(seq))
             print(e)
 
-        if df.empty:
-            continue
-        df = df[df['type'] == 'trace']
-        df['date'] = df['start'].apply(get_date)
-        df['seq'] = [seq] * len(df)
-        df['start_time'] = df['start'].apply(get_start_time)
-        df['start_sec'] = df['start'].apply(get_start_sec)
-        if 'hops' in df.columns:
-            df['ip_at_ttl'] = df['hops'].apply(get_ip_at_ttl)
-            df['probe_ttl'] = df['hops'].apply(get_probe_ttl)
-            df['rtt'] = df['hops'].apply(get_rtt)
-        else:
-            df['ip_at_ttl'] = [None] * len(df)
-            df['probe_ttl'] = [None] * len(df)
-            df['rtt'] = [None] * len(df)
-        df = df[['date', 'seq', 'dst', 'stop_reason', 'start_time', 'start_sec', 'hop_count', 'ip_at_ttl', 'probe_ttl', 'rtt']]
-        dfs.append(df)
 
-    if len(dfs) == 0:
-        return pd.DataFrame(columns=['date',
-            'seq',
-            'dst',
-            'stop_reason',
-            'start_time',
-            'start_sec',
-            'hop_count',
-            'ip_at_ttl',
-            'probe_ttl',
-            'rtt'])
-
-    all_dfs = pd.concat(dfs)
-    all_dfs.astype({
-        'date': 'str', 
-        'seq': 'int32', 
-        'dst': 'str', 
-        'stop_reason': 'str', 
-        'start_time': 'str', 
-        'start_sec': 'int32', 
-        'hop_count': 'int32', 
-        'ip_at_ttl': 'str', 
-        'probe_ttl': 'float', 
-        'rtt': 'float'
-        }).dtypes
-
-    return all_dfs
+def aggregate_data(files: dict, chunk_size: int = CHUNK_SIZE, compact: bool = False) -> pd.DataFrame:
+    """
+    Aggregates data from list of files containing scamper outputs when running ttl_ping
+    into a single file.
+
+    :param files: list of .json files (or in-memory buffers) from scamper output
+    :param chunk_size: (optional) number of traces parsed per chunk
+    :param compact: (optional) return compact records (see `COMPACT_PING_DTYPES`),
+    converting each chunk as it is parsed
+    :return: a single aggregated dataframe with column for seq numbers
+    """
+    start = time.monotonic()
+    if compact:
+        df = concat_pings(list(iter_pings(files, chunk_size, compact)))
+    else:
+        df = _concat_chunks(iter_pings(files, chunk_size), PING_COLUMNS)
+    _record_parse("pings", len(df), time.monotonic() - start)
+    return df
+
+
+def _record_parse(source: str, rows: int, seconds: float) -> None:
+    metrics.record("parse", {"source": source}, rows=rows, seconds=seconds,
+                   rows_per_second=rows / seconds if seconds > 0 else None)
 
         
 
@@ -0,0 +1,189 @@
+'''
+Copyright 2023 The Board of Trustees of The Leland Stanford Junior University
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+'''
+
+"""
+Config-driven runner for measuring several ASNs at once.
+
+The config is a JSON file with the global probe budget and one entry per
+job:
+
+    {
+        "data_dir": "measurements",
+        "max_pps": 20000,
+        "max_concurrency": 8,
+        "jobs": [
+            {"name": "starlink", "asn": 14593, "ipv": 4, "weight": 3,
+             "bq_dataset_id": "starlink", "ping_len": 10, "upload_to_bq": true},
+            {"name": "oneweb", "asn": 800, "ipv": 4, "ping_len": 600}
+        ]
+    }
+
+Every job runs in its own process. `max_pps` and `max_concurrency` (ping
+workers) are split between the jobs in proportion to their `weight`
+(default 1), so jobs run side by side without exceeding the shared budget;
+the budgets must leave at least 1 for every job. Each job writes to its own
+`<data_dir>/<name>` directory (`data_dir` defaults to the current directory)
+unless it sets a `data_dir` of its own.
+`metrics_file` (optional) collects the metrics of every job as JSON lines
+and `prometheus_port` (optional) serves them at /metrics while the jobs run.
+A job's `mode` picks `DataCollection.run_checkpointed` (the default) or
+`DataCollection.run_pipelined`; `data_dir`, `bq_dataset_id`,
+`output_format` and `scamper_format` configure its `DataCollection`, and
+the remaining keys are passed to the run method.
+"""
+
+import inspect
+import json
+import metrics
+import os
+import time
+from multiprocessing import Process
+from multiprocessing.connection import wait
+
+# `DataCollection` method of each job mode; data_collection is imported when
+# a config is loaded, so importing this module stays cheap
+RUN_METHODS = {
+    "checkpointed": "run_checkpointed",
+    "pipelined": "run_pipelined",
+}
+
+JOB_KEYS = ("name", "mode", "weight", "data_dir", "bq_dataset_id", "output_format", "scamper_format")
+
+
+def load_jobs(config_path: str) -> dict:
+    """
+    Read and validate a job config.
+
+    :param config_path: path to the JSON config
+    :return: the config dict
+    """
+    from data_collection import DataCollection
+
+    with open(config_path) as f:
+        config = json.load(f)
+
+    jobs = config.get("jobs", [])
+    if len(jobs) == 0:
+        raise Exception("No jobs in " + config_path)
+    names = set()
+    for job in jobs:
+        if "asn" not in job:
+            raise Exception("Job without an ASN: " + str(job))
+        job.setdefault("name", "as" + str(job["asn"]))
+        if job["name"] in names:
+            raise Exception("Duplicate job name: " + job["name"])
+        names.add(job["name"])
+
+        mode = job.get("mode", "checkpointed")
+        if mode not in RUN_METHODS:
+            raise Exception("Unsupported job mode: " + str(mode))
+        params = inspect.signature(getattr(DataCollection, RUN_METHODS[mode])).parameters
+        for key in job:
+            if key not in JOB_KEYS and key not in params:
+                raise Exception("Unknown option {} in job {}".format(key, job["name"]))
+        if job.get("weight", 1) <= 0:
+            raise Exception("Job weight must be positive: " + job["name"])
+    return config
+
+
+def share_budget(jobs: list, total: int) -> list:
+    """
+    Split a budget between jobs in proportion to their weights. Every job
+    gets at least 1 and the shares never add up to more than the budget.
+
+    :param jobs: job dicts
+    :param total: budget to split (None for no limit)
+    :return: each job's share, in job order
+    """
+    if total is None:
+        return [None] * len(jobs)
+    if total < len(jobs):
+        raise Exception("Cannot split a budget of {} between {} jobs".format(total, len(jobs)))
+    weights = [job.get("weight", 1) for job in jobs]
+    shares = [max(int(total * w / sum(weights)), 1) for w in weights]
+    # jobs raised to 1 are paid for by the largest shares
+    while sum(shares) > total:
+        largest = shares.index(max(shares))
+        shares[largest] -= 1
+    return shares
+
+
+def run_job(job: dict, max_pps: int, max_concurrency: int, data_dir: str = ".") -> None:
+    """
+    Run one job of a config with its share of the budget.
+
+    :param data_dir: directory under which the job gets its own directory,
+    unless it sets a `data_dir` of its own
+    """
+    from data_collection import DataCollection
+
+    print("running {} job".format(job["name"]))
+    job_dir = job.get("data_dir")
+    if job_dir is None:
+        job_dir = os.path.join(data_dir, job["name"])
+        os.makedirs(job_dir, exist_ok=True)
+    dc = DataCollection(
+        data_dir=job_dir,
+        bq_dataset_id=job.get("bq_dataset_id"),
+        output_format=job.get("output_format", "csv"),
+        scamper_format=job.get("scamper_format", "json"),
+    )
+    mode = job.get("mode", "checkpointed")
+    kwargs = {k: v for k, v in job.items() if k not in JOB_KEYS}
+    kwargs["max_pps"] = max_pps
+    kwargs["max_concurrency"] = max_concurrency
+    getattr(dc, RUN_METHODS[mode])(**kwargs)
+
+
+def run_jobs(config: dict) -> dict:
+    """
+    Run every job of a config at the same time and wait for all of them.
+
+    :param config: config from `load_jobs`
+    :return: exit code of each job's process, by job name
+    """
+    jobs = config["jobs"]
+    if config.get("metrics_file") is not None:
+        # set before the job processes start so they record to it as well
+        metrics.configure(config["metrics_file"])
+    server = None
+    if config.get("prometheus_port") is not None:
+        server = metrics.serve_prometheus(config["prometheus_port"])
+    pps_shares = share_budget(jobs, config.get("max_pps"))
+    concurrency_shares = share_budget(jobs, config.get("max_concurrency", len(jobs)))
+
+    processes = {}
+    for job, pps, concurrency in zip(jobs, pps_shares, concurrency_shares):
+        print("{}: {} pps, {} ping workers".format(job["name"], pps if pps else "unlimited", concurrency))
+        p = Process(target=run_job, args=(job, pps, concurrency, config.get("data_dir", ".")), name=job["name"])
+        p.start()
+        processes[job["name"]] = p
+
+    start = time.time()
+    exit_codes = {}
+    running = dict(processes)
+    while len(running) > 0:
+        for sentinel in wait([p.sentinel for p in running.values()]):
+            name = next(n for n, p in running.items() if p.sentinel == sentinel)
+            p = running.pop(name)
+            p.join()
+            exit_codes[name] = p.exitcode
+            print("{} job finished with exit code {} after {:.0f}s".format(name, p.exitcode, time.time() - start))
+            metrics.record("job", {"job": name}, exit_code=p.exitcode, wall_seconds=time.time() - start)
+    if server is not None:
+        server.shutdown()
+        server.server_close()
+    return exit_codes
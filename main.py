@@ -1,4 +1,4 @@
-''' 
+'''
 Copyright 2023 The Board of Trustees of The Leland Stanford Junior University
 
 Licensed under the Apache License, Version 2.0 (the "License");
@@ -14,32 +14,266 @@ See the License for the specific language governing permissions and
 limitations under the License.
 '''
 
+"""
+Command line entry point of the LEO HitchHiking pipeline.
 
-from data_collection import *
+    python main.py run --preset starlink --bq-dataset hitchhiking_sample --upload
+    python main.py discover --asn 800 --ipv 4
+    python main.py trace --asn 800 --shards 4 --max-pps 5000
+    python main.py ping --asn 800 --duration 600 --interval 1
+    python main.py upload --table hitchhiking_sample.endpoint_pings pings/last/2023-11-14.csv
+    python main.py jobs jobs.example.json
 
-"""
-Sample LEO HitchHiking script.
+`discover`, `trace` and `ping` each run one stage of the day's checkpointed
+run of an ASN (see `DataCollection.run_checkpointed`) and read the output of
+the stage before from the run's checkpoints; `run` runs every stage.
+`--preset` fills in the ASN, Censys table and ping schedule of a
+constellation measured before. `--incremental` makes `discover` and
+`trace` work against the ASN's latest local snapshot (see `snapshot`).
+`jobs` exits with status 1 if any of its jobs failed.
 
-Queries Censys for exposed Starlink and OneWeb services. Traceroutes the exposed services
-and pings reachable endpoints for 5 minutes. Data is uploaded to the specified BigQuery
-dataset.
+Only the standard library is imported at startup. pandas, scamper and the
+Censys and BigQuery SDKs are imported when a command needs them, so
+`--help`, short cron invocations and the worker processes started from
+them do not load backends they never use. `--timings` prints how long
+startup and each backend import took (and records them as a `startup`
+metric).
 """
 
-def starlink_job():
-    print("running starlink job")
-    starlink_dc = DataCollection(bq_dataset_id="hitchhiking_sample") # FIXME: update with BQ dataset id
-    starlink_df = starlink_dc.get_censys_exposed_services(14593, 4, 'censys-io.universal_internet_dataset_v2.base')
-    tr_df = starlink_dc.paris_traceroute_exposed_services(starlink_df, 'ip', True) # change to False to save to file instead of BQ
-    starlink_dc.ping_exposed_services(tr_df, 10, 1, True)  # change to False to save to file instead of BQ
+import time
+
+STARTED = time.perf_counter()
+
+import argparse
+import importlib
+import os
+import sys
+import metrics
+
+# ASN, Censys BigQuery table and ping schedule of the constellations
+# measured so far
+PRESETS = {
+    "starlink": {"asn": 14593, "bq": "censys-io.universal_internet_dataset_v2.base", "ping_len": 10, "ping_interval": 1},
+    "oneweb": {"asn": 800, "bq": None, "ping_len": 600, "ping_interval": 1},
+}
+
+# stages of `DataCollection.run_checkpointed` each command runs
+COMMAND_STAGES = {
+    "discover": ("exposed_services",),
+    "trace": ("traceroute",),
+    "ping": ("pings",),
+    "run": None,
+}
+
+# loader of each kind of file `upload` accepts, by file extension
+UPLOAD_KINDS = {
+    ".parquet": "upload_parquet_file",
+    ".json": "upload_exposed_services_file",
+    ".csv": "upload_ping_file",
+}
+
+import_seconds = {}
+
+
+def lazy_import(name: str):
+    """
+    Import a backend module when a command first needs it, recording how
+    long the import took.
+
+    :param name: module name
+    :return: the module
+    """
+    if name in sys.modules:
+        return sys.modules[name]
+    start = time.perf_counter()
+    module = importlib.import_module(name)
+    import_seconds[name] = time.perf_counter() - start
+    return module
+
+
+def report_startup(args, command: str) -> None:
+    """
+    Print (with `--timings`) and record the time from startup until the
+    command starts measuring, including the backend imports.
+    """
+    seconds = time.perf_counter() - STARTED
+    metrics.record("startup", {"command": command}, seconds=seconds, imports=import_seconds)
+    if args.timings:
+        print("startup: {:.1f} ms".format(seconds * 1000))
+        for name, elapsed in import_seconds.items():
+            print("  import {}: {:.1f} ms".format(name, elapsed * 1000))
+
+
+def resolve(args, parser) -> dict:
+    """
+    Combine a preset with the options given on the command line, which take
+    precedence.
+
+    :return: the ASN, Censys table and ping schedule to measure with
+    """
+    settings = {"asn": None, "bq": None, "ping_len": 5, "ping_interval": 1}
+    if args.preset is not None:
+        settings.update(PRESETS[args.preset])
+    if args.asn is not None:
+        settings["asn"] = args.asn
+    if args.bq is not None:
+        settings["bq"] = args.bq or None
+    if settings["asn"] is None:
+        parser.error("an ASN is required (--asn or --preset)")
+    if args.upload and args.bq_dataset is None:
+        parser.error("--upload requires --bq-dataset")
+    if getattr(args, "pipelined", False) and getattr(args, "incremental", False):
+        parser.error("--incremental needs the checkpointed run (drop --pipelined)")
+
+    interval = getattr(args, "interval", None)
+    if interval is not None:
+        settings["ping_interval"] = interval
+    if getattr(args, "ping_len", None) is not None:
+        settings["ping_len"] = args.ping_len
+    elif getattr(args, "duration", None) is not None:
+        if settings["ping_interval"] <= 0:
+            parser.error("--duration needs a positive --interval")
+        settings["ping_len"] = max(int(args.duration / settings["ping_interval"]), 1)
+    return settings
+
+
+def data_collection(args):
+    """
+    :return: a `DataCollection` configured from the command line
+    """
+    DataCollection = lazy_import("data_collection").DataCollection
+    return DataCollection(
+        data_dir=args.data_dir,
+        bq_dataset_id=args.bq_dataset,
+        output_format=args.output_format,
+        path_cache_max_age=args.path_cache_ttl,
+        path_cache_granularity=args.path_cache_granularity,
+        metrics_file=args.metrics_file,
+        scamper_format=args.scamper_format,
+    )
+
+
+def run_stages(args, parser) -> None:
+    settings = resolve(args, parser)
+    dc = data_collection(args)
+    report_startup(args, args.command)
+    if getattr(args, "pipelined", False):
+        dc.run_pipelined(settings["asn"], args.ipv, settings["bq"],
+                         ping_len=settings["ping_len"], ping_interval=settings["ping_interval"],
+                         upload_to_bq=args.upload, batch_size=args.batch_size, shards=args.shards,
+                         max_concurrency=args.max_concurrency or 2, max_pps=args.max_pps,
+                         per_group=args.per_group, rotate=args.rotate)
+        return
+    dc.run_checkpointed(settings["asn"], args.ipv, settings["bq"],
+                        ping_len=settings["ping_len"], ping_interval=settings["ping_interval"],
+                        upload_to_bq=args.upload, run_id=args.run_id,
+                        shards=getattr(args, "shards", 1), max_concurrency=getattr(args, "max_concurrency", None),
+                        max_pps=getattr(args, "max_pps", None), per_group=getattr(args, "per_group", None),
+                        rotate=getattr(args, "rotate", "day"), stages=COMMAND_STAGES[args.command],
+                        incremental=getattr(args, "incremental", False), max_age_days=getattr(args, "max_age_days", 7),
+                        full_refresh_days=getattr(args, "full_refresh_days", None),
+                        rotation_days=getattr(args, "rotation_days", 7))
+
+
+def upload(args, parser) -> None:
+    loaders = []
+    for path in args.files:
+        kind = UPLOAD_KINDS.get(os.path.splitext(path)[1])
+        if kind is None:
+            parser.error("cannot upload {}: expected one of {}".format(path, ", ".join(UPLOAD_KINDS)))
+        loaders.append((kind, path))
+    bq_upload = lazy_import("bq_upload")
+    report_startup(args, "upload")
+    for kind, path in loaders:
+        getattr(bq_upload, kind)(args.table, path)
+
+
+def run_jobs(args, parser) -> None:
+    jobs = lazy_import("jobs")
+    config = jobs.load_jobs(args.config)
+    report_startup(args, "jobs")
+    exit_codes = jobs.run_jobs(config)
+    failed = sorted(name for name, code in exit_codes.items() if code != 0)
+    if len(failed) > 0:
+        print("failed jobs: " + ", ".join(failed))
+        sys.exit(1)
+
+
+def build_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(description="Measure LEO networks by pinging the hops in front of exposed services.")
+    parser.add_argument("--timings", action="store_true", help="print startup and import times")
+    commands = parser.add_subparsers(dest="command", required=True, metavar="command")
+
+    common = argparse.ArgumentParser(add_help=False)
+    common.add_argument("--preset", choices=sorted(PRESETS), help="ASN, Censys table and ping schedule of a known constellation")
+    common.add_argument("--asn", type=int, help="autonomous system to measure")
+    common.add_argument("--ipv", type=int, choices=(4, 6), help="only measure this IP version")
+    common.add_argument("--bq", help="Censys BigQuery table to read hosts from (\"\" for the Censys API)")
+    common.add_argument("--data-dir", help="directory to store measurement data in (default .)")
+    common.add_argument("--bq-dataset", help="BigQuery dataset to upload results to")
+    common.add_argument("--upload", action="store_true", help="upload results to --bq-dataset instead of saving them to file")
+    common.add_argument("--run-id", help="ID of the checkpointed run to start or resume (default today's date)")
+    common.add_argument("--output-format", choices=("csv", "parquet"), default="csv")
+    common.add_argument("--scamper-format", choices=("json", "warts"), default="json")
+    common.add_argument("--path-cache-ttl", type=float, help="reuse traced paths for this many seconds")
+    common.add_argument("--path-cache-granularity", choices=("ip", "prefix"), default="ip")
+    common.add_argument("--metrics-file", help="append metrics as JSON lines to this file")
+
+    trace = argparse.ArgumentParser(add_help=False)
+    trace.add_argument("--shards", type=int, default=1, help="parallel scamper workers for the traceroutes")
+
+    ping = argparse.ArgumentParser(add_help=False)
+    length = ping.add_mutually_exclusive_group()
+    length.add_argument("--duration", type=float, help="seconds to ping for")
+    length.add_argument("--ping-len", type=int, help="number of ping rounds")
+    ping.add_argument("--interval", type=float, help="seconds between ping rounds")
+    ping.add_argument("--max-concurrency", type=int, help="number of ping workers")
+    ping.add_argument("--per-group", type=int, help="destinations pinged per PoP segment")
+    ping.add_argument("--rotate", choices=("day", "round"), default="day")
+
+    budget = argparse.ArgumentParser(add_help=False)
+    budget.add_argument("--max-pps", type=int, help="global packets-per-second budget")
+
+    snapshot = argparse.ArgumentParser(add_help=False)
+    snapshot.add_argument("--incremental", action="store_true",
+                          help="only query and trace what changed since the ASN's latest snapshot")
+    snapshot.add_argument("--max-age-days", type=int, default=7, help="days a host is kept without Censys reporting it")
+    snapshot.add_argument("--full-refresh-days", type=int,
+                          help="days between full Censys queries (default half of --max-age-days)")
+    snapshot.add_argument("--rotation-days", type=int, default=7, help="days over which every known IP is traced again")
+
+    commands.add_parser("discover", parents=[common, snapshot], help="query Censys for the exposed services of an ASN") \
+        .set_defaults(handler=run_stages)
+    commands.add_parser("trace", parents=[common, trace, budget, snapshot], help="traceroute the discovered services") \
+        .set_defaults(handler=run_stages)
+    commands.add_parser("ping", parents=[common, ping, budget], help="ping the last hops found by trace") \
+        .set_defaults(handler=run_stages)
+    run = commands.add_parser("run", parents=[common, trace, ping, budget, snapshot], help="discover, trace and ping")
+    run.add_argument("--pipelined", action="store_true", help="overlap the stages instead of checkpointing them")
+    run.add_argument("--batch-size", type=int, default=1000, help="destinations per pipelined batch")
+    run.set_defaults(handler=run_stages)
+
+    upload_parser = commands.add_parser("upload", help="load saved result files into BigQuery")
+    upload_parser.add_argument("--table", required=True, help="BigQuery table ID")
+    upload_parser.add_argument("files", nargs="+", help=".csv pings, .json exposed services or .parquet files")
+    upload_parser.set_defaults(handler=upload)
+
+    jobs_parser = commands.add_parser("jobs", help="run every job of a config file side by side")
+    jobs_parser.add_argument("config", help="JSON config (see jobs.example.json)")
+    jobs_parser.set_defaults(handler=run_jobs)
+    return parser
+
 
+def main(argv: list = None) -> None:
+    if argv is None:
+        argv = sys.argv[1:]
+    # `python main.py jobs.json`, as before the subcommands
+    if len(argv) == 1 and argv[0].endswith(".json") and os.path.isfile(argv[0]):
+        argv = ["jobs"] + argv
+    parser = build_parser()
+    args = parser.parse_args(argv)
+    args.handler(args, parser)
 
-def oneweb_job():
-    print("running oneweb job")
-    oneweb_dc = DataCollection(bq_dataset_id="MY_BQ_DATASET") # FIXME: update with BQ dataset id
-    oneweb_df = oneweb_dc.get_censys_exposed_services(800, 4)
-    tr_df = oneweb_dc.paris_traceroute_exposed_services(oneweb_df, 'ip', True)  # change to False to save to file instead of BQ
-    oneweb_dc.ping_exposed_services(tr_df, 600, 1, True)  # change to False to save to file instead of BQ
 
 if __name__ == "__main__":
-    starlink_job()
-    # oneweb_job()
+    main()
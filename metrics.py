@@ -0,0 +1,240 @@
+'''
+Copyright 2023 The Board of Trustees of The Leland Stanford Junior University
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+'''
+
+"""
+Run metrics.
+
+Metrics are appended as JSON lines to the file set with `configure` (or the
+METRICS_FILE environment variable), one line per event:
+
+    {"ts": 1700000000.0, "pid": 1234, "metric": "ttl_ping",
+     "labels": {"asn": 14593, "hop_type": "last"}, "probes": 6000, ...}
+
+Worker processes inherit the file and append to it as well. Recording is a
+no-op when no file is configured. `serve_prometheus` exposes the latest value
+of every metric in the Prometheus text format, read back from the file so it
+includes the metrics of every process.
+"""
+
+import json
+import os
+import re
+import resource
+import threading
+import time
+from contextlib import contextmanager
+
+ENV_VAR = "METRICS_FILE"
+
+_path = os.environ.get(ENV_VAR)
+_lock = threading.Lock()
+
+
+def _reset_lock() -> None:
+    # a worker forked while another thread was recording would otherwise
+    # inherit the lock held forever
+    global _lock
+    _lock = threading.Lock()
+
+
+os.register_at_fork(after_in_child=_reset_lock)
+
+
+def configure(path: str) -> None:
+    """
+    Start (or, with None, stop) recording metrics to a JSON-lines file.
+    Processes started afterwards record to the same file.
+    """
+    global _path
+    _path = path
+    if path is None:
+        os.environ.pop(ENV_VAR, None)
+    else:
+        os.environ[ENV_VAR] = path
+
+
+def enabled() -> bool:
+    return _path is not None
+
+
+def record(metric: str, labels: dict = None, **values) -> None:
+    """
+    Append one metrics event.
+
+    :param metric: event name, e.g. the stage it describes
+    :param labels: (optional) labels such as the ASN or hop type
+    :param values: measured values
+    """
+    if _path is None:
+        return
+    line = json.dumps(dict(
+        {"ts": time.time(), "pid": os.getpid(), "metric": metric, "labels": labels or {}},
+        **values), default=str)
+    with _lock:
+        # a single short append per event keeps the lines of concurrent
+        # processes from interleaving
+        with open(_path, "a") as f:
+            f.write(line + "\n")
+
+
+def peak_rss_mb() -> float:
+    """
+    :return: peak resident set size of this process so far, in MB
+    """
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def start_stage() -> tuple:
+    """
+    Take the snapshot `finish_stage` measures a stage against.
+    """
+    children = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return time.monotonic(), time.process_time(), children.ru_utime + children.ru_stime
+
+
+def finish_stage(metric: str, started: tuple, labels: dict = None, **values) -> None:
+    """
+    Record the wall time, CPU time (of this process and of the child
+    processes it waited for, e.g. scamper) and peak RSS of a stage.
+
+    :param metric: stage name
+    :param started: snapshot from `start_stage`
+    :param labels: (optional) labels such as the ASN or hop type
+    :param values: other values measured during the stage
+    """
+    if _path is None:
+        return
+    wall, cpu, child_cpu = started
+    children = resource.getrusage(resource.RUSAGE_CHILDREN)
+    values["wall_seconds"] = time.monotonic() - wall
+    values["cpu_seconds"] = time.process_time() - cpu
+    values["child_cpu_seconds"] = children.ru_utime + children.ru_stime - child_cpu
+    values["peak_rss_mb"] = peak_rss_mb()
+    record(metric, labels, **values)
+
+
+@contextmanager
+def stage(metric: str, **labels):
+    """
+    `start_stage`/`finish_stage` around a block. The block can add its own
+    values to the yielded dict.
+
+        with metrics.stage("traceroute", asn=asn) as m:
+            ...
+            m["traces"] = n
+    """
+    values = {}
+    started = start_stage()
+    try:
+        yield values
+    finally:
+        finish_stage(metric, started, labels, **values)
+
+
+def _prometheus_name(*parts) -> str:
+    return re.sub(r"[^a-zA-Z0-9_]", "_", "_".join(str(p) for p in parts))
+
+
+def _prometheus_labels(labels: dict) -> str:
+    if len(labels) == 0:
+        return ""
+    pairs = ['{}="{}"'.format(_prometheus_name(k), str(v).replace('\\', '\\\\').replace('"', '\\"'))
+             for k, v in sorted(labels.items())]
+    return "{" + ",".join(pairs) + "}"
+
+
+class _MetricsFile:
+    """
+    Latest values of every (metric, value, labels) in a metrics file, read
+    incrementally.
+    """
+
+    def __init__(self, path: str) -> None:
+        self.path = path
+        self.offset = 0
+        self.latest = {}
+        self.counts = {}
+        self.lock = threading.Lock()
+
+    def refresh(self) -> None:
+        if not os.path.exists(self.path):
+            return
+        with open(self.path, "rb") as f:
+            f.seek(self.offset)
+            for line in f:
+                # a line still being written is read on the next refresh
+                if not line.endswith(b"\n"):
+                    break
+                self.offset += len(line)
+                try:
+                    event = json.loads(line)
+                except ValueError:
+                    continue
+                labels = _prometheus_labels(event.get("labels", {}))
+                name = _prometheus_name(event.get("metric"))
+                self.counts[(name, labels)] = self.counts.get((name, labels), 0) + 1
+                for key, value in event.items():
+                    if key in ("ts", "pid", "metric", "labels"):
+                        continue
+                    if isinstance(value, (int, float)) and not isinstance(value, bool):
+                        self.latest[(_prometheus_name(name, key), labels)] = value
+
+    def render(self) -> str:
+        with self.lock:
+            self.refresh()
+            lines = []
+            for (name, labels), value in sorted(self.latest.items()):
+                lines.append("hitchhiking_{}{} {}".format(name, labels, value))
+            for (name, labels), count in sorted(self.counts.items()):
+                lines.append("hitchhiking_{}_events_total{} {}".format(name, labels, count))
+            return "\n".join(lines) + "\n"
+
+
+def serve_prometheus(port: int, host: str = "") -> "ThreadingHTTPServer":
+    """
+    Serve the latest metrics in the Prometheus text format at /metrics from
+    a background thread.
+
+    :param port: port to listen on
+    :param host: (optional) address to bind to
+    :return: the server (call `shutdown()` to stop it)
+    """
+    # imported here as every worker process imports this module, and only
+    # the job runner serves metrics
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+    if _path is None:
+        raise Exception("Configure a metrics file before serving metrics.")
+    source = _MetricsFile(_path)
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.split("?")[0] != "/metrics":
+                self.send_error(404)
+                return
+            body = source.render().encode()
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain; version=0.0.4")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer((host, port), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
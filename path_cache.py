@@ -0,0 +1,162 @@
+'''
+Copyright 2023 The Board of Trustees of The Leland Stanford Junior University
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+'''
+
+import sqlite3
+import time
+import pandas as pd
+from contextlib import contextmanager
+from ipaddress import ip_network
+
+PATH_COLUMNS = ['stop_reason', 'hop_count', 'sec_last_ip', 'sec_last_hop']
+
+
+class PathCache:
+    """
+    Persistent cache of paris-traceroute results (hop count and second-to-last
+    hop), keyed by destination IP or by the destination's /24 (IPv4) or /64
+    (IPv6) prefix.
+
+    Entries expire after `max_age` seconds and are dropped early when TTL
+    pings show that the path changed, i.e. the responder at a cached hop is no
+    longer the expected one. Only completed traceroutes are cached.
+
+    The cache is a SQLite file opened per operation, so the object can be
+    handed to ping worker processes.
+    """
+
+    def __init__(self, db_path: str, max_age: float = 3 * 24 * 3600, granularity: str = "ip") -> None:
+        """
+        :param db_path: path to the SQLite file
+        :param max_age: (optional) seconds before an entry must be traced again
+        :param granularity: (optional) "ip" to key by destination, "prefix" to key by /24 or /64
+        """
+        if granularity not in ("ip", "prefix"):
+            raise Exception("Unsupported path cache granularity: " + str(granularity))
+        self.db_path = db_path
+        self.max_age = max_age
+        self.granularity = granularity
+        with self._connect() as conn:
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS paths ("
+                "  key TEXT PRIMARY KEY,"
+                "  stop_reason TEXT,"
+                "  hop_count REAL,"
+                "  sec_last_ip TEXT,"
+                "  sec_last_hop REAL,"
+                "  updated REAL"
+                ")"
+            )
+
+    @contextmanager
+    def _connect(self):
+        conn = sqlite3.connect(self.db_path, timeout=60)
+        try:
+            with conn:
+                yield conn
+        finally:
+            conn.close()
+
+    def key(self, ip: str) -> str:
+        if self.granularity == "ip":
+            return str(ip)
+        prefix_len = 24 if ":" not in str(ip) else 64
+        return str(ip_network(str(ip) + "/" + str(prefix_len), strict=False))
+
+    def lookup(self, ips) -> pd.DataFrame:
+        """
+        Fetch the fresh cache entries for a list of IPs.
+
+        :param ips: IP addresses
+        :return: dataframe with 'dst' and the traceroute columns, one row per
+        IP that has a fresh entry
+        """
+        now = time.time()
+        keys = {ip: self.key(ip) for ip in ips}
+        entries = {}
+        with self._connect() as conn:
+            unique_keys = list(set(keys.values()))
+            for i in range(0, len(unique_keys), 500):
+                batch = unique_keys[i:i + 500]
+                rows = conn.execute(
+                    "SELECT key, stop_reason, hop_count, sec_last_ip, sec_last_hop FROM paths "
+                    "WHERE updated >= ? AND key IN (" + ",".join("?" * len(batch)) + ")",
+                    [now - self.max_age] + batch
+                )
+                for row in rows:
+                    entries[row[0]] = row[1:]
+
+        hits = [(ip,) + entries[key] for ip, key in keys.items() if key in entries]
+        return pd.DataFrame(hits, columns=['dst'] + PATH_COLUMNS)
+
+    def update(self, last_hops: pd.DataFrame) -> None:
+        """
+        Store completed traceroute results.
+
+        :param last_hops: dataframe from `get_last_hops_from_paris_tr`
+        """
+        done = last_hops[(last_hops['stop_reason'] == 'COMPLETED') & last_hops['sec_last_ip'].notna()]
+        now = time.time()
+        with self._connect() as conn:
+            conn.executemany(
+                "INSERT OR REPLACE INTO paths VALUES (?, ?, ?, ?, ?, ?)",
+                [(self.key(r.dst), r.stop_reason, float(r.hop_count), r.sec_last_ip, float(r.sec_last_hop), now)
+                 for r in done.itertuples(index=False)]
+            )
+
+    def invalidate(self, ips) -> None:
+        """
+        Drop the entries of the given IPs.
+        """
+        with self._connect() as conn:
+            conn.executemany("DELETE FROM paths WHERE key = ?", [(self.key(ip),) for ip in set(ips)])
+
+    def evict_expired(self) -> int:
+        """
+        Drop every entry older than `max_age`.
+
+        :return: number of entries dropped
+        """
+        with self._connect() as conn:
+            return conn.execute("DELETE FROM paths WHERE updated < ?", (time.time() - self.max_age,)).rowcount
+
+    def check_pings(self, df: pd.DataFrame, sec_last: bool) -> list:
+        """
+        Invalidate the paths that TTL pings show have changed. A destination's
+        path is considered changed when most of its answered pings came from
+        a responder other than the expected one: the cached second-to-last hop
+        for `sec_last` pings, the destination itself for last-hop pings.
+
+        :param df: ping dataframe from `aggregate_data` (plain or compact)
+        :param sec_last: whether `df` holds second-to-last hop pings
+        :return: the destinations that were invalidated
+        """
+        answered = df[df['ip_at_ttl'].notna()][['dst', 'ip_at_ttl']].astype(object)
+        if len(answered) == 0:
+            return []
+
+        if sec_last:
+            cached = self.lookup(answered['dst'].unique())
+            expected = answered['dst'].map(dict(zip(cached['dst'], cached['sec_last_ip'])))
+        else:
+            expected = answered['dst']
+
+        mismatch = (answered['ip_at_ttl'] != expected) & expected.notna()
+        share = mismatch.groupby(answered['dst']).mean()
+        changed = share[share > 0.5].index.tolist()
+        if len(changed) > 0:
+            self.invalidate(changed)
+            print("path cache: invalidated {} changed paths".format(len(changed)))
+        return changed
@@ -0,0 +1,168 @@
+'''
+Copyright 2023 The Board of Trustees of The Leland Stanford Junior University
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+'''
+
+"""
+On-line RTT statistics for TTL pings.
+
+`RttAggregator` is fed the ping rounds as they are collected and keeps, for
+every hop type, per-destination and per-second-to-last-hop (PoP) running
+counts, min/max/sum of the RTTs and a log-bucketed quantile sketch. The
+sketch has a bounded relative error, only stores the buckets that were hit
+and can be merged across workers, so the summaries of a whole run are
+computed without keeping the raw pings around.
+"""
+
+import numpy as np
+import pandas as pd
+
+# groups the statistics are kept for; "sec_last_ip" groups destinations by
+# the second-to-last hop found in their paris-traceroute
+GROUPS = ("dst", "sec_last_ip")
+
+QUANTILES = {"p50_rtt": 0.5, "p95_rtt": 0.95}
+
+SUMMARY_COLUMNS = ['date', 'asn', 'hop_type', 'group_by', 'key', 'probes', 'responses',
+                   'loss_rate', 'min_rtt', 'mean_rtt', 'p50_rtt', 'p95_rtt', 'max_rtt']
+
+# smallest RTT (ms) the sketch distinguishes; smaller RTTs share its bucket
+MIN_RTT = 0.001
+
+
+class RttAggregator:
+
+    def __init__(self, pops: dict = None, accuracy: float = 0.01, max_pending: int = 1000000) -> None:
+        """
+        :param pops: (optional) mapping of destination IP to the second-to-last
+        hop IP of its paris-traceroute, used for the "sec_last_ip" groups
+        :param accuracy: (optional) relative error of the RTT quantiles
+        :param max_pending: (optional) number of sketch updates buffered before
+        they are merged into the sketch
+        """
+        self.pops = pops or {}
+        self.gamma = (1 + accuracy) / (1 - accuracy)
+        self.max_pending = max_pending
+        # (hop_type, group) -> dataframe indexed by key
+        self._stats = {}
+        # (hop_type, group) -> bucket counts indexed by (key, bucket)
+        self._buckets = {}
+        # (hop_type, group) -> list of bucket counts not merged yet
+        self._pending = {}
+
+    def update(self, df: pd.DataFrame, hop_type: str) -> None:
+        """
+        Add a batch of pings.
+
+        :param df: ping dataframe from `aggregate_data` (plain or compact)
+        :param hop_type: hop type the pings were sent to, e.g. "last" or "sec_last"
+        """
+        if len(df) == 0:
+            return
+        # compact pings keep float32 RTTs; round back to scamper's microseconds
+        rtt = df['rtt'].to_numpy(dtype=np.float64, na_value=np.nan).round(3)
+        keys = {"dst": df['dst'], "sec_last_ip": df['dst'].map(self.pops)}
+
+        for group in GROUPS:
+            frame = pd.DataFrame({'key': np.asarray(keys[group], dtype=object), 'rtt': rtt})
+            frame = frame[frame['key'].notna()]
+            if len(frame) == 0:
+                continue
+            stats = frame.groupby('key').agg(
+                probes=('rtt', 'size'),
+                responses=('rtt', 'count'),
+                rtt_min=('rtt', 'min'),
+                rtt_max=('rtt', 'max'),
+                rtt_sum=('rtt', 'sum'),
+            )
+            self._merge_stats((hop_type, group), stats)
+
+            answered = frame[frame['rtt'].notna()]
+            buckets = np.ceil(np.log(np.maximum(answered['rtt'].to_numpy(), MIN_RTT)) / np.log(self.gamma))
+            counts = answered.groupby([answered['key'], buckets.astype(np.int64)]).size()
+            pending = self._pending.setdefault((hop_type, group), [])
+            pending.append(counts)
+            if sum(len(c) for c in pending) >= self.max_pending:
+                self._merge_buckets((hop_type, group))
+
+    def merge(self, other: "RttAggregator") -> None:
+        """
+        Add the statistics of another aggregator, e.g. from another ping worker.
+        Both aggregators must use the same accuracy.
+        """
+        for name, stats in other._stats.items():
+            self._merge_stats(name, stats)
+        for name in set(other._buckets) | set(other._pending):
+            other._merge_buckets(name)
+            self._pending.setdefault(name, []).append(other._buckets[name])
+            self._merge_buckets(name)
+
+    def summary(self, date: str, asn: int = None) -> pd.DataFrame:
+        """
+        :param date: date of the run
+        :param asn: (optional) ASN the destinations belong to
+        :return: one row per (hop_type, group_by, key) with the columns of `SUMMARY_COLUMNS`
+        """
+        dfs = []
+        for (hop_type, group), stats in self._stats.items():
+            self._merge_buckets((hop_type, group))
+            df = stats.copy()
+            df['loss_rate'] = 1 - df['responses'] / df['probes']
+            df['mean_rtt'] = df['rtt_sum'] / df['responses'].replace(0, np.nan)
+            df['min_rtt'] = df['rtt_min']
+            df['max_rtt'] = df['rtt_max']
+            for name, q in QUANTILES.items():
+                estimate = self._quantile((hop_type, group), df['responses'], q)
+                df[name] = estimate.reindex(df.index).clip(df['min_rtt'], df['max_rtt'])
+            df = df.reset_index()
+            df['date'] = str(date)
+            df['asn'] = asn
+            df['hop_type'] = hop_type
+            df['group_by'] = group
+            dfs.append(df[SUMMARY_COLUMNS])
+
+        if len(dfs) == 0:
+            return pd.DataFrame(columns=SUMMARY_COLUMNS)
+        return pd.concat(dfs, ignore_index=True)
+
+    def _merge_stats(self, name: tuple, stats: pd.DataFrame) -> None:
+        if name in self._stats:
+            stats = pd.concat([self._stats[name], stats]).groupby(level=0).agg({
+                'probes': 'sum', 'responses': 'sum', 'rtt_min': 'min', 'rtt_max': 'max', 'rtt_sum': 'sum'})
+        self._stats[name] = stats
+
+    def _merge_buckets(self, name: tuple) -> None:
+        counts = self._pending.pop(name, [])
+        if name in self._buckets:
+            counts.append(self._buckets[name])
+        counts = [c for c in counts if len(c) > 0]
+        if len(counts) == 0:
+            self._buckets[name] = pd.Series(dtype=np.int64)
+            return
+        self._buckets[name] = pd.concat(counts).groupby(level=[0, 1]).sum()
+
+    def _quantile(self, name: tuple, responses: pd.Series, q: float) -> pd.Series:
+        # the q-quantile is the value of the first bucket whose cumulative
+        # count exceeds rank q * (n - 1)
+        counts = self._buckets.get(name)
+        if counts is None or len(counts) == 0:
+            return pd.Series(dtype=np.float64)
+        counts = counts.sort_index()
+        keys = counts.index.get_level_values(0)
+        buckets = counts.index.get_level_values(1).to_numpy()
+        cumulative = counts.groupby(level=0).cumsum().to_numpy()
+        rank = q * (responses.reindex(keys).to_numpy() - 1)
+        hit = cumulative > rank
+        first = pd.Series(buckets[hit], index=keys[hit]).groupby(level=0).first()
+        return 2 * self.gamma ** first.astype(np.float64) / (self.gamma + 1)
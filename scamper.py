@@ -14,102 +14,506 @@ See the License for the specific language governing permissions and
 limitations under the License.
 '''
 
+import os
 import pandas as pd
 import subprocess
-import tempfile
+import sys
+import threading
 import time
-from data_parse import aggregate_data
-from bq_upload import upload_ping_file
+import metrics
+from datetime import date
+from data_parse import CHUNK_SIZE, PING_COLUMNS, ColumnBuffer, compact_pings, concat_pings, expand_pings, get_last_hops_from_paris_tr, ping_row
+from rtt_stats import RttAggregator
+from bq_upload import BigQueryUploader
+from checkpoint import PingCheckpoint
+from scamper_engine import ScamperEngine
+from storage import write_parquet
+from warts import HEADER as WARTS_HEADER, TYPE_TRACE as WARTS_TRACE
 
-def run_paris_trs(ip_file: str, output_file: str) -> None:
+# seconds after a round is sent before all of its replies are assumed to have
+# arrived (scamper's trace wait timeout defaults to 5 seconds)
+RESULT_TIMEOUT = 10
+
+# probe list columns that are not hop types
+PROBE_INFO_COLUMNS = ('ip', 'sec_last_ip', 'slot', 'slots')
+
+# targets written to scamper's stdin at a time
+TARGET_BATCH = 1000
+
+def run_paris_trs(ips, output, shards: int = 1, pps: int = None, window: int = None, scamper_format: str = "json") -> None:
     """
-    Run an ICMP paris-traceroute to every IP address in a given file.
+    Run an ICMP paris-traceroute to every IP address given.
+
+    The IPs can be split across several scamper workers, each reading its
+    targets from stdin. Each worker gets an equal share of the global `pps`
+    budget, and their outputs are merged into `output` record by record
+    (JSON lines or warts objects) as the traces finish.
 
-    :param ip_file: file path string to a new-line delimited list of IPs to run traceroutes to
-    :param output_file: file path string to .json file to output traceroute data
+    :param ips: iterable of IPs, or file path string to a new-line delimited list of IPs
+    :param output: file path string to the .json (or .warts) file to output
+    traceroute data, or a binary file object (e.g. a pipe) to write it to
+    :param shards: (optional) number of scamper workers to split the IPs across
+    (at most `pps`, so every worker gets at least 1 pps)
+    :param pps: (optional) global packets-per-second limit across all workers
+    (default is scamper's own default per worker)
+    :param window: (optional) maximum number of traces each worker runs at once
+    :param scamper_format: (optional) "json" or "warts", the format scamper writes
+    (see `warts` for the decoder)
     """
 
-    cmd_str = "scamper -O json -o " + output_file + " -c \"trace -P icmp-paris -q 1 \" " + ip_file
+    if scamper_format not in ("json", "warts"):
+        raise Exception("Unsupported scamper output format: " + str(scamper_format))
+    started = metrics.start_stage()
+    if isinstance(ips, (str, os.PathLike)):
+        with open(ips) as f:
+            ips = [line.strip() for line in f if line.strip()]
+    else:
+        ips = [str(ip) for ip in ips]
+    shards = max(1, min(shards, len(ips)))
+    if pps:
+        # every shard needs at least 1 pps of the budget
+        shards = min(shards, pps)
+
+    cmd = ["scamper", "-O", scamper_format]
+    if pps:
+        cmd += ["-p", str(pps // shards)]
+    if window:
+        cmd += ["-w", str(window)]
+    # "-" makes scamper read its targets from stdin
+    cmd += ["-c", "trace -P icmp-paris -q 1", "-"]
+
+    lock = threading.Lock()
+    completed = [0]
+    report_every = max(len(ips) // 10, 1)
+
+    def count_trace():
+        completed[0] += 1
+        if completed[0] % report_every == 0:
+            print("traceroutes: {}/{} done".format(completed[0], len(ips)))
+
+    def merge_json(proc):
+        for line in proc.stdout:
+            with lock:
+                out.write(line)
+                if line[:32].replace(b" ", b"").startswith(b'{"type":"trace"'):
+                    count_trace()
+
+    def merge_warts(proc):
+        # warts objects are written whole so the outputs do not interleave
+        while True:
+            header = proc.stdout.read(WARTS_HEADER.size)
+            if len(header) < WARTS_HEADER.size:
+                break
+            _, obj_type, length = WARTS_HEADER.unpack(header)
+            body = proc.stdout.read(length)
+            with lock:
+                out.write(header + body)
+                if obj_type == WARTS_TRACE:
+                    count_trace()
+
+    merge_records = merge_warts if scamper_format == "warts" else merge_json
+
+    def merge(proc):
+        try:
+            merge_records(proc)
+        except OSError:
+            # the output was closed (e.g. the reader of a pipe stopped), so
+            # stop scamper rather than leave it blocked on a full stdout
+            proc.kill()
+
+    def feed(proc, targets):
+        # scamper reads its targets as its window frees up, so they are
+        # written from their own thread while its output is read
+        try:
+            for i in range(0, len(targets), TARGET_BATCH):
+                proc.stdin.write(("\n".join(targets[i:i + TARGET_BATCH]) + "\n").encode())
+            proc.stdin.flush()
+        except BrokenPipeError:
+            # scamper exited early; the merged output shows what it traced
+            pass
+        finally:
+            try:
+                proc.stdin.close()
+            except BrokenPipeError:
+                pass
+
+    out = open(output, "wb") if isinstance(output, (str, os.PathLike)) else output
     try:
-        subprocess.run(
-                cmd_str, 
-                shell=True, 
-        )
-    except ValueError:
-        raise Exception("Invalid command: " + cmd_str)
-
-def ttl_ping (sec_last: bool, input_file: str, output_destination: str, ttl: int, ping_len: int, ping_interval: int = 1, upload_to_bq: bool = False, bq_table_id: str = None) -> pd.DataFrame:
+        procs = [subprocess.Popen(cmd, stdin=subprocess.PIPE, stdout=subprocess.PIPE) for _ in range(shards)]
+        threads = [threading.Thread(target=feed, args=(p, ips[i::shards])) for i, p in enumerate(procs)]
+        readers = [threading.Thread(target=merge, args=(p,)) for p in procs]
+        for t in threads + readers:
+            t.start()
+        for t, p in zip(readers, procs):
+            t.join()
+            p.wait()
+        for t in threads:
+            t.join()
+    except (OSError, ValueError):
+        raise Exception("Invalid command: " + " ".join(cmd))
+    finally:
+        if out is not output:
+            out.close()
+        metrics.finish_stage("run_paris_trs", started, {"shards": shards},
+                             destinations=len(ips), traces=completed[0], pps=pps)
+
+def trace_last_hops(ips, shards: int = 1, pps: int = None, window: int = None, scamper_format: str = "json") -> pd.DataFrame:
+    """
+    Run `run_paris_trs` and extract the last hops of the traces (see
+    `data_parse.get_last_hops_from_paris_tr`) as they arrive, through a pipe
+    rather than a file.
+
+    :param ips: iterable of IPs to run traceroutes to
+    :return: dataframe of the last hops of every trace
+    """
+    read_fd, write_fd = os.pipe()
+    errors = []
+
+    def trace():
+        try:
+            with open(write_fd, "wb") as out:
+                run_paris_trs(ips, out, shards, pps, window, scamper_format)
+        except Exception as e:
+            errors.append(e)
+
+    tracer = threading.Thread(target=trace)
+    tracer.start()
+    try:
+        # closing the read end stops the traces if parsing fails
+        with open(read_fd, "rb") as source:
+            last_hops = get_last_hops_from_paris_tr(source)
+    finally:
+        tracer.join()
+    if len(errors) > 0:
+        raise errors[0]
+    return last_hops
+
+def plan_ttl_probes(df: pd.DataFrame) -> pd.DataFrame:
+    """
+    Build the probe list for `ttl_ping`: one row per destination carrying its
+    own TTLs for the second-to-last hop (`sec_last_hop`) and the last hop
+    (`hop_count`) found in its paris-traceroute, and the second-to-last hop's
+    IP the RTT summaries are grouped by.
+
+    :param df: dataframe constructed from `paris_traceroute_exposed_services`
+    :return: dataframe with columns 'ip', 'sec_last_ip', 'sec_last' and 'last'
+    """
+    probes = df.drop_duplicates('ip')
+    return pd.DataFrame({
+        'ip': probes['ip'].values,
+        'sec_last_ip': probes['sec_last_ip'].values,
+        'sec_last': probes['sec_last_hop'].astype(int).values,
+        'last': probes['hop_count'].astype(int).values,
+    })
+
+def save_rtt_summary(summary: pd.DataFrame, destination: str, upload_to_bq: bool = False, bq_table_id: str = None, output_format: str = 'csv', asn: int = None) -> None:
+    """
+    Write the RTT summaries of a ping run (see `rtt_stats.RttAggregator.summary`).
+
+    :param summary: summary dataframe
+    :param destination: CSV file to append to, or the parquet store directory
+    :param upload_to_bq: (optional) upload to bigquery instead of writing `destination`
+    :param bq_table_id: (optional) BigQuery table ID of the summary table
+    :param output_format: (optional) 'csv' or 'parquet'
+    :param asn: (optional) ASN the IPs belong to, used to partition parquet output
+    """
+    if len(summary) == 0:
+        return
+    if upload_to_bq:
+        if bq_table_id is not None:
+            with BigQueryUploader() as uploader:
+                uploader.submit(bq_table_id, "rtt_summary", summary)
+    elif destination is not None:
+        if output_format == 'parquet':
+            write_parquet(summary, destination, "rtt_summary", str(date.today()), asn)
+        else:
+            summary.to_csv(destination, header=None, index=None, mode='a')
+    print("len of rtt summary df: " + str(len(summary)))
+
+def ttl_ping (probes, output_destinations: dict, ping_len: int, ping_interval: int = 1, upload_to_bq: bool = False, bq_table_ids: dict = None, pps: int = None, start_offset: float = 0, output_format: str = 'csv', asn: int = None, path_cache=None, stats_queue=None, checkpoint_dir: str = None, scamper_format: str = "json", feed=None) -> dict:
     """
     Run ping tests using ICMP paris-traceroute with first hop and max ttl are as specified.
 
-    :param input_file: file path to ips to ping
-    :param output_dir: file path to output data to
+    A single scamper process is started in control-socket mode for the whole
+    run; every round submits one probe command per destination and TTL to
+    it, so the second-to-last and last hop of a destination are probed
+    together, and the results are streamed back over the control connection
+    and parsed into compact records as they arrive. Finished rounds are fed
+    to an on-line RTT aggregator and, when uploading to BigQuery, queued for
+    upload while probing continues.
+
+    With a checkpoint directory, every batch of parsed rounds is persisted
+    before it is uploaded. A rerun with the same directory reloads those
+    rounds, re-uploads the ones BigQuery has not committed and continues
+    probing after the last checkpointed round.
+
+    With a `feed`, destinations can join the schedule while it runs: before
+    every round the probe lists that arrived since the round before are
+    added, and each of their destinations is probed in the `ping_len` rounds
+    from the one it joins in. The run ends once the feed is exhausted and
+    every destination had all its rounds.
+
+    :param probes: probe list from `plan_ttl_probes` with an 'ip' column, an
+    optional 'sec_last_ip' column and one TTL column per hop type (or the
+    path to it as a CSV file)
+    :param output_destinations: file path to output data to, for each hop type,
+    and optionally for the "rtt_summary" table
     :param ping_len: probecount, the number of probes to send
     :param ping_interval: number of seconds between each probe
+    :param upload_to_bq: (optional) upload data to bigquery (default saves output to file)
+    :param bq_table_ids: (optional) BigQuery table ID for each hop type and
+    optionally for the "rtt_summary" table
+    :param pps: (optional) packets-per-second limit for this worker's scamper
+    :param start_offset: (optional) seconds to wait before the first round, used
+    to interleave the rounds of concurrently running workers
+    :param output_format: (optional) 'csv' appends to the output destinations;
+    'parquet' writes a partition under the output destination directories
+    :param asn: (optional) ASN the IPs belong to, used to partition parquet output
+    :param path_cache: (optional) `PathCache` whose entries are invalidated when
+    the pings show a different responder at the probed hop
+    :param stats_queue: (optional) queue to put the `RttAggregator` on instead of
+    writing the RTT summaries, so the caller can merge those of several workers
+    :param checkpoint_dir: (optional) directory to checkpoint this worker's rounds in
+    :param scamper_format: (optional) "json" or "warts", the format scamper sends results in
+    :param feed: (optional) function called before every round that returns a
+    list of the probe lists (as `probes`) that arrived since the last call, or
+    None once no more will arrive; cannot be combined with `checkpoint_dir`
+    :return: dataframe of ping results for each hop type, as compact records
+    (see `data_parse.COMPACT_PING_DTYPES`)
     """
 
-    processes = []
-    output_dir = {}
-    for seq in range(1, ping_len + 1):
-        output_dir[seq] = scamper_output_file = tempfile.NamedTemporaryFile(mode='w+', suffix='.json')
+    if feed is not None and checkpoint_dir is not None:
+        raise Exception("A ping run fed with new destinations cannot be checkpointed")
+    started = metrics.start_stage()
+    if isinstance(probes, pd.DataFrame):
+        probes = probes.reset_index(drop=True)
+    else:
+        probes = pd.read_csv(probes, dtype={'ip': str})
+    hop_types = [c for c in probes.columns if c not in PROBE_INFO_COLUMNS]
+    aggregator = RttAggregator()
 
-    def append_data(process):
-        p = process["pid"]
+    def plan(probes):
+        """
+        :return: the per-destination part of every probe command and the
+        (slot, slots) in which each destination is due
+        """
+        if 'sec_last_ip' in probes.columns:
+            aggregator.pops.update(zip(probes['ip'], probes['sec_last_ip']))
+        commands = [
+            [(i, "trace -P icmp-paris -q 1 -f {ttl} -m {ttl} -U ".format(ttl=int(ttl)), " " + ip)
+             for i, ttl in enumerate(ttls)]
+            for ip, ttls in zip(probes['ip'], probes[hop_types].itertuples(index=False))
+        ]
+        # with round rotation (see `targets.reduce_targets`) a destination is
+        # only probed in the rounds its slot is due
+        if 'slot' in probes.columns:
+            due = list(zip(probes['slot'], probes['slots']))
+        else:
+            due = [(0, 1)] * len(probes)
+        return commands, due
 
-        # process isn't finished yet, keep in processes list
-        if p.poll() is None:
-            return True
+    destinations = len(probes)
+    commands, due = plan(probes)
 
-        p.wait()
-        output_dir[process["seq"]].seek(0)
+    # every command is a single probe; they are counted per hop type once
+    # they are written to scamper
+    probes_sent = [0] * len(hop_types)
 
-        return False
+    def counter(i):
+        def count():
+            probes_sent[i] += 1
+        return count
+    count_sent = [counter(i) for i in range(len(hop_types))]
 
-    # create temporary output files then aggregate at the end
-    for seq in range(1, ping_len + 1):
-        start_time = time.time()
-        scamper_output_file = output_dir[seq]
-        scamper_output_file.flush()
+    # the userid of each probe encodes its round and hop type
+    def userid(seq, i):
+        return seq * len(hop_types) + i
 
-        try:
-            cmd_str = "scamper -O json -o " + scamper_output_file.name + " -c \"trace -P icmp-paris -q 1" + " -f " + str(ttl) + " -m " + str(ttl) + " \" " + input_file
-            p = subprocess.Popen(
-                cmd_str, 
-                shell=True, 
-            )
-            processes.append({
-                "pid": p,
-                "seq": seq
-            })
-        except ValueError:
-            continue
-        processes = list(filter(append_data, processes))
-
-        to_sleep = ping_interval - (time.time() - start_time)
-        if to_sleep > 0:
-            time.sleep(to_sleep)
-
-    while len(processes) > 0:
-        processes = list(filter(append_data, processes))
-
-    df = aggregate_data(output_dir)
-
-	# cleanup files
-    for seq in range(1, ping_len + 1):
-        output_dir[seq].close()
-
-    if sec_last:
-        print("len of sec_last_pings df: " + str(len(df)))
-    else:
-        print("len of last_pings df: " + str(len(df)))
+    # results of each (hop type, round) are parsed as they arrive into typed
+    # column buffers, which are converted to compact chunks as they fill up
+    buffers = {}
+    chunks = {}
+    buffer_rows = max(min(CHUNK_SIZE, destinations), 1)
+    sent_at = {}
+    # seconds between each round's scheduled and actual send time
+    jitter = {}
 
-    if upload_to_bq:
-        with tempfile.NamedTemporaryFile(mode='w+') as temp_csv:
-            temp_csv.flush()
-            df.to_csv(temp_csv.name, header=False, index=False)
-            temp_csv.seek(0)
-            upload_ping_file(bq_table_id, temp_csv.name)
-    else:
-        df.to_csv(output_destination, header=None, index=None, mode='a')
+    # a round counts as sent once its last command is written to scamper,
+    # which can be later than its deadline when scamper is short of capacity
+    def round_sent(rnd, seqs, deadline):
+        jitter[rnd] = time.monotonic() - deadline
+        for seq in seqs:
+            sent_at[seq] = time.time()
+    dfs = {hop_type: [] for hop_type in hop_types}
+
+    uploader = BigQueryUploader() if upload_to_bq else None
+
+    def add_rounds(batch, path=None):
+        for hop_type, df in batch.items():
+            dfs[hop_type].append(df)
+            aggregator.update(df, hop_type)
+            if uploader is not None and not (path is not None and checkpoint.committed(path, hop_type)):
+                on_loaded = None
+                if path is not None:
+                    on_loaded = lambda path=path, hop_type=hop_type: checkpoint.mark_committed(path, hop_type)
+                uploader.submit(bq_table_ids[hop_type], "pings", df, on_loaded)
+
+    checkpoint = None
+    first_seq = 1
+    if checkpoint_dir is not None:
+        checkpoint = PingCheckpoint(checkpoint_dir)
+        for path in checkpoint.chunks():
+            add_rounds(checkpoint.load(path), path)
+        first_seq = checkpoint.last_round() + 1
+        if first_seq > 1:
+            print("resuming pings after round {} of {}".format(first_seq - 1, ping_len))
+
+    def append_data(record):
+        if record.get('type') != 'trace':
+            return
+        seq, i = divmod(record.get('userid', 0), len(hop_types))
+        if not 1 <= seq <= ping_len:
+            return
+        buf = buffers.get((i, seq))
+        if buf is None:
+            buf = buffers[(i, seq)] = ColumnBuffer(PING_COLUMNS, buffer_rows)
+        buf.append(ping_row(record, seq))
+        if buf.full():
+            chunks.setdefault((i, seq), []).append(compact_pings(buf.to_frame()))
+            buf.reset()
+
+    def collect_rounds(seqs):
+        if len(seqs) == 0:
+            return
+        batch = {}
+        for i, hop_type in enumerate(hop_types):
+            parsed = []
+            for seq in seqs:
+                parsed += chunks.pop((i, seq), [])
+                buf = buffers.pop((i, seq), None)
+                if buf is not None and buf.n > 0:
+                    parsed.append(compact_pings(buf.to_frame()))
+            batch[hop_type] = concat_pings(parsed)
+        path = checkpoint.save(seqs, batch) if checkpoint is not None else None
+        add_rounds(batch, path)
+
+    # a worker that finished before already wrote its file output and summaries
+    finished_before = checkpoint is not None and checkpoint.done()
+    if finished_before:
+        first_seq = ping_len + 1
+    scamper_errors = 0
+    if first_seq <= ping_len:
+        # destinations are probed in cohorts that joined the schedule in the
+        # same round; in round k a cohort with base b is in its round k + b
+        cohorts = [(first_seq, commands, due)]
+        feeding = feed is not None
+        with ScamperEngine(on_record=append_data, pps=pps, output_format=scamper_format) as engine:
+            # rounds fire at absolute deadlines on the monotonic clock, so time
+            # spent submitting or reading results never shifts later rounds
+            first_round = time.monotonic() + start_offset
+            k = 0
+            while True:
+                deadline = first_round + k * ping_interval
+                engine.run_until(deadline)
+                if feeding:
+                    arrived = feed()
+                    if arrived is None:
+                        feeding = False
+                    for new in arrived or []:
+                        new = new.reset_index(drop=True)
+                        destinations += len(new)
+                        buffer_rows = max(min(CHUNK_SIZE, destinations), 1)
+                        cohorts.append((1 - k,) + plan(new))
+                cohorts = [c for c in cohorts if k + c[0] <= ping_len]
+                if len(cohorts) == 0:
+                    if not feeding:
+                        break
+                    k += 1
+                    continue
+
+                round_commands = []
+                seqs = set()
+                for base, cohort_commands, cohort_due in cohorts:
+                    seq = k + base
+                    seqs.add(seq)
+                    for (slot, slots), dst_commands in zip(cohort_due, cohort_commands):
+                        if (seq - 1) % slots != slot:
+                            continue
+                        for i, prefix, target in dst_commands:
+                            round_commands.append((i, prefix + str(userid(seq, i)) + target))
+                rnd = k + first_seq
+                if len(round_commands) == 0:
+                    round_sent(rnd, seqs, deadline)
+                else:
+                    for i, command in round_commands[:-1]:
+                        engine.submit(command, count_sent[i])
+                    i, command = round_commands[-1]
+
+                    def last_sent(i=i, rnd=rnd, seqs=seqs, deadline=deadline):
+                        count_sent[i]()
+                        round_sent(rnd, seqs, deadline)
+                    engine.submit(command, last_sent)
+
+                # rounds older than RESULT_TIMEOUT have all their replies; parse
+                # them while probing continues
+                finished = [s for s, t in sent_at.items() if time.time() - t > RESULT_TIMEOUT]
+                for s in finished:
+                    del sent_at[s]
+                if len(finished) > 0:
+                    collect_rounds(finished)
+                k += 1
+
+            engine.run_until(first_round + k * ping_interval)
+            engine.drain()
+            scamper_errors = engine.errors
+            if scamper_errors > 0:
+                sys.stderr.write("scamper rejected {} ping commands, latest errors: {}\n".format(
+                    scamper_errors, "; ".join(engine.error_messages)))
+
+    if len(jitter) > 0:
+        print("round send jitter: mean {:.2f} ms, max {:.2f} ms".format(
+            1000 * sum(jitter.values()) / len(jitter), 1000 * max(jitter.values())))
+
+    # late replies to already collected rounds are picked up here as well
+    collect_rounds(list(range(first_seq, ping_len + 1)))
+    if uploader is not None:
+        uploader.close()
+
+
+    results = {}
+    for i, hop_type in enumerate(hop_types):
+        df = concat_pings(dfs[hop_type])
+        df.attrs['round_jitter'] = jitter
+        results[hop_type] = df
+
+        if path_cache is not None:
+            path_cache.check_pings(df, hop_type == "sec_last")
+
+        print("len of " + hop_type + "_pings df: " + str(len(df)))
+        metrics.record("ttl_ping_hop", {"asn": asn, "hop_type": hop_type},
+                       probes_sent=probes_sent[i], rows=len(df),
+                       responses=int(df['ip_at_ttl'].notna().sum()))
+
+        if not upload_to_bq and not finished_before:
+            if output_format == 'parquet':
+                write_parquet(df, output_destinations[hop_type], "pings", str(date.today()), asn, hop_type)
+            else:
+                expand_pings(df).to_csv(output_destinations[hop_type], header=None, index=None, mode='a')
+
+    if checkpoint is not None:
+        checkpoint.mark_done()
+
+    metrics.finish_stage("ttl_ping", started, {"asn": asn},
+                         destinations=destinations, rounds_sent=len(jitter), probes_sent=sum(probes_sent),
+                         pps=pps, scamper_errors=scamper_errors,
+                         jitter_mean_ms=1000 * sum(jitter.values()) / len(jitter) if len(jitter) > 0 else None,
+                         jitter_max_ms=1000 * max(jitter.values()) if len(jitter) > 0 else None)
+
+    if stats_queue is not None:
+        stats_queue.put(aggregator)
+    elif not finished_before:
+        save_rtt_summary(aggregator.summary(str(date.today()), asn),
+                         output_destinations.get("rtt_summary"), upload_to_bq,
+                         (bq_table_ids or {}).get("rtt_summary"), output_format, asn)
 
-    return df
+    return results
@@ -0,0 +1,251 @@
+'''
+Copyright 2023 The Board of Trustees of The Leland Stanford Junior University
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+'''
+
+import json
+import os
+import selectors
+import shutil
+import socket
+import subprocess
+import tempfile
+import time
+from collections import deque
+from typing import Callable
+from warts import StreamDecoder
+
+class ScamperEngine:
+    """
+    A long-lived scamper process running in control-socket mode (`scamper -U`).
+
+    Probe commands are queued with `submit` and written to the control socket
+    whenever scamper signals that it can take more work (`MORE`). Results are
+    streamed back over the same connection, as JSON or as uuencoded warts,
+    and handed to `on_record` as decoded records as they arrive.
+
+    Commands scamper rejects (`ERR`) are counted in `errors`, with their
+    messages in `error_messages`. A connection that closes before scamper
+    reported `EOF` means scamper died and raises an exception, so partial
+    results are never taken for a finished run.
+    """
+
+    def __init__(self, on_record: Callable[[dict], None] = None, pps: int = None,
+                 scamper_bin: str = "scamper", socket_path: str = None,
+                 start_timeout: float = 10, output_format: str = "json") -> None:
+        """
+        :param on_record: callback invoked with every record, a dict shaped
+        like scamper's JSON output in both formats
+        :param pps: (optional) packets-per-second limit passed to scamper with `-p`
+        :param scamper_bin: (optional) path to the scamper executable
+        :param socket_path: (optional) unix socket path (default is a fresh temp dir)
+        :param start_timeout: (optional) seconds to wait for the control socket to appear
+        :param output_format: (optional) "json" or "warts", the format scamper sends results in
+        """
+        if output_format not in ("json", "warts"):
+            raise Exception("Unsupported scamper output format: " + str(output_format))
+        self.on_record = on_record
+        self.output_format = output_format
+        self.pps = pps
+        self.scamper_bin = scamper_bin
+        self.socket_path = socket_path
+        self.start_timeout = start_timeout
+
+        self.proc = None
+        self.sock = None
+        self.selector = None
+        self._temp_dir = None
+        self._buf = bytearray()
+        self._data_len = None
+        self._pending = deque()
+        self._credit = 0
+        self._eof = False
+        self._attached = False
+        self.errors = 0
+        self.error_messages = deque(maxlen=10)
+        self._warts = StreamDecoder() if output_format == "warts" else None
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+    def start(self) -> None:
+        """
+        Launch scamper, connect to its control socket and attach with the output format.
+        """
+        if self.socket_path is None:
+            self._temp_dir = tempfile.mkdtemp(prefix="scamper-")
+            self.socket_path = os.path.join(self._temp_dir, "scamper.sock")
+
+        cmd = [self.scamper_bin, "-U", self.socket_path]
+        if self.pps:
+            cmd += ["-p", str(self.pps)]
+        self.proc = subprocess.Popen(cmd)
+
+        deadline = time.monotonic() + self.start_timeout
+        while True:
+            try:
+                self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+                self.sock.connect(self.socket_path)
+                break
+            except (FileNotFoundError, ConnectionRefusedError):
+                self.sock.close()
+                if self.proc.poll() is not None or time.monotonic() > deadline:
+                    self.close()
+                    raise Exception("Could not connect to scamper control socket: " + self.socket_path)
+                time.sleep(0.05)
+
+        self.selector = selectors.DefaultSelector()
+        self.selector.register(self.sock, selectors.EVENT_READ)
+        self.sock.sendall(b"attach format " + self.output_format.encode() + b"\n")
+
+    def submit(self, command: str, on_sent: Callable[[], None] = None) -> None:
+        """
+        Queue a scamper command (e.g. `trace -P icmp-paris -q 1 1.2.3.4`).
+        The command is written as soon as scamper has capacity for it.
+
+        :param command: scamper command
+        :param on_sent: (optional) function called without arguments once the
+        command has been written to the control socket
+        """
+        self._pending.append((command, on_sent))
+        self._flush()
+
+    def run_for(self, timeout: float) -> None:
+        """
+        Service the control socket (send queued commands, read results) until
+        `timeout` seconds have passed.
+        """
+        self.run_until(time.monotonic() + timeout)
+
+    def run_until(self, deadline: float) -> None:
+        """
+        Service the control socket until the `time.monotonic()` clock reaches
+        `deadline`. The wait is event driven: the process sleeps in `select`
+        until data arrives or the deadline passes.
+        """
+        while not self._eof:
+            self._poll(max(deadline - time.monotonic(), 0))
+            if time.monotonic() >= deadline:
+                break
+
+    def drain(self) -> None:
+        """
+        Send every queued command, tell scamper no more are coming and read
+        results until scamper reports that all tasks have finished.
+        """
+        while self._pending and not self._eof:
+            self._poll(None)
+        if not self._eof:
+            self._send(b"done\n")
+        while not self._eof:
+            self._poll(None)
+
+    def close(self) -> None:
+        """
+        Close the control connection and stop the scamper process.
+        """
+        if self.selector is not None:
+            self.selector.close()
+            self.selector = None
+        if self.sock is not None:
+            self.sock.close()
+            self.sock = None
+        if self.proc is not None:
+            if self.proc.poll() is None:
+                self.proc.terminate()
+            self.proc.wait()
+            self.proc = None
+        if self._temp_dir is not None:
+            shutil.rmtree(self._temp_dir, ignore_errors=True)
+            self._temp_dir = None
+
+    def _flush(self) -> None:
+        while self._credit > 0 and self._pending:
+            command, on_sent = self._pending.popleft()
+            self._send((command + "\n").encode())
+            self._credit -= 1
+            if on_sent is not None:
+                on_sent()
+
+    def _send(self, data: bytes) -> None:
+        try:
+            self.sock.sendall(data)
+        except ConnectionError:
+            self._connection_lost()
+
+    def _connection_lost(self) -> None:
+        self._eof = True
+        try:
+            code = self.proc.wait(timeout=self.start_timeout)
+        except subprocess.TimeoutExpired:
+            code = None
+        raise Exception("scamper closed the control socket before EOF (exit code {})".format(code))
+
+    def _poll(self, timeout: float) -> None:
+        for _ in self.selector.select(timeout):
+            try:
+                chunk = self.sock.recv(65536)
+            except ConnectionError:
+                chunk = b""
+            if not chunk:
+                self._connection_lost()
+            self._buf += chunk
+            self._parse()
+        self._flush()
+
+    def _parse(self) -> None:
+        while True:
+            if self._data_len is not None:
+                if len(self._buf) < self._data_len:
+                    return
+                data = bytes(self._buf[:self._data_len])
+                del self._buf[:self._data_len]
+                self._data_len = None
+                if self.on_record is not None:
+                    for line in data.splitlines():
+                        if not line.strip():
+                            continue
+                        if self._warts is not None:
+                            for record in self._warts.feed_uu(line):
+                                self.on_record(record)
+                        else:
+                            self.on_record(json.loads(line))
+                continue
+
+            idx = self._buf.find(b"\n")
+            if idx < 0:
+                return
+            line = self._buf[:idx].decode().strip()
+            del self._buf[:idx + 1]
+
+            if line == "MORE":
+                self._credit += 1
+            elif line.startswith("DATA "):
+                self._data_len = int(line.split()[1])
+            elif line == "EOF":
+                self._eof = True
+                return
+            elif line.startswith("ERR"):
+                if not self._attached:
+                    # no credit ever comes for a connection scamper did not attach
+                    raise Exception("scamper rejected attach format {}: {}".format(self.output_format, line))
+                self.errors += 1
+                self.error_messages.append(line)
+            elif line.startswith("OK"):
+                # the first acknowledgement is the one of `attach`
+                self._attached = True
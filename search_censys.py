@@ -15,12 +15,133 @@ limitations under the License.
 '''
 
 
+import queue
 import sys
-from censys.search import CensysCerts, CensysHosts
+import threading
+from bq_upload import get_client
+from concurrent.futures import ThreadPoolExecutor
 from datetime import date
 from ipaddress import ip_address, IPv4Address, IPv6Address
+from typing import Iterator
 
-def search_censys(asn: int, ipv: int = None):
+# pages buffered per search worker before it waits for the consumer
+PREFETCH_PAGES = 4
+
+# seconds to wait before retrying a failed search, times the attempt number
+RETRY_DELAY = 5
+
+def iter_censys_hosts(asn: int, ipv: int = None, prefixes: list = None, max_workers: int = 4, client=None, since: str = None, retries: int = 3) -> Iterator[dict]:
+    """
+    Queries Censys for the hosts in the specified ASN and yields them as their
+    pages arrive.
+
+    Censys result pages are chained by cursor, so a single query can only be
+    read one page at a time; a background worker prefetches the following
+    pages while earlier ones are processed. Passing `prefixes` (e.g. the
+    ASN's announced CIDRs) splits the search into one query per prefix, and up
+    to `max_workers` of them are paged through in parallel.
+
+    A query whose page fails to load is run again up to `retries` times,
+    skipping the pages it already handed over. When the retries are used up,
+    the generator raises rather than return an incomplete host list.
+
+    :param asn: the autonomous system number
+    :param ipv: (optional) specify 4 or 6 to filter for IP version
+    :param prefixes: (optional) IP prefixes to split the search by
+    :param max_workers: (optional) number of queries paged through at once
+    :param client: (optional) object with a `CensysHosts.search`-like `search` method
+    :param since: (optional) only return hosts Censys updated on or after this date (YYYY-MM-DD)
+    :param retries: (optional) number of times a failed query is run again
+    :return: generator of host dicts with keys 'ip', 'ports' and 'dns_name'
+    """
+    if client is None:
+        # imported here so runs reading the BigQuery dataset never load the Censys SDK
+        from censys.search import CensysHosts
+        client = CensysHosts()
+
+    queries = ["autonomous_system.asn:" + str(asn)]
+    if since is not None:
+        queries = [queries[0] + " and last_updated_at:[" + str(since) + " TO *]"]
+    if prefixes:
+        queries = [queries[0] + " and ip:" + str(prefix) for prefix in prefixes]
+
+    pages = queue.Queue(maxsize=PREFETCH_PAGES * min(max_workers, len(queries)))
+    done = object()
+    stop = threading.Event()
+
+    def put(item):
+        while not stop.is_set():
+            try:
+                pages.put(item, timeout=0.1)
+                return
+            except queue.Full:
+                continue
+
+    def fetch(query):
+        # pages are chained by cursor, so a retried query is read from its
+        # first page again and the pages handed over before are skipped
+        delivered = 0
+        try:
+            for attempt in range(retries + 1):
+                try:
+                    for i, page in enumerate(client.search(query, pages=-1)):
+                        if stop.is_set():
+                            return
+                        if i < delivered:
+                            continue
+                        put(page)
+                        delivered += 1
+                    return
+                except Exception as e:
+                    if attempt == retries:
+                        put(Exception("Could not search Censys for {} after {} retries: {}".format(query, retries, e)))
+                        return
+                    sys.stderr.write("{}\t could not search {}, retry {} of {}\n".format(e, query, attempt + 1, retries))
+                    stop.wait(RETRY_DELAY * (attempt + 1))
+        finally:
+            put(done)
+
+    executor = ThreadPoolExecutor(max_workers=max_workers)
+    for query in queries:
+        executor.submit(fetch, query)
+
+    try:
+        remaining = len(queries)
+        while remaining > 0:
+            page = pages.get()
+            if page is done:
+                remaining -= 1
+                continue
+            if isinstance(page, Exception):
+                raise page
+            for entry in page:
+                try:
+                    # filter IPv if specified
+                    version = type(ip_address(entry['ip']))
+                    if ((ipv == 4 and version is not IPv4Address) or
+                        (ipv == 6 and version is not IPv6Address)):
+                        continue
+
+                    # get DNS name if it exists
+                    try:
+                        dns_name = entry['dns']['reverse_dns']['names']
+                    except (KeyError, TypeError):
+                        dns_name = []
+
+                    yield {
+                        'ip': entry['ip'],
+                        'ports': [service['port'] for service in entry['services']],
+                        'dns_name': dns_name,
+                    }
+                except Exception as e:
+                    sys.stderr.write(str(e) + "\t could not get ip " + str(entry) + "\n")
+    finally:
+        # let workers still waiting to hand over a page exit
+        stop.set()
+        executor.shutdown(wait=False)
+
+
+def search_censys(asn: int, ipv: int = None, prefixes: list = None, max_workers: int = 4, client=None, since: str = None, retries: int = 3):
     """
     Queries Censys for all exposed services (IP, port) for the specified ASN.
 
@@ -30,11 +151,14 @@ def search_censys(asn: int, ipv: int = None):
     :param asn: the autonomous system number
     :param ipv: (optional) specify 4 or 6 to filter for IP version 
     (default is no filter)
+    :param prefixes: (optional) IP prefixes to split the search by, see `iter_censys_hosts`
+    :param max_workers: (optional) number of queries paged through at once
+    :param client: (optional) object with a `CensysHosts.search`-like `search` method
+    :param since: (optional) only return hosts Censys updated on or after this date (YYYY-MM-DD)
+    :param retries: (optional) number of times a failed query is run again
     :return: list of exposed ip/port
     """ 
 
-    h = CensysHosts()
-    c = CensysCerts()
     exposed_services = {
         'date': [],
         'asn': [],
@@ -44,55 +168,74 @@ def search_censys(asn: int, ipv: int = None):
         'pep_link': [],
     }
 
-    # certs_queried = {}
+    # label hosts using pep-link 
+    # (not queried because costly in # of queries; it needs a CensysCerts
+    # lookup of services.tls.certificates.leaf_data.subject_dn per service)
+    pep_link = None
 
-    # search Censys for services matching asn
-    for page in h.search("autonomous_system.asn:" + str(asn), pages=-1):
-        for entry in page:
-            try:
-                for service in entry['services']:
-                    # filter IPv if specified
-                    if (((ipv == 4) and type(ip_address(entry['ip'])) is not IPv4Address) or 
-                        ((ipv == 6) and type(ip_address(entry['ip'])) is not IPv6Address)):
-                        continue
-
-                    # get DNS name if it exists
-                    dns_name = []
-                    # FIXME
-                    try: 
-                        dns_name = entry['dns']['reverse_dns']['names']
-                    except:
-                        dns_name = []
-
-                    # label hosts using pep-link 
-                    # (commented out because costly in # of queries)
-                    pep_link = None
-                    # try:
-                    #     # services.tls.certificates.leaf_data.subject_dn
-                    #     certificate = service['certificate']
-                    #     cert = ""
-                    #     if certificate in certs_queried:
-                    #         cert = certs_queried[certificate]
-                    #     else:
-                    #         cert = c.raw_search(certificate)
-                    #         certs_queried[certificate] = cert
-                    #         print(certificate)
-
-                    #     subject_dn = cert['result']['hits'][0]['parsed']['subject_dn']
-                    #     if 'peplink' in subject_dn.lower():
-                    #         pep_link = True
-                    # except:
-                    #     pep_link = False
-
-                    exposed_services['asn'].append(asn)
-                    exposed_services['ip'].append(entry['ip'])
-                    exposed_services['port'].append(service['port'])
-                    exposed_services['dns_name'].append(dns_name)
-                    exposed_services['pep_link'].append(pep_link) 
-
-            except Exception as e:
-                sys.stderr.write(str(e) + "\t could not get ip")
-                sys.stderr.write(str(entry))
+    for host in iter_censys_hosts(asn, ipv, prefixes, max_workers, client, since, retries):
+        for port in host['ports']:
+            exposed_services['asn'].append(asn)
+            exposed_services['ip'].append(host['ip'])
+            exposed_services['port'].append(port)
+            exposed_services['dns_name'].append(host['dns_name'])
+            exposed_services['pep_link'].append(pep_link) 
 
     exposed_services['date'] = [str(date.today())] * len(exposed_services['ip'])
     return exposed_services
+
+
+def censys_bq_query(asn: int, ipv: int, table: str) -> str:
+    """
+    Builds the query for the exposed services of an ASN in the Censys
+    universal dataset on BigQuery.
+
+    :param asn: the autonomous system number
+    :param ipv: specify 6 to select IPv6 addresses (default is IPv4)
+    :param table: the BigQuery table to pull data from
+    :return: SQL query string
+    """
+    ip_col = 'host_identifier.ipv6' if ipv == 6 else 'host_identifier.ipv4'
+    return (
+        'SELECT DISTINCT '
+        '    {ip_col} as ip, '
+        '    CURRENT_DATE() as date, '
+        '    {asn} as asn, '
+        '    dns.reverse_dns.names as dns_name, '
+        '    ports_list as port, '
+        '    ARRAY( '
+        '     SELECT '
+        '      CASE '
+        '        WHEN LOWER(service.tls.certificates.leaf_data.subject_dn) LIKE "%peplink%" '
+        '        THEN TRUE '
+        '        ELSE FALSE '
+        '      END '
+        '     FROM UNNEST(services) AS service '
+        '   ) AS pep_link '
+        'FROM `{table}` '
+        'WHERE '
+        '    autonomous_system.asn={asn} AND '
+        '    TIMESTAMP_TRUNC(snapshot_date, DAY) = TIMESTAMP(DATE_SUB(CURRENT_DATE, INTERVAL 2 DAY)) '  # we can only guarantee that censys's data from yesterday is available , reverse dns names take another day to populate in dataset
+        '    AND host_identifier.ipv4 IS NOT NULL '
+    ).format(ip_col=ip_col, asn=asn, table=table)
+
+
+def iter_censys_bq(asn: int, ipv: int, table: str, page_size: int = 50000, client=None) -> Iterator:
+    """
+    Runs the Censys universal dataset query and yields the result one page
+    at a time, so only one page of hosts is held in memory.
+
+    :param asn: the autonomous system number
+    :param ipv: specify 6 to select IPv6 addresses (default is IPv4)
+    :param table: the BigQuery table to pull data from
+    :param page_size: (optional) number of rows per page
+    :param client: (optional) BigQuery client, defaults to the shared client
+    :return: generator of dataframes with at most `page_size` rows
+    """
+    if client is None:
+        client = get_client()
+    query_job = client.query(censys_bq_query(asn, ipv, table))  # API request
+    rows = query_job.result(page_size=page_size)  # Waits for query to finish
+    for df in rows.to_dataframe_iterable():
+        if len(df) > 0:
+            yield df
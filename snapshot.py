@@ -0,0 +1,159 @@
+'''
+Copyright 2023 The Board of Trustees of The Leland Stanford Junior University
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+'''
+
+"""
+Local snapshots of the exposed services of an ASN, one Parquet file per
+(asn, date). Each snapshot row holds an IP's ports and reverse DNS names from
+Censys together with its last paris-traceroute result, plus the dates the IP
+was last returned by Censys (`last_seen`) and last traced (`last_traced`).
+"""
+
+import glob
+import os
+import zlib
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+from datetime import date, timedelta
+from storage import EXPOSED_SERVICES_SCHEMA, to_arrow_table
+
+SNAPSHOT_SCHEMA = EXPOSED_SERVICES_SCHEMA \
+    .append(pa.field("last_seen", pa.date32())) \
+    .append(pa.field("last_traced", pa.date32()))
+
+LAST_HOP_COLUMNS = ['stop_reason', 'hop_count', 'sec_last_ip', 'sec_last_hop']
+
+
+class SnapshotStore:
+
+    def __init__(self, base_dir: str) -> None:
+        """
+        :param base_dir: directory to keep snapshots in
+        """
+        self.base_dir = base_dir
+        os.makedirs(base_dir, exist_ok=True)
+
+    def path(self, asn: int, day: str) -> str:
+        return os.path.join(self.base_dir, "asn=" + str(asn), str(day) + ".parquet")
+
+    def save(self, asn: int, day: str, df: pd.DataFrame) -> None:
+        """
+        Write (or replace) the snapshot of `asn` for `day`.
+        """
+        path = self.path(asn, day)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        pq.write_table(to_arrow_table(df, SNAPSHOT_SCHEMA), path + ".tmp", compression="zstd")
+        os.replace(path + ".tmp", path)
+
+    def load(self, asn: int, day: str) -> pd.DataFrame:
+        """
+        :return: the snapshot of `asn` for `day`, or None if there is none
+        """
+        path = self.path(asn, day)
+        if not os.path.exists(path):
+            return None
+        df = pq.read_table(path, schema=SNAPSHOT_SCHEMA).to_pandas()
+        for col in ['date', 'last_seen', 'last_traced']:
+            df[col] = df[col].astype(str).where(df[col].notna(), None)
+        return df
+
+    def latest(self, asn: int, before: str = None) -> tuple:
+        """
+        Find the most recent snapshot of `asn`.
+
+        :param asn: the autonomous system number
+        :param before: (optional) only consider snapshots strictly before this date
+        :return: (date, dataframe), or (None, None) if there is no snapshot
+        """
+        days = sorted(
+            os.path.basename(p)[:-len(".parquet")]
+            for p in glob.glob(os.path.join(self.base_dir, "asn=" + str(asn), "*.parquet"))
+        )
+        if before is not None:
+            days = [d for d in days if d < str(before)]
+        if len(days) == 0:
+            return None, None
+        return days[-1], self.load(asn, days[-1])
+
+    def mark_full(self, asn: int, day: str) -> None:
+        """
+        Record that the snapshot of `asn` for `day` is built from a full
+        Censys query rather than a delta, so every host still reported got a
+        fresh `last_seen`.
+        """
+        path = self.path(asn, day)[:-len(".parquet")] + ".full"
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        open(path, "w").close()
+
+    def last_full(self, asn: int, before: str = None) -> str:
+        """
+        :param asn: the autonomous system number
+        :param before: (optional) only consider snapshots strictly before this date
+        :return: the date of the most recent saved snapshot built from a full
+        query, or None if there is none
+        """
+        days = sorted(
+            os.path.basename(p)[:-len(".full")]
+            for p in glob.glob(os.path.join(self.base_dir, "asn=" + str(asn), "*.full"))
+        )
+        # a full query whose snapshot was never saved refreshed nothing
+        days = [d for d in days if os.path.exists(self.path(asn, d))]
+        if before is not None:
+            days = [d for d in days if d < str(before)]
+        return days[-1] if len(days) > 0 else None
+
+
+def merge_delta(previous: pd.DataFrame, delta: pd.DataFrame, today: str, max_age_days: int = 7) -> pd.DataFrame:
+    """
+    Combine the hosts Censys reported as updated since the previous snapshot
+    with the hosts carried over from that snapshot. Carried-over hosts that
+    Censys has not reported for more than `max_age_days` are dropped; hosts
+    that never change are only reported by a full query, so one must be run
+    more often than that (see `SnapshotStore.last_full`).
+
+    :param previous: previous snapshot (may be None)
+    :param delta: exposed services returned by the delta query
+    :param today: date of the new snapshot
+    :param max_age_days: (optional) days a host is kept without being reported
+    :return: exposed services dataframe with a `last_seen` column
+    """
+    delta = delta.copy()
+    delta['last_seen'] = str(today)
+    if previous is None or len(previous) == 0:
+        return delta
+
+    oldest = str(date.fromisoformat(str(today)) - timedelta(days=max_age_days))
+    carried = previous[~previous['ip'].isin(delta['ip']) & (previous['last_seen'] >= oldest)]
+    carried = carried[[c for c in delta.columns if c in carried.columns]].copy()
+    carried['date'] = str(today)
+    return pd.concat([delta, carried], ignore_index=True)
+
+
+def due_for_retrace(ips: pd.Series, today: str, rotation_days: int) -> pd.Series:
+    """
+    Pick the known IPs whose turn it is to be traced again. Every IP is
+    assigned a fixed day in a `rotation_days` cycle, so all known IPs are
+    re-traced once per cycle, spread evenly across days.
+
+    :param ips: IP addresses
+    :param today: date of the run
+    :param rotation_days: length of the rotation cycle in days
+    :return: boolean series aligned with `ips`
+    """
+    if rotation_days <= 1:
+        return pd.Series(True, index=ips.index)
+    slot = date.fromisoformat(str(today)).toordinal() % rotation_days
+    return ips.apply(lambda ip: zlib.crc32(str(ip).encode()) % rotation_days == slot)
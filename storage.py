@@ -0,0 +1,186 @@
+'''
+Copyright 2023 The Board of Trustees of The Leland Stanford Junior University
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+'''
+
+"""
+Typed columnar storage for measurement data.
+
+Tables are written as Parquet files laid out as
+
+    <base_dir>/<table>/date=<YYYY-MM-DD>/asn=<asn>/hop_type=<hop_type>/part-<id>.parquet
+
+Every file carries the full table schema (including `date`), so a single file
+can be loaded into BigQuery as is; the directory names only exist so readers
+can skip partitions without opening files.
+"""
+
+import glob
+import os
+import uuid
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+PING_SCHEMA = pa.schema([
+    pa.field("date", pa.date32()),
+    pa.field("seq", pa.int64()),
+    pa.field("dst", pa.string()),
+    pa.field("stop_reason", pa.string()),
+    pa.field("start_time", pa.timestamp("us", tz="UTC")),
+    pa.field("start_sec", pa.int64()),
+    pa.field("hop_count", pa.float64()),
+    pa.field("ip_at_ttl", pa.string()),
+    pa.field("probe_ttl", pa.float64()),
+    pa.field("rtt", pa.float64()),
+])
+
+EXPOSED_SERVICES_SCHEMA = pa.schema([
+    pa.field("ip", pa.string()),
+    pa.field("date", pa.date32()),
+    pa.field("asn", pa.int64()),
+    pa.field("dns_name", pa.list_(pa.string())),
+    pa.field("port", pa.list_(pa.int64())),
+    pa.field("pep_link", pa.list_(pa.bool_())),
+    pa.field("stop_reason", pa.string()),
+    pa.field("hop_count", pa.float64()),
+    pa.field("sec_last_ip", pa.string()),
+    pa.field("sec_last_hop", pa.float64()),
+])
+
+RTT_SUMMARY_SCHEMA = pa.schema([
+    pa.field("date", pa.date32()),
+    pa.field("asn", pa.int64()),
+    pa.field("hop_type", pa.string()),
+    pa.field("group_by", pa.string()),
+    pa.field("key", pa.string()),
+    pa.field("probes", pa.int64()),
+    pa.field("responses", pa.int64()),
+    pa.field("loss_rate", pa.float64()),
+    pa.field("min_rtt", pa.float64()),
+    pa.field("mean_rtt", pa.float64()),
+    pa.field("p50_rtt", pa.float64()),
+    pa.field("p95_rtt", pa.float64()),
+    pa.field("max_rtt", pa.float64()),
+])
+
+SCHEMAS = {
+    "pings": PING_SCHEMA,
+    "exposed_services": EXPOSED_SERVICES_SCHEMA,
+    "rtt_summary": RTT_SUMMARY_SCHEMA,
+}
+
+
+def to_arrow_table(df: pd.DataFrame, schema: pa.Schema) -> pa.Table:
+    """
+    Convert a dataframe to an arrow table with the given schema, coercing
+    date strings, timestamps and numeric columns along the way.
+
+    Compact columns are accepted as well: categoricals are decoded, integer
+    timestamps are read as epoch microseconds and float32 columns are rounded
+    to the microsecond resolution they were parsed with.
+
+    :param df: dataframe with (at least) the columns in `schema`
+    :param schema: target arrow schema
+    :return: arrow table
+    """
+    columns = {}
+    for field in schema:
+        col = df[field.name] if field.name in df.columns else pd.Series([None] * len(df), dtype=object)
+        if isinstance(col.dtype, pd.CategoricalDtype):
+            col = col.astype(object)
+        if pa.types.is_date32(field.type):
+            col = pd.to_datetime(col, errors="coerce").dt.date
+        elif pa.types.is_timestamp(field.type):
+            if pd.api.types.is_integer_dtype(col):
+                col = pd.to_datetime(col, unit="us", errors="coerce", utc=True)
+            else:
+                col = pd.to_datetime(col, errors="coerce", utc=True)
+        elif pa.types.is_integer(field.type) or pa.types.is_floating(field.type):
+            if col.dtype == "float32":
+                col = col.astype("float64").round(3)
+            col = pd.to_numeric(col, errors="coerce")
+            if pa.types.is_integer(field.type):
+                col = col.astype("Int64")
+        elif pa.types.is_list(field.type):
+            col = col.apply(lambda x: list(x) if isinstance(x, (list, tuple)) or hasattr(x, "tolist") else [])
+        columns[field.name] = pa.array(col, type=field.type, from_pandas=True)
+    return pa.Table.from_pydict(columns, schema=schema)
+
+
+def partition_dir(base_dir: str, table: str, date: str, asn: int = None, hop_type: str = None) -> str:
+    """
+    :return: directory path of a (table, date, asn, hop_type) partition
+    """
+    parts = [base_dir, table, "date=" + str(date)]
+    if asn is not None:
+        parts.append("asn=" + str(asn))
+    if hop_type is not None:
+        parts.append("hop_type=" + hop_type)
+    return os.path.join(*parts)
+
+
+def write_parquet(df: pd.DataFrame, base_dir: str, table: str, date: str, asn: int = None, hop_type: str = None) -> str:
+    """
+    Write a dataframe as a new Parquet file in its (date, asn, hop_type)
+    partition of `table`.
+
+    :param df: dataframe to write
+    :param base_dir: root directory of the columnar store
+    :param table: table name, one of `SCHEMAS`
+    :param date: partition date (YYYY-MM-DD)
+    :param asn: (optional) partition ASN
+    :param hop_type: (optional) partition hop type, e.g. "last" or "sec_last"
+    :return: path of the written file
+    """
+    out_dir = partition_dir(base_dir, table, date, asn, hop_type)
+    os.makedirs(out_dir, exist_ok=True)
+    path = os.path.join(out_dir, "part-" + uuid.uuid4().hex + ".parquet")
+    pq.write_table(to_arrow_table(df, SCHEMAS[table]), path, compression="zstd")
+    return path
+
+
+def read_parquet(base_dir: str, table: str, dates: list = None, asns: list = None, hop_types: list = None) -> pd.DataFrame:
+    """
+    Read the Parquet files of `table`, optionally restricted to some
+    partitions. The `asn` and `hop_type` partition keys are added as columns
+    when they are not already part of the table.
+
+    :param base_dir: root directory of the columnar store
+    :param table: table name, one of `SCHEMAS`
+    :param dates: (optional) dates to read
+    :param asns: (optional) ASNs to read
+    :param hop_types: (optional) hop types to read
+    :return: dataframe with the table schema's dtypes
+    """
+    def matches(values, key, path):
+        if values is None:
+            return True
+        return any("{}={}".format(key, v) in path.split(os.sep) for v in values)
+
+    schema = SCHEMAS[table]
+    dfs = []
+    for path in sorted(glob.glob(os.path.join(base_dir, table, "**", "*.parquet"), recursive=True)):
+        if not (matches(dates, "date", path) and matches(asns, "asn", path) and matches(hop_types, "hop_type", path)):
+            continue
+        df = pq.read_table(path, schema=schema).to_pandas()
+        for part in os.path.relpath(os.path.dirname(path), os.path.join(base_dir, table)).split(os.sep):
+            key, _, value = part.partition("=")
+            if key in ("asn", "hop_type") and key not in df.columns:
+                df[key] = int(value) if key == "asn" else value
+        dfs.append(df)
+
+    if len(dfs) == 0:
+        return schema.empty_table().to_pandas()
+    return pd.concat(dfs, ignore_index=True)
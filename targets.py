@@ -0,0 +1,104 @@
+'''
+Copyright 2023 The Board of Trustees of The Leland Stanford Junior University
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+'''
+
+"""
+Prefix-aware target reduction for TTL pings.
+
+Many destinations behind the same PoP measure the same path segment: they
+share the second-to-last hop, the hop count and a /24 (IPv4) or /56 (IPv6)
+prefix. `reduce_targets` groups the probe list from `plan_ttl_probes` by
+that key and keeps `per_group` representatives of every group, so the probe
+budget grows with the number of groups (the topology) rather than with the
+number of hosts.
+
+The representatives rotate so every destination is still probed over time:
+
+- "day": each day a different `per_group` members of a group are probed.
+- "round": every destination stays in the probe list with a `slot` out of
+  `slots`, and `ttl_ping` only probes the members whose slot is due in a
+  round, so a group's members take turns round by round.
+"""
+
+import zlib
+import numpy as np
+import pandas as pd
+from datetime import date
+from ipaddress import ip_network
+
+ROTATIONS = ("day", "round")
+
+GROUP_PREFIX_LEN = {4: 24, 6: 56}
+
+
+def group_prefix(ip: str) -> str:
+    """
+    :return: the /24 (IPv4) or /56 (IPv6) prefix of an IP
+    """
+    if ":" not in ip:
+        return ip.rsplit(".", 1)[0] + ".0/24"
+    return str(ip_network("{}/{}".format(ip, GROUP_PREFIX_LEN[6]), strict=False))
+
+
+def target_groups(probes: pd.DataFrame) -> pd.Series:
+    """
+    :param probes: probe list from `plan_ttl_probes`
+    :return: group number of every destination; destinations with the same
+    second-to-last hop, hop count and prefix share a group
+    """
+    key = pd.DataFrame({
+        'sec_last_ip': probes['sec_last_ip'].fillna(''),
+        'last': probes['last'],
+        'prefix': probes['ip'].map(group_prefix),
+    })
+    return pd.Series(key.groupby(list(key.columns), sort=False).ngroup().to_numpy(), index=probes.index)
+
+
+def reduce_targets(probes: pd.DataFrame, per_group: int = 1, rotate: str = "day", day: str = None) -> pd.DataFrame:
+    """
+    Keep `per_group` representatives of every group of destinations.
+
+    Members of a group are ordered by a hash of their IP and dealt into
+    `ceil(size / per_group)` slots, so a slot holds at most `per_group`
+    members and the slots are balanced.
+
+    :param probes: probe list from `plan_ttl_probes`
+    :param per_group: (optional) destinations probed per group at a time
+    :param rotate: (optional) "day" keeps the slot of `day`; "round" keeps
+    every destination and adds the `slot` and `slots` columns `ttl_ping`
+    rotates through
+    :param day: (optional) date (YYYY-MM-DD) the "day" rotation is for, default today
+    :return: the reduced probe list
+    """
+    if rotate not in ROTATIONS:
+        raise Exception("Unsupported target rotation: " + str(rotate))
+    if per_group < 1:
+        raise Exception("per_group must be at least 1")
+    if len(probes) == 0:
+        return probes
+
+    groups = target_groups(probes)
+    order = probes['ip'].map(lambda ip: zlib.crc32(ip.encode()))
+    rank = pd.DataFrame({'group': groups, 'order': order}).groupby('group')['order'].rank(method='first').astype(np.int64) - 1
+    slots = (groups.map(groups.value_counts()) + per_group - 1) // per_group
+    slot = rank % slots
+
+    if rotate == "round":
+        return probes.assign(slot=slot.to_numpy(), slots=slots.to_numpy())
+
+    day = date.fromisoformat(day) if day is not None else date.today()
+    keep = slot == day.toordinal() % slots
+    print("probing {} of {} destinations ({} groups)".format(int(keep.sum()), len(probes), groups.nunique()))
+    return probes[keep].reset_index(drop=True)
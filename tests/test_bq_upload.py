@@ -0,0 +1,117 @@
+'''
+Copyright 2023 The Board of Trustees of The Leland Stanford Junior University
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+'''
+
+"""
+Tests for `bq_upload.BigQueryUploader` against a fake BigQuery client:
+batching per table, retries and the callbacks of committed frames.
+"""
+
+import threading
+
+import pandas as pd
+import pyarrow.parquet as pq
+import pytest
+from google.cloud.exceptions import BadRequest
+
+from bq_upload import BigQueryUploader
+
+
+class FakeJob:
+    def __init__(self, error: Exception = None) -> None:
+        self.error = error
+        self.errors = [{"message": str(error)}] if error is not None else None
+
+    def result(self):
+        if self.error is not None:
+            raise self.error
+
+
+class FakeClient:
+    """
+    Records the rows of every load job; the first loads fail with the
+    given errors.
+    """
+
+    def __init__(self, failures: list = None) -> None:
+        self.failures = list(failures or [])
+        self.attempts = 0
+        self.loads = []
+        self.lock = threading.Lock()
+
+    def load_table_from_file(self, buf, table_id, job_config=None):
+        with self.lock:
+            self.attempts += 1
+            if len(self.failures) > 0:
+                return FakeJob(self.failures.pop(0))
+            self.loads.append((table_id, pq.read_table(buf).to_pandas()))
+            return FakeJob()
+
+
+def pings(*dsts) -> pd.DataFrame:
+    return pd.DataFrame({"date": "2023-11-14", "seq": 1, "dst": list(dsts), "rtt": 12.5})
+
+
+def test_frames_are_batched_per_table():
+    client = FakeClient()
+    loaded = []
+    uploader = BigQueryUploader(client, batch_rows=4, backoff=0)
+    uploader.submit("ds.last", "pings", pings("192.0.2.1", "192.0.2.2"), lambda: loaded.append(1))
+    uploader.submit("ds.sec_last", "pings", pings("192.0.2.3"), lambda: loaded.append(2))
+    uploader.submit("ds.last", "pings", pings("192.0.2.4", "192.0.2.5"), lambda: loaded.append(3))
+    uploader.submit("ds.last", "pings", pings(), lambda: loaded.append(4))
+    uploader.close()
+
+    # the two frames of ds.last reach batch_rows and share one load job;
+    # close loads the rest
+    assert sorted((table_id, len(df)) for table_id, df in client.loads) == [("ds.last", 4), ("ds.sec_last", 1)]
+    assert sorted(loaded) == [1, 2, 3, 4]
+    assert sorted(s["rows"] for s in uploader.stats) == [1, 4]
+
+
+def test_failed_loads_are_retried():
+    client = FakeClient([Exception("backend error"), Exception("backend error")])
+    loaded = []
+    with BigQueryUploader(client, backoff=0) as uploader:
+        uploader.submit("ds.last", "pings", pings("192.0.2.1"), lambda: loaded.append(1))
+
+    assert client.attempts == 3
+    assert len(client.loads) == 1
+    assert uploader.stats[0]["attempts"] == 3
+    assert loaded == [1]
+
+
+def test_uploader_gives_up_after_max_retries():
+    client = FakeClient([Exception("backend error")] * 3)
+    loaded = []
+    uploader = BigQueryUploader(client, max_retries=3, backoff=0)
+    uploader.submit("ds.last", "pings", pings("192.0.2.1"), lambda: loaded.append(1))
+
+    with pytest.raises(Exception, match="backend error"):
+        uploader.close()
+    assert client.attempts == 3
+    assert loaded == []
+
+
+def test_bad_requests_are_not_retried():
+    client = FakeClient([BadRequest("no such field: rtt")])
+    loaded = []
+    uploader = BigQueryUploader(client, backoff=0)
+    uploader.submit("ds.last", "pings", pings("192.0.2.1"), lambda: loaded.append(1))
+
+    with pytest.raises(BadRequest, match="no such field"):
+        uploader.close()
+    assert client.attempts == 1
+    assert loaded == []
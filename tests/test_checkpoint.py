@@ -0,0 +1,88 @@
+'''
+Copyright 2023 The Board of Trustees of The Leland Stanford Junior University
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+'''
+
+"""
+Tests for the run manifests and ping checkpoints of `checkpoint`.
+"""
+
+import pandas as pd
+import pytest
+
+from checkpoint import STAGE_SCHEMAS, PingCheckpoint, RunManifest
+from data_parse import compact_pings
+
+
+def pings(seq: int) -> pd.DataFrame:
+    return compact_pings(pd.DataFrame({
+        "date": ["2023-11-14"], "seq": [seq], "dst": ["192.0.2.1"], "stop_reason": ["COMPLETED"],
+        "start_time": ["2023-11-14 10:00:00"], "start_sec": [1699956000], "hop_count": [5.0],
+        "ip_at_ttl": ["100.64.0.1"], "probe_ttl": [5.0], "rtt": [12.5],
+    }))
+
+
+def test_manifest_survives_a_restart(tmp_path):
+    manifest = RunManifest(str(tmp_path / "run"))
+    assert not manifest.done("exposed_services")
+    manifest.complete("exposed_services", rows=3)
+
+    reloaded = RunManifest(str(tmp_path / "run"))
+    assert reloaded.done("exposed_services")
+    assert reloaded.stages["exposed_services"]["rows"] == 3
+    assert not reloaded.done("traceroute")
+    with pytest.raises(Exception, match="Unknown run stage"):
+        reloaded.complete("upload")
+
+
+def test_stage_frames_keep_their_own_columns(tmp_path):
+    manifest = RunManifest(str(tmp_path / "run"))
+    df = pd.DataFrame({"ip": ["192.0.2.1"], "date": ["2023-11-14"], "asn": [800],
+                       "dns_name": [["a.example.net"]], "port": [[80, 443]], "pep_link": [[]]})
+    manifest.save_frame("exposed_services", df)
+
+    loaded = manifest.load_frame("exposed_services")
+    assert list(loaded.columns) == ["ip", "date", "asn", "dns_name", "port", "pep_link"]
+    assert "sec_last_ip" not in loaded.columns
+    assert loaded["port"].iloc[0] == [80, 443]
+
+    # incremental runs keep the date Censys last reported each host
+    df["last_seen"] = "2023-11-10"
+    manifest.save_frame("exposed_services", df)
+    loaded = manifest.load_frame("exposed_services")
+    assert list(loaded.columns) == STAGE_SCHEMAS["exposed_services"].names
+    assert loaded["last_seen"].iloc[0] == "2023-11-10"
+
+
+def test_ping_chunks(tmp_path):
+    checkpoint = PingCheckpoint(str(tmp_path / "worker-0-of-1"))
+    assert checkpoint.last_round() == 0
+    first = checkpoint.save([1, 2], {"last": pings(1), "sec_last": pings(2)})
+    # late replies of rounds that already have a chunk get a chunk of their own
+    late = checkpoint.save([1, 2], {"last": pings(2)})
+    third = checkpoint.save([3], {"last": pings(3)})
+
+    chunks = checkpoint.chunks()
+    assert sorted(chunks[:2]) == sorted([first, late]) and chunks[2] == third
+    assert checkpoint.last_round() == 3
+    loaded = checkpoint.load(first)
+    assert sorted(loaded) == ["last", "sec_last"]
+    pd.testing.assert_frame_equal(loaded["sec_last"], pings(2))
+
+    assert not checkpoint.committed(first, "last")
+    checkpoint.mark_committed(first, "last")
+    assert checkpoint.committed(first, "last") and not checkpoint.committed(first, "sec_last")
+    assert not checkpoint.done()
+    checkpoint.mark_done()
+    assert PingCheckpoint(checkpoint.checkpoint_dir).done()
@@ -0,0 +1,349 @@
+'''
+Copyright 2023 The Board of Trustees of The Leland Stanford Junior University
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+'''
+
+"""
+Tests for how `DataCollection` splits the probe list and the packets-per-second
+budget between its ping workers, with the worker processes replaced by a
+fake that records what each would have been started with, and for resuming
+checkpointed runs.
+"""
+
+import multiprocessing
+import os
+import threading
+import time
+from datetime import date, timedelta
+from queue import Empty
+
+import pandas as pd
+import pyarrow.parquet as pq
+import pytest
+
+import data_collection
+from checkpoint import RunManifest
+from data_collection import DataCollection
+from data_parse import get_last_hops_from_paris_tr
+from rtt_stats import RttAggregator
+from snapshot import due_for_retrace
+from storage import EXPOSED_SERVICES_SCHEMA, to_arrow_table
+
+
+class FakeProcess:
+    started = []
+    exitcode = 0
+
+    def __init__(self, target, args):
+        self.args = args
+
+    def start(self):
+        FakeProcess.started.append(self.args)
+
+    def is_alive(self):
+        return False
+
+    def join(self):
+        pass
+
+
+class FakeQueue:
+    def get(self, timeout=None):
+        raise Empty
+
+
+@pytest.fixture
+def workers(monkeypatch):
+    FakeProcess.started = []
+    monkeypatch.setattr(data_collection, "Process", FakeProcess)
+    monkeypatch.setattr(data_collection, "Queue", FakeQueue)
+    return FakeProcess.started
+
+
+def traceroutes(n: int) -> pd.DataFrame:
+    return pd.DataFrame({
+        "ip": ["192.0.2.{}".format(i) for i in range(n)],
+        "sec_last_ip": "100.64.0.1",
+        "sec_last_hop": 4,
+        "hop_count": 5,
+        "stop_reason": "COMPLETED",
+        "asn": 800,
+    })
+
+
+def test_ping_workers_fit_the_pps_budget(tmp_path, workers):
+    dc = DataCollection(data_dir=str(tmp_path))
+
+    dc.ping_exposed_services(traceroutes(10), max_concurrency=8, max_pps=3)
+
+    # 3 workers of 1 pps each rather than 8 workers of 1 pps
+    assert len(workers) == 3
+    assert [args[6] for args in workers] == [1, 1, 1]
+    assert sum(len(args[0]) for args in workers) == 10
+
+
+def test_resumed_workers_must_fit_the_pps_budget(tmp_path, workers):
+    dc = DataCollection(data_dir=str(tmp_path))
+    checkpoint_dir = tmp_path / "pings"
+    for i in range(4):
+        (checkpoint_dir / "worker-{}-of-4".format(i)).mkdir(parents=True)
+
+    with pytest.raises(Exception, match="2 pps"):
+        dc.ping_exposed_services(traceroutes(10), max_concurrency=2, max_pps=2, checkpoint_dir=str(checkpoint_dir))
+    assert workers == []
+
+    dc.ping_exposed_services(traceroutes(10), max_concurrency=2, max_pps=9, checkpoint_dir=str(checkpoint_dir))
+    assert [args[6] for args in workers] == [2, 2, 2, 2]
+
+
+def test_pipelined_budget_covers_every_stage(tmp_path):
+    dc = DataCollection(data_dir=str(tmp_path))
+
+    with pytest.raises(Exception, match="1 pps"):
+        dc.run_pipelined(800, max_pps=1)
+
+
+def exposed_services(n: int) -> pd.DataFrame:
+    return pd.DataFrame({
+        "ip": ["192.0.2.{}".format(i) for i in range(n)],
+        "date": str(date.today()),
+        "asn": 800,
+        "dns_name": [[] for _ in range(n)],
+        "port": [[443] for _ in range(n)],
+        "pep_link": [[] for _ in range(n)],
+    })
+
+
+def fake_trace_last_hops(ips, shards=1, pps=None, window=None, scamper_format="json"):
+    last_hops = get_last_hops_from_paris_tr([])
+    last_hops["dst"] = list(ips)
+    last_hops["stop_reason"] = "COMPLETED"
+    last_hops["hop_count"] = 5.0
+    last_hops["sec_last_ip"] = "100.64.0.1"
+    last_hops["sec_last_hop"] = 4.0
+    return last_hops
+
+
+@pytest.mark.parametrize("legacy", [False, True])
+def test_trace_stage_resumes_from_discovery_checkpoint(tmp_path, monkeypatch, legacy):
+    monkeypatch.setattr(data_collection, "trace_last_hops", fake_trace_last_hops)
+    dc = DataCollection(data_dir=str(tmp_path))
+    manifest = RunManifest(str(tmp_path / "runs" / "800" / "run"))
+    if legacy:
+        # checkpoints written before the stages had their own schemas carry
+        # empty traceroute columns
+        pq.write_table(to_arrow_table(exposed_services(3), EXPOSED_SERVICES_SCHEMA), manifest.path("exposed_services.parquet"))
+    else:
+        manifest.save_frame("exposed_services", exposed_services(3))
+    manifest.complete("exposed_services", rows=3)
+
+    dc.run_checkpointed(800, run_id="run", stages=("traceroute",))
+
+    tr_df = RunManifest(manifest.run_dir).load_frame("traceroute")
+    assert sorted(tr_df["ip"]) == ["192.0.2.0", "192.0.2.1", "192.0.2.2"]
+    assert list(tr_df.columns) == EXPOSED_SERVICES_SCHEMA.names
+    assert (tr_df["sec_last_ip"] == "100.64.0.1").all()
+
+
+def test_failed_ping_workers_leave_the_stage_incomplete(tmp_path, monkeypatch):
+    def ttl_ping(*args):
+        raise Exception("scamper failed")
+
+    monkeypatch.setattr(data_collection, "ttl_ping", ttl_ping)
+    dc = DataCollection(data_dir=str(tmp_path))
+    manifest = RunManifest(str(tmp_path / "runs" / "800" / "run"))
+    manifest.save_frame("exposed_services", exposed_services(3))
+    manifest.complete("exposed_services", rows=3)
+    tr_df = exposed_services(3).merge(fake_trace_last_hops(exposed_services(3)["ip"]), left_on="ip", right_on="dst")
+    manifest.save_frame("traceroute", tr_df.drop(columns=["dst"]))
+    manifest.complete("traceroute", rows=3)
+
+    with pytest.raises(Exception, match="Ping workers of AS800 failed"):
+        dc.run_checkpointed(800, run_id="run", stages=("pings",), max_concurrency=2)
+    assert not RunManifest(manifest.run_dir).done("pings")
+    assert multiprocessing.active_children() == []
+
+
+def censys_services(ips: list) -> dict:
+    return {"date": [str(date.today())] * len(ips), "asn": [800] * len(ips), "ip": list(ips),
+            "port": [443] * len(ips), "dns_name": [[] for _ in ips], "pep_link": [None] * len(ips)}
+
+
+def seed_snapshot(dc: DataCollection, ips: list) -> str:
+    """
+    Save yesterday's snapshot of AS800 as built from a full query, with a
+    traced path through 100.64.0.9 for each IP.
+    """
+    yesterday = str(date.today() - timedelta(days=1))
+    df = exposed_services(len(ips))
+    df["ip"] = ips
+    df["date"] = yesterday
+    df = df.assign(stop_reason="COMPLETED", hop_count=5.0, sec_last_ip="100.64.0.9", sec_last_hop=4.0,
+                   last_seen=yesterday, last_traced=yesterday)
+    dc.snapshots.save(800, yesterday, df)
+    dc.snapshots.mark_full(800, yesterday)
+    return yesterday
+
+
+def test_checkpointed_run_discovers_and_traces_incrementally(tmp_path, monkeypatch):
+    searches, traced = [], []
+
+    def search_censys(asn, ipv=None, prefixes=None, since=None):
+        searches.append(since)
+        return censys_services(["192.0.2.1", "192.0.2.9"])
+
+    def trace_last_hops(ips, shards=1, pps=None, window=None, scamper_format="json"):
+        traced.extend(ips)
+        return fake_trace_last_hops(ips)
+
+    monkeypatch.setattr(data_collection, "search_censys", search_censys)
+    monkeypatch.setattr(data_collection, "trace_last_hops", trace_last_hops)
+    dc = DataCollection(data_dir=str(tmp_path))
+    yesterday = seed_snapshot(dc, ["192.0.2.1", "192.0.2.2"])
+
+    dc.run_checkpointed(800, run_id="run", stages=("exposed_services", "traceroute"),
+                        incremental=True, rotation_days=3)
+
+    # only the delta since yesterday's snapshot is queried; the unchanged
+    # host is carried over with the date Censys last reported it
+    assert searches == [yesterday]
+    manifest = RunManifest(str(tmp_path / "runs" / "800" / "run"))
+    discovered = manifest.load_frame("exposed_services").set_index("ip")
+    assert discovered.loc["192.0.2.2", "last_seen"] == yesterday
+    assert discovered.loc["192.0.2.9", "last_seen"] == str(date.today())
+
+    # the new host is traced; known hosts only on their rotation day
+    known = pd.Series(["192.0.2.1", "192.0.2.2"])
+    due = set(known[due_for_retrace(known, str(date.today()), 3)])
+    assert sorted(traced) == sorted({"192.0.2.9"} | due)
+    tr_df = manifest.load_frame("traceroute").set_index("ip")
+    for ip in ("192.0.2.1", "192.0.2.2"):
+        assert tr_df.loc[ip, "sec_last_ip"] == ("100.64.0.1" if ip in due else "100.64.0.9")
+    snapshot = dc.snapshots.load(800, str(date.today()))
+    assert sorted(snapshot["ip"]) == ["192.0.2.1", "192.0.2.2", "192.0.2.9"]
+    assert snapshot.set_index("ip").loc["192.0.2.2", "last_seen"] == yesterday
+
+
+def test_bq_discovery_merges_its_pages_with_the_snapshot(tmp_path, monkeypatch):
+    def iter_censys_bq(asn, ipv, table, page_size=50000, client=None):
+        for ips in (["192.0.2.1"], ["192.0.2.9"]):
+            page = exposed_services(1)
+            page["ip"] = ips
+            yield page
+
+    monkeypatch.setattr(data_collection, "iter_censys_bq", iter_censys_bq)
+    dc = DataCollection(data_dir=str(tmp_path))
+    yesterday = seed_snapshot(dc, ["192.0.2.1", "192.0.2.2"])
+
+    df = dc.get_censys_exposed_services(800, 4, "censys.base", incremental=True)
+
+    assert sorted(df["ip"]) == ["192.0.2.1", "192.0.2.2", "192.0.2.9"]
+    assert df.set_index("ip").loc["192.0.2.2", "last_seen"] == yesterday
+    assert df.set_index("ip").loc["192.0.2.9", "last_seen"] == str(date.today())
+    assert dc.snapshots.last_full(800) is not None
+    # outside incremental mode the pages are only joined
+    assert sorted(dc.get_censys_exposed_services(800, 4, "censys.base")["ip"]) == ["192.0.2.1", "192.0.2.9"]
+
+
+@pytest.fixture
+def pipeline(tmp_path, monkeypatch):
+    """
+    Fake Censys pages of 5 hosts and traceroutes, and a ttl_ping that logs
+    which process started a ping run and how many destinations it was
+    handed, first and through its feed.
+    """
+    log = tmp_path / "pings.log"
+
+    def iter_censys_exposed_services(self, asn, ipv=None, bq=None, page_size=50000, prefixes=None):
+        hosts = exposed_services(23)
+        for start in range(0, len(hosts), page_size):
+            yield hosts.iloc[start:start + page_size]
+
+    def paris_traceroute_exposed_services(self, df, ip_col, upload_to_bq=True, shards=1, pps=None, append_output=False):
+        return df.merge(fake_trace_last_hops(df[ip_col]), left_on=ip_col, right_on="dst").drop(columns=["dst"])
+
+    def ttl_ping(probes, output_destinations, ping_len, ping_interval, upload_to_bq, bq_table_ids, pps,
+                 start_offset, output_format, asn, path_cache, stats_queue, checkpoint_dir, scamper_format, feed):
+        batches = [probes]
+        with open(str(log), "a") as f:
+            f.write("{} start\n".format(os.getpid()))
+        while True:
+            arrived = feed()
+            if arrived is None:
+                break
+            batches += arrived
+            time.sleep(0.01)
+        aggregator = RttAggregator()
+        for batch in batches:
+            if len(batch) == 0:
+                raise Exception("empty batch")
+            with open(str(log), "a") as f:
+                f.write("{} {}\n".format(os.getpid(), len(batch)))
+            aggregator.update(pd.DataFrame({"dst": batch["ip"], "rtt": 20.0}), "last")
+        stats_queue.put(aggregator)
+
+    monkeypatch.setattr(DataCollection, "iter_censys_exposed_services", iter_censys_exposed_services)
+    monkeypatch.setattr(DataCollection, "paris_traceroute_exposed_services", paris_traceroute_exposed_services)
+    monkeypatch.setattr(data_collection, "ttl_ping", ttl_ping)
+    return log
+
+
+def pipeline_threads() -> list:
+    return [t.name for t in threading.enumerate() if t.name.startswith("pipeline-")]
+
+
+def test_pipeline_reuses_its_ping_workers(tmp_path, pipeline):
+    dc = DataCollection(data_dir=str(tmp_path))
+
+    dc.run_pipelined(800, batch_size=5, max_concurrency=2)
+
+    lines = [line.split() for line in pipeline.read_text().splitlines()]
+    starts = [int(pid) for pid, size in lines if size == "start"]
+    pids, sizes = zip(*((int(pid), int(size)) for pid, size in lines if size != "start"))
+    # 5 batches, but only ever the 2 workers started for the run, each
+    # feeding its batches into a single ping run
+    assert sorted(sizes) == [3, 5, 5, 5, 5]
+    assert len(set(pids)) <= 2 and os.getpid() not in pids
+    assert sorted(starts) == sorted(set(pids))
+    # the workers' aggregators are merged into one summary of every destination
+    summary = pd.read_csv(dc._ping_outputs()[0]["rtt_summary"], header=None)
+    assert sorted(summary[4]) == sorted(exposed_services(23)["ip"])
+    assert pipeline_threads() == []
+    assert multiprocessing.active_children() == []
+
+
+def test_pipeline_stops_every_stage_on_failure(tmp_path, pipeline, monkeypatch):
+    def paris_traceroute_exposed_services(self, df, ip_col, upload_to_bq=True, shards=1, pps=None, append_output=False):
+        raise Exception("scamper failed")
+
+    monkeypatch.setattr(DataCollection, "paris_traceroute_exposed_services", paris_traceroute_exposed_services)
+    dc = DataCollection(data_dir=str(tmp_path))
+
+    with pytest.raises(Exception, match="scamper failed"):
+        dc.run_pipelined(800, batch_size=5, max_concurrency=2, queue_size=1)
+    assert pipeline_threads() == []
+    assert multiprocessing.active_children() == []
+
+
+def test_pipeline_fails_when_its_ping_workers_fail(tmp_path, pipeline, monkeypatch):
+    def ttl_ping(*args):
+        raise Exception("scamper failed")
+
+    monkeypatch.setattr(data_collection, "ttl_ping", ttl_ping)
+    dc = DataCollection(data_dir=str(tmp_path))
+
+    with pytest.raises(Exception, match="[Pp]ing worker"):
+        dc.run_pipelined(800, batch_size=5, max_concurrency=2, queue_size=1)
+    assert pipeline_threads() == []
+    assert multiprocessing.active_children() == []
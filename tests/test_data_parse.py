@@ -0,0 +1,78 @@
+'''
+Copyright 2023 The Board of Trustees of The Leland Stanford Junior University
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+'''
+
+"""
+Tests for the chunked scamper parsers of `data_parse`: results must not
+depend on the chunk size, and chunks are released as they are joined.
+"""
+
+import gc
+import os
+import weakref
+
+import numpy as np
+import pandas as pd
+
+import data_parse
+from data_parse import LAST_HOPS_COLUMNS, PING_COLUMNS, aggregate_data, get_last_hops_from_paris_tr, iter_last_hops, iter_pings
+
+FIXTURES = os.path.join(os.path.dirname(os.path.abspath(__file__)), "fixtures")
+
+
+def fixture(name: str) -> str:
+    return os.path.join(FIXTURES, name)
+
+
+def test_last_hops_do_not_depend_on_chunk_size():
+    expected = get_last_hops_from_paris_tr(fixture("traces.json"))
+    chunks = list(iter_last_hops(fixture("traces.json"), chunk_size=7))
+
+    assert [len(chunk) for chunk in chunks[:-1]] == [7] * (len(chunks) - 1)
+    assert list(chunks[0].columns) == list(LAST_HOPS_COLUMNS)
+    pd.testing.assert_frame_equal(get_last_hops_from_paris_tr(fixture("traces.json"), chunk_size=7), expected)
+
+
+def test_pings_do_not_depend_on_chunk_size():
+    with open(fixture("pings.json")) as f:
+        expected = aggregate_data({1: f})
+        assert sum(len(chunk) for chunk in iter_pings({1: f}, chunk_size=5)) == len(expected)
+        pd.testing.assert_frame_equal(aggregate_data({1: f}, chunk_size=5), expected)
+
+
+def test_empty_output():
+    assert list(get_last_hops_from_paris_tr([]).columns) == list(LAST_HOPS_COLUMNS)
+    assert list(aggregate_data({}).columns) == list(PING_COLUMNS)
+
+
+def test_chunks_are_released_as_they_are_parsed():
+    alive = []
+
+    def chunks():
+        for i in range(3):
+            chunk = pd.DataFrame({"dst": np.array(["192.0.2.{}".format(i)] * 4, dtype=object),
+                                  "rtt": np.arange(4, dtype=np.float64) + i}, copy=False)
+            gc.collect()
+            # earlier chunks are dropped once their columns are taken; only
+            # the one handed over last may still be referenced
+            alive.append(sum(ref() is not None for ref in refs))
+            refs.append(weakref.ref(chunk))
+            yield chunk
+
+    refs = []
+    df = data_parse._concat_chunks(chunks(), {"dst": "str", "rtt": "float"})
+
+    assert alive == [0, 1, 1]
+    assert list(df["rtt"]) == [0, 1, 2, 3, 1, 2, 3, 4, 2, 3, 4, 5]
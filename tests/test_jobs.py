@@ -0,0 +1,104 @@
+'''
+Copyright 2023 The Board of Trustees of The Leland Stanford Junior University
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+'''
+
+"""
+Tests for the job config runner of `jobs`.
+"""
+
+import json
+
+import pytest
+
+import jobs
+
+
+def write_config(tmp_path, config: dict) -> str:
+    path = tmp_path / "jobs.json"
+    path.write_text(json.dumps(config))
+    return str(path)
+
+
+def test_load_jobs(tmp_path):
+    config = jobs.load_jobs(write_config(tmp_path, {"jobs": [{"asn": 800, "ping_len": 600}]}))
+    assert config["jobs"][0]["name"] == "as800"
+
+    invalid = [
+        {"jobs": []},
+        {"jobs": [{"name": "oneweb"}]},
+        {"jobs": [{"asn": 800}, {"asn": 800}]},
+        {"jobs": [{"asn": 800, "mode": "streaming"}]},
+        {"jobs": [{"asn": 800, "ping_length": 600}]},
+        {"jobs": [{"asn": 800, "weight": 0}]},
+    ]
+    for bad in invalid:
+        with pytest.raises(Exception):
+            jobs.load_jobs(write_config(tmp_path, bad))
+    # options of the pipelined mode only apply to pipelined jobs
+    jobs.load_jobs(write_config(tmp_path, {"jobs": [{"asn": 800, "mode": "pipelined", "batch_size": 10}]}))
+    with pytest.raises(Exception, match="batch_size"):
+        jobs.load_jobs(write_config(tmp_path, {"jobs": [{"asn": 800, "batch_size": 10}]}))
+    # snapshot-based discovery is an option of the checkpointed mode
+    jobs.load_jobs(write_config(tmp_path, {"jobs": [{"asn": 800, "incremental": True, "full_refresh_days": 2}]}))
+    with pytest.raises(Exception, match="incremental"):
+        jobs.load_jobs(write_config(tmp_path, {"jobs": [{"asn": 800, "mode": "pipelined", "incremental": True}]}))
+
+
+def test_share_budget():
+    assert jobs.share_budget([{"weight": 3}, {}], 8) == [6, 2]
+    assert jobs.share_budget([{}, {}, {}], 9000) == [3000, 3000, 3000]
+    assert jobs.share_budget([{}, {}], None) == [None, None]
+    # jobs raised to a share of 1 do not push the total over the budget
+    shares = jobs.share_budget([{"weight": 100}, {}, {}], 10)
+    assert shares == [8, 1, 1]
+    assert jobs.share_budget([{"weight": 9}, {}], 2) == [1, 1]
+    with pytest.raises(Exception, match="3 jobs"):
+        jobs.share_budget([{}, {}, {}], 2)
+
+
+def test_run_job_gets_its_own_data_dir(tmp_path, monkeypatch):
+    import data_collection
+
+    runs = []
+
+    def run_checkpointed(self, asn, max_pps=None, max_concurrency=None):
+        runs.append(self.data_dir)
+
+    monkeypatch.setattr(data_collection.DataCollection, "run_checkpointed", run_checkpointed)
+    jobs.run_job({"name": "starlink", "asn": 14593}, None, 1, str(tmp_path))
+    jobs.run_job({"name": "oneweb", "asn": 800}, None, 1, str(tmp_path))
+    jobs.run_job({"name": "custom", "asn": 800, "data_dir": str(tmp_path)}, None, 1, str(tmp_path))
+
+    assert runs == [str(tmp_path / "starlink"), str(tmp_path / "oneweb"), str(tmp_path)]
+    assert (tmp_path / "starlink" / "pings").is_dir()
+
+
+def test_run_jobs_reports_exit_codes(tmp_path, monkeypatch):
+    def run_job(job, max_pps, max_concurrency, data_dir):
+        with open(str(tmp_path / job["name"]), "w") as f:
+            json.dump([max_pps, max_concurrency, data_dir], f)
+        if job["name"] == "oneweb":
+            raise SystemExit(3)
+
+    monkeypatch.setattr(jobs, "run_job", run_job)
+    config = {"data_dir": str(tmp_path), "max_pps": 100, "max_concurrency": 4, "metrics_file": str(tmp_path / "metrics.jsonl"),
+              "jobs": [{"name": "starlink", "asn": 14593, "weight": 3}, {"name": "oneweb", "asn": 800}]}
+    try:
+        assert jobs.run_jobs(config) == {"starlink": 0, "oneweb": 3}
+    finally:
+        jobs.metrics.configure(None)
+
+    assert json.loads((tmp_path / "starlink").read_text()) == [75, 3, str(tmp_path)]
+    assert json.loads((tmp_path / "oneweb").read_text()) == [25, 1, str(tmp_path)]
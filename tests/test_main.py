@@ -0,0 +1,112 @@
+'''
+Copyright 2023 The Board of Trustees of The Leland Stanford Junior University
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+'''
+
+"""
+Tests for the command line entry point in `main` and the lazy backend
+imports it relies on.
+"""
+
+import json
+import os
+import subprocess
+import sys
+
+import pytest
+
+import main
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+BACKENDS = ("pandas", "google.cloud.bigquery", "censys.search", "data_collection")
+
+
+def imported_after(code: str) -> list:
+    """
+    :return: the backend modules a fresh interpreter has imported after running `code`
+    """
+    check = code + "\nimport sys\nprint(' '.join(m for m in {!r} if m in sys.modules))".format(BACKENDS)
+    out = subprocess.run([sys.executable, "-c", check], cwd=ROOT, capture_output=True, text=True, check=True)
+    return out.stdout.split()
+
+
+def resolve(argv: list) -> dict:
+    parser = main.build_parser()
+    return main.resolve(parser.parse_args(argv), parser)
+
+
+def test_startup_imports_no_backends():
+    assert imported_after("import main; main.build_parser().parse_args(['ping', '--asn', '800'])") == []
+
+
+def test_data_collection_does_not_load_cloud_sdks():
+    assert imported_after("import data_collection") == ["pandas", "data_collection"]
+
+
+def test_presets_and_options():
+    assert resolve(["run", "--preset", "starlink"]) == {
+        "asn": 14593, "bq": "censys-io.universal_internet_dataset_v2.base", "ping_len": 10, "ping_interval": 1}
+    # options override the preset; an empty --bq selects the Censys API
+    settings = resolve(["ping", "--preset", "starlink", "--bq", "", "--duration", "120", "--interval", "2"])
+    assert settings == {"asn": 14593, "bq": None, "ping_len": 60, "ping_interval": 2}
+    assert resolve(["ping", "--asn", "800", "--ping-len", "7"])["ping_len"] == 7
+
+
+def test_invalid_options():
+    with pytest.raises(SystemExit):
+        resolve(["trace"])
+    with pytest.raises(SystemExit):
+        resolve(["run", "--asn", "800", "--upload"])
+    with pytest.raises(SystemExit):
+        resolve(["ping", "--asn", "800", "--duration", "60", "--ping-len", "5"])
+
+
+def test_stage_needs_earlier_checkpoints(tmp_path):
+    from data_collection import DataCollection
+
+    dc = DataCollection(data_dir=str(tmp_path))
+    with pytest.raises(Exception, match="exposed_services"):
+        dc.run_checkpointed(800, stages=("traceroute",))
+
+
+def test_jobs_exit_status(tmp_path, monkeypatch):
+    config = tmp_path / "jobs.json"
+    # a job whose data directory does not exist fails in its process
+    config.write_text(json.dumps({"jobs": [{"asn": 800, "data_dir": str(tmp_path / "missing")}]}))
+    failed = subprocess.run([sys.executable, "main.py", "jobs", str(config)], cwd=ROOT, capture_output=True, text=True)
+    assert failed.returncode == 1
+    assert "failed jobs: as800" in failed.stdout
+
+    import jobs
+
+    monkeypatch.setattr(jobs, "run_jobs", lambda config: {"as800": 0})
+    main.main(["jobs", str(config)])
+
+
+def test_incremental_options_reach_the_run(tmp_path, monkeypatch):
+    import data_collection
+
+    runs = []
+    monkeypatch.setattr(data_collection.DataCollection, "run_checkpointed",
+                        lambda self, asn, ipv, bq, **kwargs: runs.append(kwargs))
+    main.main(["discover", "--asn", "800", "--data-dir", str(tmp_path), "--incremental", "--full-refresh-days", "2"])
+    main.main(["trace", "--asn", "800", "--data-dir", str(tmp_path)])
+
+    assert [(r["incremental"], r["max_age_days"], r["full_refresh_days"], r["rotation_days"]) for r in runs] == [
+        (True, 7, 2, 7), (False, 7, None, 7)]
+    with pytest.raises(SystemExit):
+        resolve(["run", "--asn", "800", "--pipelined", "--incremental"])
+    with pytest.raises(SystemExit):
+        resolve(["ping", "--asn", "800", "--incremental"])
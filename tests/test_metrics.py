@@ -0,0 +1,75 @@
+'''
+Copyright 2023 The Board of Trustees of The Leland Stanford Junior University
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+'''
+
+"""
+Tests for the JSON-lines metrics of `metrics` and their Prometheus export.
+"""
+
+import json
+import urllib.request
+
+import pytest
+
+import metrics
+
+
+@pytest.fixture
+def metrics_file(tmp_path):
+    path = str(tmp_path / "metrics.jsonl")
+    metrics.configure(path)
+    yield path
+    metrics.configure(None)
+
+
+def events(path: str) -> list:
+    with open(path) as f:
+        return [json.loads(line) for line in f]
+
+
+def test_recording_is_off_without_a_file():
+    metrics.configure(None)
+    assert not metrics.enabled()
+    metrics.record("traceroute", traces=1)
+    with metrics.stage("traceroute"):
+        pass
+
+
+def test_stage_records_resource_usage(metrics_file):
+    metrics.record("parse", {"source": "traces"}, rows=10)
+    with metrics.stage("traceroute", asn=800) as m:
+        m["traces"] = 5
+
+    parse, stage = events(metrics_file)
+    assert (parse["metric"], parse["labels"], parse["rows"]) == ("parse", {"source": "traces"}, 10)
+    assert (stage["metric"], stage["labels"], stage["traces"]) == ("traceroute", {"asn": 800}, 5)
+    for key in ("wall_seconds", "cpu_seconds", "child_cpu_seconds", "peak_rss_mb"):
+        assert stage[key] >= 0
+
+
+def test_serve_prometheus(metrics_file):
+    metrics.record("ttl_ping_hop", {"asn": 800, "hop_type": "last"}, rows=3, done=True)
+    metrics.record("ttl_ping_hop", {"asn": 800, "hop_type": "last"}, rows=7)
+    server = metrics.serve_prometheus(0, "127.0.0.1")
+    try:
+        url = "http://127.0.0.1:{}/metrics".format(server.server_address[1])
+        body = urllib.request.urlopen(url).read().decode()
+    finally:
+        server.shutdown()
+        server.server_close()
+
+    assert 'hitchhiking_ttl_ping_hop_rows{asn="800",hop_type="last"} 7' in body.splitlines()
+    assert 'hitchhiking_ttl_ping_hop_events_total{asn="800",hop_type="last"} 2' in body.splitlines()
+    assert "done" not in body
@@ -0,0 +1,113 @@
+'''
+Copyright 2023 The Board of Trustees of The Leland Stanford Junior University
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+'''
+
+"""
+Tests for the persistent traceroute path cache of `path_cache`: storing and
+looking up paths, expiry, invalidation by TTL pings and reopening the same
+SQLite file.
+"""
+
+import pandas as pd
+import pytest
+
+import path_cache
+from path_cache import PATH_COLUMNS, PathCache
+
+
+def last_hops(rows: list) -> pd.DataFrame:
+    return pd.DataFrame(rows, columns=['dst'] + PATH_COLUMNS)
+
+
+TRACES = last_hops([
+    ("192.0.2.1", "COMPLETED", 5.0, "100.64.0.1", 4.0),
+    ("192.0.2.2", "GAPLIMIT", 3.0, "100.64.0.1", 2.0),
+    ("198.51.100.1", "COMPLETED", 7.0, None, None),
+    ("2001:db8::1", "COMPLETED", 6.0, "2001:db8:ffff::1", 5.0),
+])
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    now = [1700000000.0]
+    monkeypatch.setattr(path_cache.time, "time", lambda: now[0])
+    return now
+
+
+def test_only_completed_paths_are_stored(tmp_path, clock):
+    cache = PathCache(str(tmp_path / "paths.sqlite"))
+    cache.update(TRACES)
+
+    hits = cache.lookup(["192.0.2.1", "192.0.2.2", "198.51.100.1", "2001:db8::1", "203.0.113.1"])
+
+    assert list(hits.columns) == ['dst'] + PATH_COLUMNS
+    assert sorted(hits['dst']) == ["192.0.2.1", "2001:db8::1"]
+    row = hits[hits['dst'] == "192.0.2.1"].iloc[0]
+    assert (row['hop_count'], row['sec_last_ip'], row['sec_last_hop']) == (5.0, "100.64.0.1", 4.0)
+
+
+def test_entries_expire(tmp_path, clock):
+    cache = PathCache(str(tmp_path / "paths.sqlite"), max_age=60)
+    cache.update(TRACES)
+
+    clock[0] += 60
+    assert len(cache.lookup(["192.0.2.1"])) == 1
+    clock[0] += 1
+    assert len(cache.lookup(["192.0.2.1"])) == 0
+    # a fresh trace of one destination keeps only that entry
+    cache.update(TRACES.iloc[:1])
+    assert cache.evict_expired() == 1
+    assert list(cache.lookup(["192.0.2.1", "2001:db8::1"])['dst']) == ["192.0.2.1"]
+
+
+def test_reopened_cache_keeps_its_entries(tmp_path, clock):
+    db = str(tmp_path / "paths.sqlite")
+    PathCache(db).update(TRACES)
+
+    cache = PathCache(db)
+    assert sorted(cache.lookup(["192.0.2.1", "2001:db8::1"])['dst']) == ["192.0.2.1", "2001:db8::1"]
+    cache.invalidate(["192.0.2.1"])
+    assert list(PathCache(db).lookup(["192.0.2.1", "2001:db8::1"])['dst']) == ["2001:db8::1"]
+
+
+def test_prefix_granularity(tmp_path, clock):
+    cache = PathCache(str(tmp_path / "paths.sqlite"), granularity="prefix")
+    cache.update(TRACES)
+
+    # destinations of the same /24 or /64 share the traced path
+    hits = cache.lookup(["192.0.2.77", "192.0.3.1", "2001:db8::beef", "2001:db8:0:1::1"])
+    assert sorted(hits['dst']) == ["192.0.2.77", "2001:db8::beef"]
+    assert list(hits.sort_values('dst')['sec_last_ip']) == ["100.64.0.1", "2001:db8:ffff::1"]
+
+    with pytest.raises(Exception, match="granularity"):
+        PathCache(str(tmp_path / "other.sqlite"), granularity="asn")
+
+
+def test_pings_invalidate_changed_paths(tmp_path, clock):
+    cache = PathCache(str(tmp_path / "paths.sqlite"))
+    cache.update(TRACES)
+    pings = pd.DataFrame({
+        "dst": ["192.0.2.1"] * 3 + ["2001:db8::1"] * 3,
+        "ip_at_ttl": ["100.64.0.9", "100.64.0.9", "100.64.0.1", "2001:db8:ffff::1", None, "2001:db8:ffff::1"],
+    })
+
+    # most answers of 192.0.2.1 came from another second-to-last hop
+    assert cache.check_pings(pings, sec_last=True) == ["192.0.2.1"]
+    assert list(cache.lookup(["192.0.2.1", "2001:db8::1"])['dst']) == ["2001:db8::1"]
+
+    # a last-hop ping answered by someone other than the destination
+    last = pd.DataFrame({"dst": ["2001:db8::1"], "ip_at_ttl": ["2001:db8:ffff::1"]})
+    assert cache.check_pings(last, sec_last=False) == ["2001:db8::1"]
+    assert len(cache.lookup(["2001:db8::1"])) == 0
@@ -0,0 +1,74 @@
+'''
+Copyright 2023 The Board of Trustees of The Leland Stanford Junior University
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+'''
+
+"""
+Tests for the on-line RTT statistics of `rtt_stats`.
+"""
+
+import numpy as np
+import pandas as pd
+
+from rtt_stats import SUMMARY_COLUMNS, RttAggregator
+
+
+def pings(dsts: list, rtts: list) -> pd.DataFrame:
+    return pd.DataFrame({"dst": dsts, "rtt": rtts})
+
+
+def test_summary():
+    aggregator = RttAggregator({"192.0.2.1": "100.64.0.1", "192.0.2.2": "100.64.0.1"})
+    aggregator.update(pings(["192.0.2.1"] * 4 + ["192.0.2.2"] * 2, [10.0, 20.0, 30.0, None, 40.0, None]), "last")
+
+    summary = aggregator.summary("2023-11-14", 800)
+    assert list(summary.columns) == SUMMARY_COLUMNS
+    rows = summary.set_index(["group_by", "key"])
+    dst = rows.loc[("dst", "192.0.2.1")]
+    assert (dst["probes"], dst["responses"], dst["loss_rate"]) == (4, 3, 0.25)
+    assert (dst["min_rtt"], dst["mean_rtt"], dst["max_rtt"]) == (10.0, 20.0, 30.0)
+    pop = rows.loc[("sec_last_ip", "100.64.0.1")]
+    assert (pop["probes"], pop["responses"], pop["max_rtt"]) == (6, 4, 40.0)
+
+
+def test_quantiles_within_accuracy():
+    rtts = np.random.default_rng(1).uniform(20, 80, 5000)
+    aggregator = RttAggregator(accuracy=0.01, max_pending=100)
+    for chunk in np.array_split(rtts, 10):
+        aggregator.update(pings(["192.0.2.1"] * len(chunk), chunk), "last")
+
+    row = aggregator.summary("2023-11-14").iloc[0]
+    for name, q in (("p50_rtt", 0.5), ("p95_rtt", 0.95)):
+        exact = np.quantile(rtts, q, method="lower")
+        assert abs(row[name] - exact) <= 0.01 * exact
+
+
+def test_merge_matches_single_aggregator():
+    rtts = list(np.random.default_rng(2).uniform(1, 100, 200))
+    dsts = ["192.0.2.{}".format(i % 7) for i in range(200)]
+    whole = RttAggregator()
+    whole.update(pings(dsts, rtts), "sec_last")
+    first, second = RttAggregator(), RttAggregator()
+    first.update(pings(dsts[:120], rtts[:120]), "sec_last")
+    second.update(pings(dsts[120:], rtts[120:]), "sec_last")
+    first.merge(second)
+
+    pd.testing.assert_frame_equal(first.summary("2023-11-14").sort_values("key", ignore_index=True),
+                                  whole.summary("2023-11-14").sort_values("key", ignore_index=True))
+
+
+def test_empty_summary():
+    aggregator = RttAggregator()
+    aggregator.update(pings([], []), "last")
+    assert list(aggregator.summary("2023-11-14").columns) == SUMMARY_COLUMNS
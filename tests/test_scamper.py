@@ -0,0 +1,111 @@
+'''
+Copyright 2023 The Board of Trustees of The Leland Stanford Junior University
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+'''
+
+"""
+Tests for the traceroute plumbing of `scamper`: targets go to scamper over
+stdin and its output is merged into a file or parsed from a pipe, against a
+local fake scamper that records how it was called.
+"""
+
+import os
+import stat
+import sys
+
+from data_parse import get_last_hops_from_paris_tr
+from scamper import run_paris_trs, trace_last_hops
+
+# Answers every target read from stdin with a two-hop JSON trace and logs
+# its arguments next to itself.
+FAKE_SCAMPER = '''#!{python}
+import json, os, sys
+
+with open(os.path.join(os.path.dirname(sys.argv[0]), "calls.log"), "a") as log:
+    log.write(" ".join(sys.argv[1:]) + "\\n")
+assert sys.argv[-1] == "-", sys.argv
+for line in sys.stdin:
+    dst = line.strip()
+    if dst:
+        print(json.dumps({{"type": "trace", "dst": dst, "stop_reason": "COMPLETED", "hop_count": 2,
+                          "hops": [{{"addr": "100.64.0.1", "probe_ttl": 1, "rtt": 1.0}},
+                                   {{"addr": dst, "probe_ttl": 2, "rtt": 2.0}}]}}), flush=True)
+'''
+
+
+def install_fake_scamper(tmp_path, monkeypatch) -> str:
+    path = tmp_path / "scamper"
+    path.write_text(FAKE_SCAMPER.format(python=sys.executable))
+    path.chmod(path.stat().st_mode | stat.S_IEXEC)
+    monkeypatch.setenv("PATH", str(tmp_path) + os.pathsep + os.environ["PATH"])
+    return str(tmp_path / "calls.log")
+
+
+def ips(n: int) -> list:
+    return ["192.0.2.{}".format(i % 250) if i < 250 else "198.51.{}.{}".format(i // 250, i % 250) for i in range(n)]
+
+
+def test_run_paris_trs_reads_targets_from_stdin(tmp_path, monkeypatch):
+    log = install_fake_scamper(tmp_path, monkeypatch)
+    output = str(tmp_path / "traces.json")
+    # more targets than a pipe buffers, so they must be fed while scamper runs
+    targets = ips(20000)
+
+    run_paris_trs(targets, output, shards=3, pps=300)
+
+    df = get_last_hops_from_paris_tr(output)
+    assert sorted(df["dst"]) == sorted(targets)
+    with open(log) as f:
+        calls = f.read().splitlines()
+    assert len(calls) == 3
+    assert all("-p 100" in call for call in calls)
+
+
+def test_run_paris_trs_reads_ip_file(tmp_path, monkeypatch):
+    install_fake_scamper(tmp_path, monkeypatch)
+    ip_file = tmp_path / "ips.txt"
+    ip_file.write_text("192.0.2.1\n\n192.0.2.2\n")
+    output = str(tmp_path / "traces.json")
+
+    run_paris_trs(str(ip_file), output)
+
+    assert list(get_last_hops_from_paris_tr(output)["dst"]) == ["192.0.2.1", "192.0.2.2"]
+
+
+def test_trace_last_hops_uses_no_files(tmp_path, monkeypatch):
+    install_fake_scamper(tmp_path, monkeypatch)
+    fds = len(os.listdir("/proc/self/fd"))
+    targets = ips(5000)
+
+    df = trace_last_hops(targets, shards=2)
+
+    assert sorted(df["dst"]) == sorted(targets)
+    assert (df["sec_last_ip"] == "100.64.0.1").all()
+    assert list(df["hop_count"].unique()) == [2]
+    assert sorted(os.listdir(tmp_path)) == ["calls.log", "scamper"]
+    assert len(os.listdir("/proc/self/fd")) == fds
+
+
+def test_run_paris_trs_shards_fit_the_pps_budget(tmp_path, monkeypatch):
+    log = install_fake_scamper(tmp_path, monkeypatch)
+    output = str(tmp_path / "traces.json")
+
+    run_paris_trs(ips(10), output, shards=4, pps=2)
+
+    with open(log) as f:
+        calls = f.read().splitlines()
+    # 2 shards of 1 pps each rather than 4 shards of 1 pps
+    assert len(calls) == 2
+    assert all("-p 1 " in call for call in calls)
+    assert len(get_last_hops_from_paris_tr(output)) == 10
@@ -0,0 +1,286 @@
+'''
+Copyright 2023 The Board of Trustees of The Leland Stanford Junior University
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+'''
+
+"""
+Tests for the scamper control-socket protocol of `ScamperEngine` and its use
+in `ttl_ping`, against a local fake scamper that speaks the protocol and
+checks the client only writes commands it was given credit for.
+"""
+
+import json
+import os
+import stat
+import sys
+import time
+
+import pandas as pd
+import pytest
+
+import metrics
+import scamper_engine
+from scamper import ttl_ping
+from scamper_engine import ScamperEngine
+
+# Answers every command with one trace record and grants one more command
+# per reply, so at most WINDOW commands are outstanding. Commands written
+# without credit and the commands received are logged next to the socket.
+# FAKE_SCAMPER_DELAY slows every reply down by that many seconds,
+# FAKE_SCAMPER_CRASH_AFTER makes it exit without EOF after that many
+# commands, and commands for 203.0.113.0/24 are rejected with ERR.
+FAKE_SCAMPER = '''#!{python}
+import json, os, socket, sys, time
+
+WINDOW = 2
+DELAY = float(os.environ.get("FAKE_SCAMPER_DELAY", 0))
+CRASH_AFTER = int(os.environ.get("FAKE_SCAMPER_CRASH_AFTER", -1))
+path = sys.argv[sys.argv.index("-U") + 1]
+log = open(os.path.join(os.path.dirname(path), "fake.log"), "w")
+server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+server.bind(path)
+server.listen(1)
+conn, _ = server.accept()
+f = conn.makefile("rwb", buffering=0)
+credit = 0
+for line in f:
+    line = line.decode().strip()
+    if line.startswith("attach"):
+        assert line == "attach format json", line
+        credit = WINDOW
+        f.write(b"OK\\n" + b"MORE\\n" * WINDOW)
+    elif line == "done":
+        f.write(b"EOF\\n")
+        break
+    elif line:
+        if credit == 0:
+            log.write("no credit: " + line + "\\n")
+        if CRASH_AFTER == 0:
+            os._exit(3)
+        CRASH_AFTER -= 1
+        credit -= 1
+        tokens = line.split()
+        if tokens[-1].startswith("203.0.113."):
+            credit += 1
+            f.write(b"ERR command not accepted\\nMORE\\n")
+            continue
+        ttl = int(tokens[tokens.index("-f") + 1])
+        userid = int(tokens[tokens.index("-U") + 1])
+        record = {{"type": "trace", "userid": userid, "dst": tokens[-1], "stop_reason": "COMPLETED",
+                   "hop_count": ttl, "start": {{"sec": 1700000000, "usec": 0, "ftime": "2023-11-14 22:13:20"}},
+                   "hops": [{{"addr": "100.64.0." + str(ttl), "probe_ttl": ttl, "rtt": 20.5}}]}}
+        data = (json.dumps(record) + "\\n").encode()
+        log.write("command: " + line + "\\n")
+        log.flush()
+        credit += 1
+        time.sleep(DELAY)
+        f.write(b"OK id-1\\n" + b"DATA %d\\n" % len(data) + data + b"MORE\\n")
+conn.close()
+os.unlink(path)
+'''
+
+
+def fake_scamper(tmp_path) -> str:
+    path = tmp_path / "bin" / "scamper"
+    path.parent.mkdir()
+    path.write_text(FAKE_SCAMPER.format(python=sys.executable))
+    path.chmod(path.stat().st_mode | stat.S_IEXEC)
+    return str(path)
+
+
+def fake_log(tmp_path) -> list:
+    with open(tmp_path / "sock" / "fake.log") as f:
+        return f.read().splitlines()
+
+
+def test_engine_streams_records_within_credit(tmp_path):
+    (tmp_path / "sock").mkdir()
+    records = []
+    engine = ScamperEngine(on_record=records.append, scamper_bin=fake_scamper(tmp_path),
+                           socket_path=str(tmp_path / "sock" / "scamper.sock"))
+    with engine:
+        for i in range(20):
+            engine.submit("trace -P icmp-paris -q 1 -f 3 -m 3 -U {} 192.0.2.{}".format(i, i))
+        engine.drain()
+
+    assert sorted(r["userid"] for r in records) == list(range(20))
+    log = fake_log(tmp_path)
+    assert [line for line in log if line.startswith("no credit")] == []
+    assert len(log) == 20
+
+
+def test_engine_reports_when_commands_are_written(tmp_path):
+    (tmp_path / "sock").mkdir()
+    sent = []
+    engine = ScamperEngine(scamper_bin=fake_scamper(tmp_path), socket_path=str(tmp_path / "sock" / "scamper.sock"))
+    with engine:
+        for i in range(5):
+            engine.submit("trace -P icmp-paris -q 1 -f 3 -m 3 -U {} 192.0.2.{}".format(i, i),
+                          lambda i=i: sent.append(i))
+        # scamper has not granted any credit yet
+        assert sent == []
+        engine.drain()
+
+    assert sent == list(range(5))
+
+
+def test_ttl_ping_collects_every_round(tmp_path, monkeypatch):
+    monkeypatch.setenv("PATH", os.path.dirname(fake_scamper(tmp_path)) + os.pathsep + os.environ["PATH"])
+    probe_file = tmp_path / "probes.csv"
+    pd.DataFrame({
+        "ip": ["192.0.2.1", "192.0.2.2", "198.51.100.1"],
+        "sec_last_ip": ["100.64.0.4", "100.64.0.4", "100.64.0.6"],
+        "sec_last": [4, 4, 6],
+        "last": [5, 5, 7],
+    }).to_csv(probe_file, index=False)
+    outputs = {name: str(tmp_path / (name + ".csv")) for name in ("sec_last", "last", "rtt_summary")}
+
+    results = ttl_ping(str(probe_file), outputs, 3, 0)
+
+    for hop_type, ttls in (("sec_last", [4, 4, 6]), ("last", [5, 5, 7])):
+        df = results[hop_type].sort_values(["seq", "dst"])
+        assert len(df) == 9
+        assert list(df["seq"]) == [1, 1, 1, 2, 2, 2, 3, 3, 3]
+        assert list(df["probe_ttl"]) == ttls * 3
+        assert (df["rtt"] == 20.5).all()
+        assert len(pd.read_csv(outputs[hop_type], header=None)) == 9
+
+
+def test_ttl_ping_rotates_round_slots(tmp_path, monkeypatch):
+    monkeypatch.setenv("PATH", os.path.dirname(fake_scamper(tmp_path)) + os.pathsep + os.environ["PATH"])
+    # the probe list is handed over as a dataframe rather than a CSV file
+    probes = pd.DataFrame({
+        "ip": ["192.0.2.1", "192.0.2.2", "198.51.100.1"],
+        "sec_last_ip": ["100.64.0.4", "100.64.0.4", "100.64.0.6"],
+        "sec_last": [4, 4, 6],
+        "last": [5, 5, 7],
+        "slot": [0, 1, 0],
+        "slots": [2, 2, 1],
+    }, index=[7, 3, 5])
+    outputs = {name: str(tmp_path / (name + ".csv")) for name in ("sec_last", "last", "rtt_summary")}
+
+    results = ttl_ping(probes, outputs, 4, 0)
+
+    df = results["last"]
+    assert sorted(zip(df["seq"], df["dst"].astype(str))) == [
+        (1, "192.0.2.1"), (1, "198.51.100.1"), (2, "192.0.2.2"), (2, "198.51.100.1"),
+        (3, "192.0.2.1"), (3, "198.51.100.1"), (4, "192.0.2.2"), (4, "198.51.100.1"),
+    ]
+
+
+def test_ttl_ping_jitter_counts_until_the_round_is_written(tmp_path, monkeypatch):
+    monkeypatch.setenv("PATH", os.path.dirname(fake_scamper(tmp_path)) + os.pathsep + os.environ["PATH"])
+    monkeypatch.setenv("FAKE_SCAMPER_DELAY", "0.02")
+    probes = pd.DataFrame({
+        "ip": ["192.0.2.{}".format(i) for i in range(15)],
+        "sec_last": 4,
+        "last": 5,
+    })
+    outputs = {name: str(tmp_path / (name + ".csv")) for name in ("sec_last", "last", "rtt_summary")}
+
+    results = ttl_ping(probes, outputs, 1, 0)
+
+    # 30 commands with 2 outstanding at a time: the last one is only written
+    # after about 28 slowed replies
+    assert results["last"].attrs["round_jitter"][1] > 0.3
+
+
+def test_engine_fails_when_scamper_dies(tmp_path, monkeypatch):
+    (tmp_path / "sock").mkdir()
+    monkeypatch.setenv("FAKE_SCAMPER_CRASH_AFTER", "3")
+    engine = ScamperEngine(scamper_bin=fake_scamper(tmp_path), socket_path=str(tmp_path / "sock" / "scamper.sock"))
+    with pytest.raises(Exception, match=r"before EOF \(exit code 3\)"):
+        with engine:
+            for i in range(5):
+                engine.submit("trace -P icmp-paris -q 1 -f 3 -m 3 -U {} 192.0.2.{}".format(i, i))
+            engine.drain()
+
+
+def test_ttl_ping_fails_when_scamper_dies(tmp_path, monkeypatch):
+    monkeypatch.setenv("PATH", os.path.dirname(fake_scamper(tmp_path)) + os.pathsep + os.environ["PATH"])
+    monkeypatch.setenv("FAKE_SCAMPER_CRASH_AFTER", "3")
+    probes = pd.DataFrame({"ip": ["192.0.2.{}".format(i) for i in range(5)], "sec_last": 4, "last": 5})
+    outputs = {name: str(tmp_path / (name + ".csv")) for name in ("sec_last", "last", "rtt_summary")}
+
+    with pytest.raises(Exception, match="before EOF"):
+        ttl_ping(probes, outputs, 1, 0)
+    # nothing is written as if the run had completed
+    assert not os.path.exists(outputs["last"])
+
+
+def test_engine_counts_rejected_commands(tmp_path):
+    (tmp_path / "sock").mkdir()
+    records = []
+    engine = ScamperEngine(on_record=records.append, scamper_bin=fake_scamper(tmp_path),
+                           socket_path=str(tmp_path / "sock" / "scamper.sock"))
+    with engine:
+        for dst in ("192.0.2.1", "203.0.113.1", "192.0.2.2", "203.0.113.2"):
+            engine.submit("trace -P icmp-paris -q 1 -f 3 -m 3 -U 1 " + dst)
+        engine.drain()
+
+    assert len(records) == 2
+    assert engine.errors == 2
+    assert list(engine.error_messages) == ["ERR command not accepted"] * 2
+
+
+def test_ttl_ping_counts_the_probes_it_sends(tmp_path, monkeypatch):
+    monkeypatch.setenv("PATH", os.path.dirname(fake_scamper(tmp_path)) + os.pathsep + os.environ["PATH"])
+    probes = pd.DataFrame({
+        "ip": ["192.0.2.1", "192.0.2.2", "198.51.100.1"],
+        "sec_last": [4, 4, 6],
+        "last": [5, 5, 7],
+        "slot": [0, 1, 0],
+        "slots": [2, 2, 1],
+    })
+    outputs = {name: str(tmp_path / (name + ".csv")) for name in ("sec_last", "last", "rtt_summary")}
+    metrics.configure(str(tmp_path / "metrics.jsonl"))
+    try:
+        ttl_ping(probes, outputs, 4, 0)
+    finally:
+        metrics.configure(None)
+
+    with open(tmp_path / "metrics.jsonl") as f:
+        events = [json.loads(line) for line in f]
+    # 2 of the 3 destinations are due in each of the 4 rounds, one probe per hop type
+    hops = {e["labels"]["hop_type"]: e["probes_sent"] for e in events if e["metric"] == "ttl_ping_hop"}
+    assert hops == {"sec_last": 8, "last": 8}
+    assert [e["probes_sent"] for e in events if e["metric"] == "ttl_ping"] == [16]
+
+
+def test_ttl_ping_feeds_new_destinations_into_the_running_schedule(tmp_path, monkeypatch):
+    monkeypatch.setenv("PATH", os.path.dirname(fake_scamper(tmp_path)) + os.pathsep + os.environ["PATH"])
+    (tmp_path / "sock").mkdir()
+    # keep the fake's log of the commands it received
+    monkeypatch.setattr(scamper_engine.tempfile, "mkdtemp", lambda **kwargs: str(tmp_path / "sock"))
+    monkeypatch.setattr(scamper_engine.shutil, "rmtree", lambda *args, **kwargs: None)
+    # a batch arrives before the second and the third round, then no more
+    arrivals = [[], [pd.DataFrame({"ip": ["192.0.2.2"], "sec_last": 4, "last": 5})],
+                [pd.DataFrame({"ip": ["192.0.2.3"], "sec_last": 4, "last": 5})]]
+    outputs = {name: str(tmp_path / (name + ".csv")) for name in ("sec_last", "last", "rtt_summary")}
+
+    start = time.monotonic()
+    results = ttl_ping(pd.DataFrame({"ip": ["192.0.2.1"], "sec_last": 4, "last": 5}), outputs, 3, 0.2,
+                       feed=lambda: arrivals.pop(0) if len(arrivals) > 0 else None)
+    elapsed = time.monotonic() - start
+
+    df = results["last"]
+    assert sorted(zip(df["dst"].astype(str), df["seq"])) == [
+        (dst, seq) for dst in ("192.0.2.1", "192.0.2.2", "192.0.2.3") for seq in (1, 2, 3)]
+    # the batches share rounds: 5 instead of 3 per batch one after the other
+    assert sorted(df.attrs["round_jitter"]) == [1, 2, 3, 4, 5]
+    assert elapsed < 8 * 0.2
+    commands = [line for line in fake_log(tmp_path) if line.startswith("command")]
+    # the third batch is probed before the second one had all its rounds
+    assert max(n for n, line in enumerate(commands) if "192.0.2.2" in line) > \
+        min(n for n, line in enumerate(commands) if "192.0.2.3" in line)
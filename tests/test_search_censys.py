@@ -0,0 +1,188 @@
+'''
+Copyright 2023 The Board of Trustees of The Leland Stanford Junior University
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+'''
+
+"""
+Tests for paging through Censys host searches with
+`search_censys.iter_censys_hosts` and through the Censys universal dataset
+on BigQuery with `search_censys.iter_censys_bq`, against local fakes of the
+Censys search API and of the BigQuery query result.
+"""
+
+import threading
+
+import pandas as pd
+import pytest
+
+import search_censys
+from search_censys import iter_censys_bq, iter_censys_hosts, search_censys as search
+
+
+def host(ip: str) -> dict:
+    return {"ip": ip, "services": [{"port": 443}, {"port": 80}], "dns": {"reverse_dns": {"names": [ip + ".example"]}}}
+
+
+class FakeCensysHosts:
+    """
+    Censys search client that serves fixed pages per query. `failures` maps
+    a query to the page index each of its next searches fails at.
+    """
+
+    def __init__(self, pages: dict, failures: dict = None) -> None:
+        self.pages = pages
+        self.failures = failures or {}
+        self.fetched = []
+        self.lock = threading.Lock()
+
+    def search(self, query: str, pages: int = 1):
+        assert pages == -1
+        fail_at = self.failures.get(query, [])
+        fail = fail_at.pop(0) if fail_at else None
+        for i, page in enumerate(self.pages[query]):
+            if i == fail:
+                raise Exception("502 Bad Gateway")
+            with self.lock:
+                self.fetched.append((query, i))
+            yield page
+
+
+def prefix_pages(prefix: str, pages: int, per_page: int = 2) -> list:
+    base = prefix.split("/")[0].rsplit(".", 1)[0]
+    return [[host("{}.{}".format(base, p * per_page + i)) for i in range(per_page)] for p in range(pages)]
+
+
+QUERIES = {
+    "autonomous_system.asn:14593 and ip:98.97.0.0/24": prefix_pages("98.97.0.0/24", 3),
+    "autonomous_system.asn:14593 and ip:98.98.0.0/24": prefix_pages("98.98.0.0/24", 4),
+}
+PREFIXES = ["98.97.0.0/24", "98.98.0.0/24"]
+
+
+def ips(pages: list) -> list:
+    return [entry["ip"] for page in pages for entry in page]
+
+
+def test_prefix_queries_are_paged_concurrently_in_order():
+    client = FakeCensysHosts(dict(QUERIES))
+
+    hosts = list(iter_censys_hosts(14593, 4, PREFIXES, max_workers=2, client=client))
+
+    # every page is fetched once and the hosts of a query keep their order
+    assert sorted(client.fetched) == sorted((q, i) for q, pages in QUERIES.items() for i in range(len(pages)))
+    for query, pages in QUERIES.items():
+        assert [h["ip"] for h in hosts if h["ip"] in ips(pages)] == ips(pages)
+    assert len(hosts) == 14
+    assert hosts[0]["ports"] == [443, 80]
+    assert hosts[0]["dns_name"] == [hosts[0]["ip"] + ".example"]
+
+
+def test_hosts_of_other_ip_versions_are_skipped():
+    client = FakeCensysHosts({"autonomous_system.asn:800": [[host("192.0.2.1"), host("2001:db8::1")]]})
+
+    assert [h["ip"] for h in iter_censys_hosts(800, 4, client=client)] == ["192.0.2.1"]
+    assert [h["ip"] for h in iter_censys_hosts(800, 6, client=client)] == ["2001:db8::1"]
+
+
+def test_failed_pages_are_retried(monkeypatch, capsys):
+    monkeypatch.setattr(search_censys, "RETRY_DELAY", 0)
+    query = "autonomous_system.asn:14593 and ip:98.98.0.0/24"
+    # the search of the second prefix fails at its third page, then at its second
+    client = FakeCensysHosts(dict(QUERIES), {query: [2, 1]})
+
+    hosts = [h["ip"] for h in iter_censys_hosts(14593, 4, PREFIXES, max_workers=2, client=client)]
+
+    assert sorted(hosts) == sorted(ips(QUERIES[query]) + ips(QUERIES["autonomous_system.asn:14593 and ip:98.97.0.0/24"]))
+    assert [h for h in hosts if h.startswith("98.98.")] == ips(QUERIES[query])
+    assert [i for q, i in client.fetched if q == query] == [0, 1, 0, 0, 1, 2, 3]
+    assert "retry 2 of 3" in capsys.readouterr().err
+
+
+def test_search_fails_once_the_retries_are_used_up(monkeypatch):
+    monkeypatch.setattr(search_censys, "RETRY_DELAY", 0)
+    query = "autonomous_system.asn:14593 and ip:98.97.0.0/24"
+    client = FakeCensysHosts(dict(QUERIES), {query: [1, 1, 1]})
+
+    with pytest.raises(Exception, match=r"98\.97\.0\.0/24 after 2 retries: 502 Bad Gateway"):
+        list(iter_censys_hosts(14593, 4, PREFIXES, max_workers=2, client=client, retries=2))
+    with pytest.raises(Exception, match="after 3 retries"):
+        search(14593, 4, PREFIXES, client=FakeCensysHosts(dict(QUERIES), {query: [0, 0, 0, 0]}))
+
+
+class FakeRowIterator:
+    """
+    Query result that builds each page only when it is asked for, like the
+    BigQuery client's `RowIterator`.
+    """
+
+    def __init__(self, pages: list, page_size: int) -> None:
+        self.pages = pages
+        self.page_size = page_size
+        self.fetched = 0
+
+    def to_dataframe_iterable(self):
+        for page in self.pages:
+            assert len(page) <= self.page_size
+            self.fetched += 1
+            yield pd.DataFrame({"ip": page, "date": "2023-11-14", "asn": 14593,
+                                "dns_name": [[] for _ in page], "port": [[443] for _ in page],
+                                "pep_link": [[False] for _ in page]})
+
+
+class FakeQueryJob:
+
+    def __init__(self, client: "FakeClient") -> None:
+        self.client = client
+
+    def result(self, page_size: int = None):
+        self.client.rows = FakeRowIterator(self.client.pages, page_size)
+        return self.client.rows
+
+
+class FakeClient:
+
+    def __init__(self, pages: list) -> None:
+        self.pages = pages
+        self.queries = []
+        self.rows = None
+
+    def query(self, sql: str) -> FakeQueryJob:
+        self.queries.append(sql)
+        return FakeQueryJob(self)
+
+
+def test_pages_are_fetched_as_they_are_consumed():
+    ips = ["98.97.0.{}".format(i) for i in range(7)]
+    client = FakeClient([ips[0:3], ips[3:6], [], ips[6:7]])
+
+    pages = iter_censys_bq(14593, 4, "censys-io.universal_internet_dataset_v2.base", page_size=3, client=client)
+    first = next(pages)
+    assert list(first["ip"]) == ips[0:3]
+    assert client.rows.fetched == 1
+
+    rest = list(pages)
+    # the empty page is skipped
+    assert [len(page) for page in rest] == [3, 1]
+    assert list(pd.concat([first] + rest)["ip"]) == ips
+    assert client.rows.fetched == 4
+
+    assert len(client.queries) == 1
+    assert "autonomous_system.asn=14593" in client.queries[0]
+    assert "`censys-io.universal_internet_dataset_v2.base`" in client.queries[0]
+
+
+def test_no_pages():
+    client = FakeClient([])
+    assert list(iter_censys_bq(800, 4, "censys.base", client=client)) == []
+    assert client.rows.page_size == 50000
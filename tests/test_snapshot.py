@@ -0,0 +1,115 @@
+'''
+Copyright 2023 The Board of Trustees of The Leland Stanford Junior University
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+'''
+
+"""
+Tests for the exposed services snapshots of `snapshot`.
+"""
+
+from datetime import date, timedelta
+
+import pandas as pd
+
+import data_collection
+from data_collection import DataCollection
+from snapshot import SnapshotStore, due_for_retrace, merge_delta
+
+
+def services(ips: list, day: str, last_seen: str = None) -> pd.DataFrame:
+    df = pd.DataFrame({
+        "ip": ips,
+        "date": day,
+        "asn": 800,
+        "dns_name": [[] for _ in ips],
+        "port": [[443] for _ in ips],
+        "pep_link": [[False] for _ in ips],
+    })
+    if last_seen is not None:
+        df["last_seen"] = last_seen
+    return df
+
+
+def test_store_keeps_the_latest_snapshot(tmp_path):
+    store = SnapshotStore(str(tmp_path))
+    assert store.latest(800) == (None, None)
+    store.save(800, "2023-11-14", services(["192.0.2.1"], "2023-11-14", "2023-11-14"))
+    store.save(800, "2023-11-15", services(["192.0.2.2"], "2023-11-15", "2023-11-15"))
+
+    day, df = store.latest(800)
+    assert day == "2023-11-15"
+    assert list(df["ip"]) == ["192.0.2.2"]
+    assert list(df["port"].iloc[0]) == [443]
+    assert df["last_traced"].iloc[0] is None
+    assert store.latest(800, before="2023-11-15")[0] == "2023-11-14"
+    assert store.load(800, "2023-11-16") is None
+
+
+def test_last_full_needs_a_saved_snapshot(tmp_path):
+    store = SnapshotStore(str(tmp_path))
+    store.mark_full(800, "2023-11-14")
+    assert store.last_full(800) is None
+    store.save(800, "2023-11-14", services(["192.0.2.1"], "2023-11-14", "2023-11-14"))
+    store.mark_full(800, "2023-11-16")
+    assert store.last_full(800) == "2023-11-14"
+    assert store.last_full(800, before="2023-11-14") is None
+
+
+def test_merge_delta_expires_unreported_hosts():
+    previous = pd.concat([services(["192.0.2.1"], "2023-11-14", "2023-11-14"),
+                          services(["192.0.2.2"], "2023-11-14", "2023-11-01"),
+                          services(["192.0.2.3"], "2023-11-14", "2023-11-14")], ignore_index=True)
+    merged = merge_delta(previous, services(["192.0.2.3", "192.0.2.4"], "2023-11-15"), "2023-11-15")
+
+    assert sorted(merged["ip"]) == ["192.0.2.1", "192.0.2.3", "192.0.2.4"]
+    assert (merged["date"] == "2023-11-15").all()
+    assert merged.set_index("ip").loc["192.0.2.3", "last_seen"] == "2023-11-15"
+    assert len(merge_delta(None, services(["192.0.2.1"], "2023-11-15"), "2023-11-15")) == 1
+
+
+def test_every_ip_is_retraced_once_per_rotation():
+    ips = pd.Series(["192.0.2.{}".format(i) for i in range(100)])
+    days = ["2023-11-{}".format(d) for d in range(14, 21)]
+    due = [due_for_retrace(ips, day, 7) for day in days]
+    assert (sum(d.astype(int) for d in due) == 1).all()
+    assert due_for_retrace(ips, days[0], 1).all()
+
+
+def test_stable_hosts_do_not_expire(tmp_path, monkeypatch):
+    today = [date(2023, 11, 14)]
+    queries = []
+
+    class FakeDate(date):
+        @classmethod
+        def today(cls):
+            return today[0]
+
+    def search_censys(asn, ipv=None, prefixes=None, since=None):
+        queries.append(since)
+        # the stable host is never updated, so only a full query returns it
+        ips = ["192.0.2.{}".format(today[0].day)] + (["192.0.2.1"] if since is None else [])
+        return {"date": [str(today[0])] * len(ips), "asn": [800] * len(ips), "ip": ips,
+                "port": [443] * len(ips), "dns_name": [[]] * len(ips), "pep_link": [None] * len(ips)}
+
+    monkeypatch.setattr(data_collection, "date", FakeDate)
+    monkeypatch.setattr(data_collection, "search_censys", search_censys)
+    dc = DataCollection(data_dir=str(tmp_path))
+    for _ in range(10):
+        df = dc.get_censys_exposed_services(800, incremental=True, max_age_days=4)
+        assert "192.0.2.1" in set(df["ip"])
+        dc.snapshots.save(800, str(today[0]), df)
+        today[0] += timedelta(days=1)
+
+    # a full query every max_age_days // 2 days, deltas in between
+    assert queries == [None, "2023-11-14", None, "2023-11-16", None, "2023-11-18", None, "2023-11-20", None, "2023-11-22"]
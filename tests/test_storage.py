@@ -0,0 +1,71 @@
+'''
+Copyright 2023 The Board of Trustees of The Leland Stanford Junior University
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+'''
+
+"""
+Tests for the Parquet store of `storage`: schema coercion and partitioned
+reads.
+"""
+
+import pandas as pd
+
+from data_parse import compact_pings
+from storage import EXPOSED_SERVICES_SCHEMA, PING_SCHEMA, partition_dir, read_parquet, to_arrow_table, write_parquet
+
+
+def pings() -> pd.DataFrame:
+    return pd.DataFrame({
+        "date": ["2023-11-14"] * 2,
+        "seq": [1, 2],
+        "dst": ["192.0.2.1", "192.0.2.2"],
+        "stop_reason": ["COMPLETED", "GAPLIMIT"],
+        "start_time": ["2023-11-14 10:00:00", "2023-11-14 10:00:01"],
+        "start_sec": [1699956000, 1699956001],
+        "hop_count": [5.0, None],
+        "ip_at_ttl": ["100.64.0.1", None],
+        "probe_ttl": [5.0, None],
+        "rtt": [31.337, None],
+    })
+
+
+def test_compact_pings_convert_like_plain_pings():
+    plain = to_arrow_table(pings(), PING_SCHEMA)
+    assert to_arrow_table(compact_pings(pings()), PING_SCHEMA).equals(plain)
+    assert plain.column("rtt").to_pylist() == [31.337, None]
+    assert str(plain.column("start_time")[0]) == "2023-11-14 10:00:00+00:00"
+
+
+def test_missing_columns_become_nulls_and_empty_lists():
+    table = to_arrow_table(pd.DataFrame({"ip": ["192.0.2.1"], "date": ["2023-11-14"], "asn": [800]}),
+                           EXPOSED_SERVICES_SCHEMA)
+    assert table.schema == EXPOSED_SERVICES_SCHEMA
+    assert table.column("port").to_pylist() == [[]]
+    assert table.column("sec_last_ip").to_pylist() == [None]
+
+
+def test_read_partitions(tmp_path):
+    base = str(tmp_path)
+    write_parquet(pings(), base, "pings", "2023-11-14", 800, "last")
+    write_parquet(pings(), base, "pings", "2023-11-14", 800, "sec_last")
+    write_parquet(pings(), base, "pings", "2023-11-15", 14593, "last")
+
+    assert partition_dir(base, "pings", "2023-11-14", 800, "last").endswith("date=2023-11-14/asn=800/hop_type=last")
+    assert len(read_parquet(base, "pings")) == 6
+    df = read_parquet(base, "pings", dates=["2023-11-14"], hop_types=["last"])
+    assert len(df) == 2
+    assert list(df["asn"].unique()) == [800]
+    assert list(df["hop_type"].unique()) == ["last"]
+    assert len(read_parquet(base, "pings", asns=[1])) == 0
+    assert list(read_parquet(base, "rtt_summary").columns)[:3] == ["date", "asn", "hop_type"]
@@ -0,0 +1,90 @@
+'''
+Copyright 2023 The Board of Trustees of The Leland Stanford Junior University
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+'''
+
+"""
+Tests for the prefix-aware target reduction of `targets`.
+"""
+
+from datetime import date, timedelta
+
+import pandas as pd
+import pytest
+
+from targets import group_prefix, reduce_targets, target_groups
+
+
+def probe_list() -> pd.DataFrame:
+    # 5 destinations behind one PoP in one /24, 2 in another /24 behind the
+    # same PoP, and 1 at a different hop count
+    ips = ["98.97.1.{}".format(i) for i in range(1, 6)] + ["98.97.2.1", "98.97.2.2", "98.97.1.99"]
+    return pd.DataFrame({
+        "ip": ips,
+        "sec_last_ip": ["100.64.0.1"] * 8,
+        "sec_last": [7] * 7 + [8],
+        "last": [8] * 7 + [9],
+    })
+
+
+def test_group_prefix():
+    assert group_prefix("98.97.1.200") == "98.97.1.0/24"
+    assert group_prefix("2001:db8:1:2ff::1") == "2001:db8:1:200::/56"
+
+
+def test_target_groups():
+    groups = target_groups(probe_list())
+    assert groups.nunique() == 3
+    assert groups.iloc[0] == groups.iloc[4] != groups.iloc[5] == groups.iloc[6]
+    assert groups.iloc[7] != groups.iloc[0]
+
+
+def test_day_rotation_covers_every_destination():
+    probes = probe_list()
+    seen = []
+    for i in range(5):
+        day = str(date(2023, 11, 14) + timedelta(days=i))
+        reduced = reduce_targets(probes, per_group=1, rotate="day", day=day)
+        # one destination of each group per day
+        assert len(reduced) == 3
+        assert target_groups(reduced).nunique() == 3
+        assert list(reduced.columns) == list(probes.columns)
+        seen += list(reduced["ip"])
+    # the largest group has 5 members, so 5 days probe everyone
+    assert set(seen) == set(probes["ip"])
+
+
+def test_day_rotation_is_deterministic():
+    probes = probe_list()
+    first = reduce_targets(probes, 2, "day", "2023-11-14")
+    shuffled = reduce_targets(probes.sample(frac=1, random_state=1), 2, "day", "2023-11-14")
+    assert sorted(first["ip"]) == sorted(shuffled["ip"])
+    assert len(first) == 2 + 2 + 1
+
+
+def test_round_rotation_assigns_slots():
+    reduced = reduce_targets(probe_list(), per_group=2, rotate="round")
+    assert len(reduced) == 8
+    assert list(reduced["slots"]) == [3] * 5 + [1, 1, 1]
+    # every slot of a group holds at most per_group destinations
+    for slot in range(3):
+        assert ((reduced["slots"] == 3) & (reduced["slot"] == slot)).sum() <= 2
+    assert sorted(reduced["slot"][:5]) == [0, 0, 1, 1, 2]
+
+
+def test_invalid_arguments():
+    with pytest.raises(Exception):
+        reduce_targets(probe_list(), rotate="week")
+    with pytest.raises(Exception):
+        reduce_targets(probe_list(), per_group=0)
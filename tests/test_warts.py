@@ -0,0 +1,114 @@
+'''
+Copyright 2023 The Board of Trustees of The Leland Stanford Junior University
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+'''
+
+"""
+Tests for the warts decoder: parsing the warts fixtures must give exactly
+the results `data_parse` gives for the same traces in scamper JSON.
+
+The fixtures in `tests/fixtures` hold the same records in both formats;
+`traces.*` are paris-traceroutes (IPv4 and IPv6, traces without hops,
+repeated hop addresses and ICMP extensions) and `pings.*` are the single
+TTL probes of `ttl_ping`. The warts files were written with
+`benchmarks/fakes.py` (`warts_trace`) from the JSON records.
+"""
+
+import binascii
+import io
+import os
+import time
+
+import pandas as pd
+import pytest
+
+import warts
+from data_parse import aggregate_data, get_last_hops_from_paris_tr, iter_trace_records
+from scamper_engine import ScamperEngine
+
+FIXTURES = os.path.join(os.path.dirname(os.path.abspath(__file__)), "fixtures")
+
+
+def fixture(name: str) -> str:
+    return os.path.join(FIXTURES, name)
+
+
+@pytest.fixture
+def utc(monkeypatch):
+    # scamper formats start times in local time; the JSON fixtures are in UTC
+    monkeypatch.setenv("TZ", "UTC")
+    time.tzset()
+    yield
+    monkeypatch.undo()
+    time.tzset()
+
+
+def test_last_hops_match_json():
+    expected = get_last_hops_from_paris_tr(fixture("traces.json"))
+    assert len(expected) > 0
+    pd.testing.assert_frame_equal(get_last_hops_from_paris_tr(fixture("traces.warts")), expected)
+
+
+def test_pings_match_json(utc):
+    with open(fixture("pings.json")) as j, open(fixture("pings.warts"), "rb") as w:
+        for compact in (False, True):
+            expected = aggregate_data({1: j}, compact=compact)
+            assert len(expected) > 0
+            pd.testing.assert_frame_equal(aggregate_data({1: w}, compact=compact), expected)
+
+
+def test_records_match_json(utc):
+    fields = ("type", "userid", "dst", "stop_reason", "start", "hop_count")
+    expected = list(iter_trace_records(fixture("pings.json")))
+    decoded = list(warts.iter_traces(fixture("pings.warts")))
+    assert [{f: r.get(f) for f in fields} for r in decoded] == [{f: r.get(f) for f in fields} for r in expected]
+    assert [[(h["addr"], h["probe_ttl"], h["rtt"]) for h in r.get("hops", [])] for r in decoded] == \
+        [[(h["addr"], h["probe_ttl"], h["rtt"]) for h in r.get("hops", [])] for r in expected]
+
+
+def test_stream_decoder_reads_uuencoded_pieces():
+    with open(fixture("traces.warts"), "rb") as f:
+        data = f.read()
+    decoder = warts.StreamDecoder()
+    records = []
+    for i in range(0, len(data), 45):
+        records += decoder.feed_uu(binascii.b2a_uu(data[i:i + 45]))
+    assert records == list(warts.iter_traces(io.BytesIO(data)))
+
+
+def test_engine_decodes_warts_data_blocks():
+    with open(fixture("pings.warts"), "rb") as f:
+        data = f.read()
+    records = []
+    engine = ScamperEngine(on_record=records.append, output_format="warts")
+    # scamper sends uuencoded warts in DATA blocks, split anywhere
+    for i in range(0, len(data), 450):
+        block = b"".join(binascii.b2a_uu(data[j:j + 45]) for j in range(i, min(i + 450, len(data)), 45))
+        engine._buf += b"MORE\nDATA %d\n" % len(block) + block
+        engine._parse()
+    assert records == list(warts.iter_traces(fixture("pings.warts")))
+    assert engine._credit == len(range(0, len(data), 450))
+
+
+def test_truncated_object_is_dropped():
+    with open(fixture("traces.warts"), "rb") as f:
+        data = b"".join(warts.HEADER.pack(warts.MAGIC, obj_type, len(body)) + body
+                        for obj_type, body in warts.iter_objects(f) if obj_type == warts.TYPE_TRACE)
+    complete = list(warts.iter_traces(io.BytesIO(data)))
+    assert list(warts.iter_traces(io.BytesIO(data[:-3]))) == complete[:-1]
+
+
+def test_bad_magic():
+    with pytest.raises(Exception):
+        list(warts.iter_traces(io.BytesIO(b"\x12\x06\x00\x06\x00\x00\x00\x00")))
@@ -0,0 +1,352 @@
+'''
+Copyright 2023 The Board of Trustees of The Leland Stanford Junior University
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+'''
+
+"""
+Decoder for scamper's binary warts output.
+
+Only trace objects are decoded, and of those only the fields the pipeline
+reads: the destination, start time, stop reason, hop count and userid of a
+trace and the address, probe TTL and RTT of its hops. They are returned as
+dicts shaped like scamper's JSON trace records, so `data_parse` handles
+both formats alike. Every other object, and every parameter past the last
+one read, is skipped using the lengths warts records for them.
+
+Warts objects start with a header of a magic number, the object type and
+the length of the object. Trace and hop parameters are preceded by a bitmap
+of the parameters present (7 flags per byte, the high bit marking another
+byte) and their total length. Addresses are either defined inline (length,
+type, bytes) or refer by ID to an address defined earlier in the same
+object.
+"""
+
+import binascii
+import os
+import socket
+import struct
+import time
+from typing import Iterator
+
+MAGIC = b"\x12\x05"
+
+TYPE_TRACE = 6
+
+STOP_REASONS = ("NONE", "COMPLETED", "UNREACH", "ICMP", "LOOP", "GAPLIMIT",
+                "ERROR", "HOPLIMIT", "GSS", "HALTED")
+
+HEADER = struct.Struct(">2sHI")
+
+_U16 = struct.Struct(">H")
+_U32 = struct.Struct(">I")
+
+_ADDR_FAMILIES = {1: socket.AF_INET, 2: socket.AF_INET6}
+
+# number of address names cached by a decoder
+ADDR_CACHE_SIZE = 100000
+
+# parameter sizes of a trace up to the userid, the last parameter read;
+# "t" is a timeval (two uint32) and "a" an address
+TRACE_PARAMS = {
+    1: 4, 2: 4, 3: 4, 4: 4, 5: "t", 6: 1, 7: 1, 8: 1, 9: 1, 10: 1, 11: 1,
+    12: 2, 13: 2, 14: 2, 15: 1, 16: 1, 17: 1, 18: 1, 19: 2, 20: 1, 21: 1,
+    22: 1, 23: 2, 24: 1, 25: 1, 26: "a", 27: "a", 28: 4,
+}
+TRACE_START, TRACE_STOP_REASON, TRACE_HOP_COUNT, TRACE_DST, TRACE_USERID = 5, 6, 19, 27, 28
+
+# parameter sizes of a hop up to its address, the last parameter read;
+# "x" is an ICMP extension block (uint16 length and data)
+HOP_PARAMS = {
+    1: 4, 2: 1, 3: 1, 4: 1, 5: 1, 6: 4, 7: 2, 8: 2, 9: 2, 10: 2, 11: 1,
+    12: 2, 13: 2, 14: 1, 15: 1, 16: 1, 17: "x", 18: "a",
+}
+HOP_PROBE_TTL, HOP_RTT, HOP_ADDR = 2, 6, 18
+
+_FIXED_FORMATS = {1: "B", 2: "H", 4: "I", "t": "II"}
+
+
+def _compile(flags: bytes, sizes: dict) -> list:
+    """
+    Build the steps reading the parameters set in a flag bitmap: runs of
+    fixed-size parameters are read with one precompiled struct each, and
+    reading stops after the last parameter in `sizes`.
+
+    :return: list of (struct or "a"/"x", [(flag, number of values)])
+    """
+    present = [i * 7 + bit + 1 for i, byte in enumerate(flags)
+               for bit in range(7) if byte & (1 << bit)]
+    steps = []
+    run = []
+
+    def end_run():
+        if run:
+            fmt = ">" + "".join(_FIXED_FORMATS[sizes[flag]] for flag in run)
+            steps.append((struct.Struct(fmt), [(flag, 2 if sizes[flag] == "t" else 1) for flag in run]))
+            run.clear()
+
+    for flag in present:
+        if flag not in sizes:
+            break
+        if sizes[flag] in ("a", "x"):
+            end_run()
+            steps.append((sizes[flag], [(flag, 1)]))
+        else:
+            run.append(flag)
+    end_run()
+    return steps
+
+
+def _read_addr(buf: bytes, off: int, table: list, names: dict) -> tuple:
+    length = buf[off]
+    if length == 0:
+        return table[_U32.unpack_from(buf, off + 1)[0]], off + 5
+    end = off + 2 + length
+    # the address type byte and the address are the key of the name cache
+    key = buf[off + 1:end]
+    addr = names.get(key)
+    if addr is None:
+        family = _ADDR_FAMILIES.get(key[0])
+        addr = socket.inet_ntop(family, key[1:]) if family is not None else key[1:].hex()
+        if len(names) >= ADDR_CACHE_SIZE:
+            names.clear()
+        names[key] = addr
+    table.append(addr)
+    return addr, end
+
+
+def _read_flags(buf: bytes, off: int) -> tuple:
+    """
+    :return: (flag bitmap, offset after it)
+    """
+    start = off
+    while buf[off] & 0x80:
+        off += 1
+    return buf[start:off + 1], off + 1
+
+
+def _read_params(buf: bytes, off: int, sizes: dict, plans: dict, table: list, names: dict) -> tuple:
+    """
+    :return: (values of the parameters read keyed by flag, offset after the parameters)
+    """
+    flags, off = _read_flags(buf, off)
+    if flags == b"\x00":
+        return {}, off
+    end = off + 2 + _U16.unpack_from(buf, off)[0]
+    off += 2
+
+    steps = plans.get(flags)
+    if steps is None:
+        steps = plans[flags] = _compile(flags, sizes)
+    values = {}
+    for step, fields in steps:
+        if step == "a":
+            values[fields[0][0]], off = _read_addr(buf, off, table, names)
+        elif step == "x":
+            off += 2 + _U16.unpack_from(buf, off)[0]
+        else:
+            unpacked = step.unpack_from(buf, off)
+            off += step.size
+            i = 0
+            for flag, n in fields:
+                values[flag] = unpacked[i] if n == 1 else unpacked[i:i + n]
+                i += n
+    return values, end
+
+
+def _compile_hop(flags: bytes) -> tuple:
+    """
+    Build the fast path for the usual hop layout, fixed-size parameters
+    optionally followed by the address.
+
+    :return: (struct or None, index of the probe TTL, index of the RTT,
+    whether the address follows), or None for other layouts
+    """
+    steps = _compile(flags, HOP_PARAMS)
+    fixed, fields = None, []
+    if len(steps) > 0 and steps[0][0] not in ("a", "x"):
+        fixed, fields = steps.pop(0)
+    if len(steps) > 1 or (len(steps) == 1 and steps[0][0] != "a"):
+        return None
+    index = {}
+    i = 0
+    for flag, n in fields:
+        index[flag] = i
+        i += n
+    return fixed, index.get(HOP_PROBE_TTL), index.get(HOP_RTT), len(steps) == 1
+
+
+class TraceDecoder:
+    """
+    Decodes warts trace objects into JSON-shaped trace records. The parsing
+    steps of every flag bitmap seen are cached, as scamper writes the same
+    parameters for most traces and hops of a run, and so are the names of
+    the addresses seen.
+    """
+
+    def __init__(self) -> None:
+        self._trace_plans = {}
+        self._hop_plans = {}
+        self._hop_steps = {}
+        self._names = {}
+        self._ftime = (None, None)
+
+    def ftime(self, sec: int) -> str:
+        # scamper formats start times in local time
+        if self._ftime[0] != sec:
+            self._ftime = (sec, time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(sec)))
+        return self._ftime[1]
+
+    def decode(self, body: bytes) -> dict:
+        """
+        :param body: bytes of a trace object after its header
+        :return: the trace record
+        """
+        buf = bytes(body)
+        table = []
+        names = self._names
+        values, off = _read_params(buf, 0, TRACE_PARAMS, self._trace_plans, table, names)
+
+        record = {"type": "trace", "userid": values.get(TRACE_USERID, 0), "dst": values.get(TRACE_DST)}
+        stop_reason = values.get(TRACE_STOP_REASON, 0)
+        record["stop_reason"] = STOP_REASONS[stop_reason] if stop_reason < len(STOP_REASONS) else str(stop_reason)
+        if TRACE_START in values:
+            sec, usec = values[TRACE_START]
+            record["start"] = {"sec": sec, "usec": usec, "ftime": self.ftime(sec)}
+        record["hop_count"] = values.get(TRACE_HOP_COUNT, 0)
+
+        num_hops = _U16.unpack_from(buf, off)[0]
+        off += 2
+        if num_hops == 0:
+            return record
+        hops = []
+        plans = self._hop_plans
+        # hops of a trace nearly always share one flag bitmap
+        last_flags, last_plan = None, None
+        for _ in range(num_hops):
+            if last_flags is not None and buf.startswith(last_flags, off):
+                start = off
+                off += len(last_flags)
+                plan = last_plan
+            else:
+                start = off
+                flags, off = _read_flags(buf, off)
+                plan = plans.get(flags, False)
+                if plan is False:
+                    plan = plans[flags] = _compile_hop(flags) if flags != b"\x00" else None
+                last_flags, last_plan = flags, plan
+            if plan is None:
+                hop, off = _read_params(buf, start, HOP_PARAMS, self._hop_steps, table, names)
+                ttl, rtt, addr = hop.get(HOP_PROBE_TTL), hop.get(HOP_RTT, 0), hop.get(HOP_ADDR)
+            else:
+                fixed, ttl_i, rtt_i, has_addr = plan
+                end = off + 2 + (buf[off] << 8 | buf[off + 1])
+                off += 2
+                ttl, rtt, addr = None, 0, None
+                if fixed is not None:
+                    unpacked = fixed.unpack_from(buf, off)
+                    off += fixed.size
+                    if ttl_i is not None:
+                        ttl = unpacked[ttl_i]
+                    if rtt_i is not None:
+                        rtt = unpacked[rtt_i]
+                if has_addr:
+                    # inline `_read_addr` for addresses already named
+                    addr = names.get(buf[off + 1:off + 2 + buf[off]]) if buf[off] else None
+                    if addr is None:
+                        addr, _ = _read_addr(buf, off, table, names)
+                    else:
+                        table.append(addr)
+                off = end
+            hops.append({"addr": addr, "probe_ttl": ttl, "rtt": rtt / 1000})
+        record["hops"] = hops
+        return record
+
+
+def iter_objects(source) -> Iterator[tuple]:
+    """
+    Read the objects of a warts stream.
+
+    :param source: binary file or pipe positioned at the start of an object
+    :return: generator of (object type, object body)
+    """
+    while True:
+        header = source.read(HEADER.size)
+        if len(header) < HEADER.size:
+            return
+        magic, obj_type, length = HEADER.unpack(header)
+        if magic != MAGIC:
+            raise Exception("Not a warts object: bad magic " + magic.hex())
+        body = source.read(length)
+        if len(body) < length:
+            # a truncated last object, e.g. from an interrupted scamper
+            return
+        yield obj_type, body
+
+
+def iter_traces(source) -> Iterator[dict]:
+    """
+    Read a warts stream and yield its trace records.
+
+    :param source: file path, binary file or pipe
+    :return: generator of JSON-shaped trace records
+    """
+    if isinstance(source, (str, os.PathLike)):
+        with open(source, "rb") as f:
+            yield from iter_traces(f)
+        return
+
+    decoder = TraceDecoder()
+    for obj_type, body in iter_objects(source):
+        if obj_type == TYPE_TRACE:
+            yield decoder.decode(body)
+
+
+class StreamDecoder:
+    """
+    Incrementally decodes warts data arriving in pieces, such as the
+    uuencoded lines scamper sends over its control socket with
+    `attach format warts`.
+    """
+
+    def __init__(self) -> None:
+        self._buf = bytearray()
+        self._decoder = TraceDecoder()
+
+    def feed_uu(self, line) -> list:
+        """
+        :param line: a uuencoded line
+        :return: the trace records completed by the line
+        """
+        return self.feed(binascii.a2b_uu(line))
+
+    def feed(self, data: bytes) -> list:
+        """
+        :param data: the next bytes of the warts stream
+        :return: the trace records completed by the data
+        """
+        self._buf += data
+        records = []
+        off = 0
+        while len(self._buf) - off >= HEADER.size:
+            magic, obj_type, length = HEADER.unpack_from(self._buf, off)
+            if magic != MAGIC:
+                raise Exception("Not a warts object: bad magic " + magic.hex())
+            if len(self._buf) - off - HEADER.size < length:
+                break
+            start = off + HEADER.size
+            off = start + length
+            if obj_type == TYPE_TRACE:
+                records.append(self._decoder.decode(bytes(self._buf[start:off])))
+        del self._buf[:off]
+        return records